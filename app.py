@@ -6,13 +6,15 @@ import requests
 import json
 import datetime
 import time
-from PIL import Image
 import os
 import io
 import base64
 import re  # 正規表現用
 import uuid # UUID生成用
 import pandas as pd # ランキング表示の整形用
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # --- ★数式画像化機能（matplotlib）を削除 ---
 from reportlab.pdfgen import canvas
@@ -21,6 +23,25 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.units import mm
 
+from model_runtime import ModelHealthRegistry, run_stream_worker, hedge_deadline_ms # ★追加: モデルごとのサーキットブレーカー
+from model_runtime import GenerativeModelCache, ensure_genai_configured # ★追加: モデルの使い回し
+from model_runtime import build_call_metric, usage_to_dict # ★追加: 呼び出しごとの計測
+from chat_context import build_windowed_history, build_summary_prompt, new_context_state # ★追加: トークン予算つき会話ウィンドウ
+from image_pipeline import preprocess_image, format_image_stats # ★追加: アップロード画像の前処理
+from image_pipeline import image_fingerprint, ImageTranscriptionCache, transcribe_image_job # ★追加: 同じ写真の読み取り結果キャッシュ
+from firestore_writer import WriteBehindQueue # ★追加: チャット保存のライトビハインド
+from study_rollups import add_rollup_increments, rebuild_rollups # ★追加: 学習時間の事前集計
+from team_membership import create_team, join_team, leave_team, TeamJoinError # ★追加: 招待コード索引つきのチーム参加
+from leaderboard import LeaderboardCache, compute_leaderboard # ★追加: ランキングの共有キャッシュ
+from study_rollups import load_rollups # ★追加: 順位インデックスの作り直し用
+from rank_index import StudyRankIndex # ★追加: 全ユーザーの順位インデックス
+from user_directory import UserDirectory # ★追加: 管理者用のユーザー名簿（検索・ページング）
+from archive_store import list_archives, load_archive_messages # ★追加: アーカイブの一覧/本体の分離
+from archive_jobs import ArchiveJobRunner, ACTIVE_STATUSES, STAGE_LABELS # ★追加: 履歴アーカイブのバックグラウンド・ジョブ
+from archive_search import ArchiveSearchIndex, write_search_segments # ★追加: アーカイブの全文検索（文字n-gram索引）
+from similar_problems import SimilarProblemIndex # ★追加: 過去に解いた似た問題の検索（TF-IDF）
+from session_cache import UserSessionCache # ★追加: プロフィールと入室記録のセッション内キャッシュ
+
 # --- 0. 設定と定数 ---
 st.set_page_config(page_title="AI数学専属コーチ", page_icon="🎓", layout="centered", initial_sidebar_state="expanded")
 
@@ -209,6 +230,49 @@ if "GEMINI_API_KEY" in st.secrets:
 else:
     GEMINI_API_KEY = None
 
+# ★追加: ヘッジ（競争）リクエスト設定（オプトイン）
+# 主モデルが「最初の文字」を返すまでの待ち時間が p95 由来の締切を超えたら、次のモデルにも同じ質問を投げて速い方を採用する
+if "CHAT_HEDGING" in st.secrets:
+    CHAT_HEDGING = dict(st.secrets["CHAT_HEDGING"])
+else:
+    CHAT_HEDGING = {}
+HEDGING_ENABLED = bool(CHAT_HEDGING.get("enabled", False))
+HEDGE_PERCENTILE = int(CHAT_HEDGING.get("percentile", 95))
+HEDGE_MIN_DEADLINE_MS = int(CHAT_HEDGING.get("min_deadline_ms", 1500))
+HEDGE_MAX_DEADLINE_MS = int(CHAT_HEDGING.get("max_deadline_ms", 8000))
+HEDGE_DEFAULT_DEADLINE_MS = int(CHAT_HEDGING.get("default_deadline_ms", 4000))
+HEDGE_TIMEOUT_SECONDS = int(CHAT_HEDGING.get("timeout_seconds", 120))
+
+# ★追加: AIに送る会話履歴のトークン予算（超えた古い発言は要約に畳み込む）
+if "CHAT_CONTEXT_TOKEN_BUDGET" in st.secrets:
+    CHAT_CONTEXT_TOKEN_BUDGET = int(st.secrets["CHAT_CONTEXT_TOKEN_BUDGET"])
+else:
+    CHAT_CONTEXT_TOKEN_BUDGET = 6000
+
+# ★追加: 「同じ写真」とみなす知覚ハッシュのハミング距離（0〜2。小さいほど厳密。2より大きい値は2として扱う）
+if "IMAGE_CACHE_MAX_DISTANCE" in st.secrets:
+    IMAGE_CACHE_MAX_DISTANCE = int(st.secrets["IMAGE_CACHE_MAX_DISTANCE"])
+else:
+    IMAGE_CACHE_MAX_DISTANCE = 2
+
+# ★追加: ランキングのスナップショットを使い回す秒数（退室時には即時に作り直す）
+if "LEADERBOARD_TTL_SECONDS" in st.secrets:
+    LEADERBOARD_TTL_SECONDS = int(st.secrets["LEADERBOARD_TTL_SECONDS"])
+else:
+    LEADERBOARD_TTL_SECONDS = 60
+
+# ★追加: 似た過去問のやり取りを、AIへの入力に短い参考情報として添えるか（既定はオフ。画面への表示は常に行う）
+if "SIMILAR_CONTEXT_ENABLED" in st.secrets:
+    SIMILAR_CONTEXT_ENABLED = str(st.secrets["SIMILAR_CONTEXT_ENABLED"]).lower() in ("1", "true", "yes")
+else:
+    SIMILAR_CONTEXT_ENABLED = False
+
+# ★追加: アーカイブ1チャンクの圧縮後の最大バイト数（1ドキュメント1MiBの上限未満）
+if "ARCHIVE_CHUNK_BYTES" in st.secrets:
+    ARCHIVE_CHUNK_BYTES = int(st.secrets["ARCHIVE_CHUNK_BYTES"])
+else:
+    ARCHIVE_CHUNK_BYTES = 256 * 1024
+
 # --- 1. Firebase初期化 ---
 if not firebase_admin._apps:
     try:
@@ -237,6 +301,195 @@ if not firebase_admin._apps:
 
 db = firestore.client()
 
+# --- ★追加: Firestore書き込みキュー（全セッションで共有） ---
+@st.cache_resource
+def get_write_queue():
+    """チャットの保存をまとめてコミットするライトビハインド・キュー（プロセスに1つ）"""
+    return WriteBehindQueue(db)
+
+# --- ★追加: ランキングのスナップショット（全セッションで共有） ---
+@st.cache_resource
+def get_leaderboard_cache():
+    """個人/チーム×日/週/月の6表を1回だけ計算して共有するキャッシュ（プロセスに1つ）"""
+    return LeaderboardCache(lambda: compute_leaderboard(db), ttl_seconds=LEADERBOARD_TTL_SECONDS)
+
+@st.cache_resource
+def get_rank_index():
+    """日/週/月の全ユーザーの順位インデックス（プロセスに1つ。5分ごとにロールアップから作り直す）"""
+    return StudyRankIndex(lambda: load_rollups(db), refresh_seconds=300)
+
+@st.cache_resource
+def get_user_directory():
+    """管理者画面用のユーザー名簿（プロセスに1つ。新規ユーザーだけを差分で読み足す）"""
+    return UserDirectory(db)
+
+def client_timestamp():
+    """キュー経由で保存するデータ用の時刻（同じバッチ内で SERVER_TIMESTAMP が同値になり順序が崩れるのを避ける）"""
+    return datetime.datetime.now(datetime.timezone.utc)
+
+# --- ★追加: Gemini共通リソース（全セッションで共有） ---
+@st.cache_resource
+def get_model_cache():
+    """構築済みGenerativeModelの共有キャッシュ（プロセスに1つ）"""
+    return GenerativeModelCache(
+        lambda name, instruction, config: genai.GenerativeModel(name, system_instruction=instruction, generation_config=config)
+    )
+
+def get_generative_model(model_name, system_instruction=None, generation_config=None):
+    """genai.configure（プロセス内で初回のみ）とモデル取得をまとめたヘルパー"""
+    ensure_genai_configured(genai, GEMINI_API_KEY)
+    return get_model_cache().get(model_name, system_instruction, generation_config)
+
+# ★追加: Gemini呼び出しごとの計測（実トークン数・遅延・結果）を gemini_call_metrics に保存する
+def record_gemini_call(metric, uid=None, write_queue=None):
+    """build_call_metric で作ったレコードをキュー経由で保存（バックグラウンドスレッドからは uid/write_queue を渡す）"""
+    try:
+        write_queue = write_queue or get_write_queue()
+        write_queue.enqueue_add(db.collection("gemini_call_metrics"), {
+            **metric,
+            "uid": uid or st.session_state.user_info["uid"],
+            "timestamp": client_timestamp(),
+        })
+    except Exception as e:
+        print(f"Metric record error: {e}")
+
+def timed_generate_content(purpose, model_name, prompt, system_instruction=None, uid=None, write_queue=None, model_cache=None):
+    """
+    generate_content を1回呼び、計測を記録してレスポンスを返す（失敗時は例外をそのまま投げる）。
+    バックグラウンドスレッドからは uid/write_queue/model_cache を渡す（st.* に触らないように）
+    """
+    started = time.perf_counter()
+    try:
+        if model_cache is None:
+            model = get_generative_model(model_name, system_instruction)
+        else:
+            ensure_genai_configured(genai, GEMINI_API_KEY)
+            model = model_cache.get(model_name, system_instruction)
+        resp = model.generate_content(prompt)
+    except Exception as e:
+        record_gemini_call(build_call_metric(purpose, model_name, "error", int((time.perf_counter() - started) * 1000), error=e),
+                           uid=uid, write_queue=write_queue)
+        raise
+    wall_ms = int((time.perf_counter() - started) * 1000)
+    record_gemini_call(build_call_metric(purpose, model_name, "success", wall_ms, ttft_ms=wall_ms,
+                                         usage=usage_to_dict(getattr(resp, "usage_metadata", None))),
+                       uid=uid, write_queue=write_queue)
+    return resp
+
+# --- ★追加: 会話履歴アーカイブのバックグラウンド・ジョブ（全セッションで共有） ---
+@st.cache_resource
+def get_archive_job_runner():
+    """「会話履歴を全削除」のタイトル生成・アーカイブ保存・削除を行うジョブ実行器（プロセスに1つ）"""
+    model_cache = get_model_cache()
+    write_queue = get_write_queue()
+
+    def generate_archive_title(uid, transcript):
+        # ワーカースレッドで呼ばれるので st.* には触らない
+        if not GEMINI_API_KEY:
+            return None
+        summary_prompt = f"""
+        以下の学習ログを読んで、このセッションの内容を一言（20文字以内）で要約し、タイトルをつけてください。
+        タイトルのみを出力してください。
+        
+        ログ:
+        {transcript[:5000]}
+        """
+        resp_summary = timed_generate_content("archive_title", "gemini-2.0-flash-exp", summary_prompt,
+                                              uid=uid, write_queue=write_queue, model_cache=model_cache)
+        return resp_summary.text.strip() if resp_summary and resp_summary.text else None
+
+    search_index = get_archive_search()
+
+    def index_archive(uid, archive_id, title, messages):
+        # アーカイブを書いた直後に、その1件分だけ検索索引を作る
+        segments = write_search_segments(db, db.collection("users").document(uid), archive_id, title,
+                                         datetime.datetime.now(datetime.timezone.utc), messages)
+        search_index.add_segments(uid, segments)
+
+    return ArchiveJobRunner(db, generate_archive_title, ARCHIVE_CHUNK_BYTES, write_queue=write_queue,
+                            on_archived=index_archive)
+
+@st.cache_resource
+def get_archive_search():
+    """アーカイブ検索の索引キャッシュ（プロセスに1つ。ユーザーごとに索引セグメントをメモリに持つ）"""
+    return ArchiveSearchIndex(db)
+
+@st.cache_resource
+def get_similar_problems():
+    """過去のやり取りとの類似度検索（プロセスに1つ。アーカイブ検索の索引から作る）"""
+    return SimilarProblemIndex(get_archive_search())
+
+def track_archive_jobs(uid):
+    """
+    前のセッション・他の端末で始めた未完了のアーカイブも追う（会話履歴を読み込む前に1回だけ）。
+    アーカイブ中（queued/running）の履歴は画面に出さないよう、一番新しい cutoff を history_floor にする。
+    failed のジョブの履歴はアーカイブされていないので隠さない（再試行ボタンだけ出す）
+    """
+    try:
+        jobs = get_archive_job_runner().jobs_for_user(uid)
+    except Exception as e:
+        print(f"Archive job lookup error: {e}")
+        return
+    for job in jobs:
+        if job["id"] not in st.session_state.archive_job_ids:
+            st.session_state.archive_job_ids.append(job["id"])
+        cutoff = job.get("cutoff")
+        if job.get("status") not in ACTIVE_STATUSES or cutoff is None:
+            continue
+        if st.session_state.history_floor is None or cutoff > st.session_state.history_floor:
+            st.session_state.history_floor = cutoff
+
+def reset_history_floor(jobs):
+    """history_floor を実行中のジョブの cutoff だけで決め直す。変わったら会話履歴を読み直す"""
+    cutoffs = [job["cutoff"] for job in jobs if job.get("status") in ACTIVE_STATUSES and job.get("cutoff") is not None]
+    floor = max(cutoffs) if cutoffs else None
+    if floor != st.session_state.history_floor:
+        st.session_state.history_floor = floor
+        st.session_state.messages_loaded = False
+        return True
+    return False
+
+def render_archive_job_status():
+    """サイドバーにアーカイブの進捗を出す（このプロセスで実行中のジョブは Firestore を読まない）"""
+    if not st.session_state.archive_job_ids:
+        return
+    runner = get_archive_job_runner()
+    still_running = False
+    tracked, any_failed = [], False
+    for job_id in list(st.session_state.archive_job_ids):
+        job = runner.status(job_id)
+        if job is None:
+            st.session_state.archive_job_ids.remove(job_id)
+            continue
+        tracked.append(job)
+        status = job.get("status")
+        if status == "done":
+            st.success("🗄️ 会話をアーカイブしました（「過去の復習」から見られます）" if job.get("archived", True)
+                       else "🗄️ 会話履歴をリセットしました")
+            st.session_state.archive_job_ids.remove(job_id)
+        elif status == "failed":
+            any_failed = True
+            st.error(f"🗄️ アーカイブに失敗しました（会話履歴は消えていません）: {job.get('error', '')}")
+            if st.button("🔁 もう一度試す", key=f"archive_retry_{job_id}"):
+                runner.retry(job_id)
+                # やり直す間は、また cutoff 以前の履歴を隠す
+                cutoff = job.get("cutoff")
+                if cutoff is not None and (st.session_state.history_floor is None or cutoff > st.session_state.history_floor):
+                    st.session_state.history_floor = cutoff
+                    st.session_state.messages_loaded = False
+                st.rerun()
+        else:
+            still_running = True
+            label = STAGE_LABELS.get(job.get("stage"), "処理中")
+            if status == "queued" and job.get("attempts"):
+                label = f"再試行待ち（{job['attempts']}回目が失敗）"
+            st.progress(min(1.0, float(job.get("progress") or 0.0)), text=f"🗄️ アーカイブ: {label}")
+    # ★変更: 失敗したジョブの cutoff で隠していた履歴は、アーカイブされていないので再び表示する
+    if any_failed and reset_history_floor(tracked):
+        st.rerun()
+    if still_running and st.button("🔄 進捗を更新", key="archive_job_refresh"):
+        st.rerun()
+
 # --- 2. 認証機能ヘルパー関数 ---
 def sign_in_with_email(email, password):
     url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={FIREBASE_WEB_API_KEY}"
@@ -264,6 +517,8 @@ if "managed_team_name" not in st.session_state:
 
 if "last_used_model" not in st.session_state:
     st.session_state.last_used_model = "まだ回答していません"
+if "last_ttft_ms" not in st.session_state:
+    st.session_state.last_ttft_ms = None
 if "last_report" not in st.session_state:
     st.session_state.last_report = ""
 
@@ -271,6 +526,20 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
 if "messages_loaded" not in st.session_state:
     st.session_state.messages_loaded = False
+if "chat_context" not in st.session_state:
+    st.session_state.chat_context = new_context_state()
+# ★追加: 会話履歴のページング状態（表示中の最古メッセージの時刻・さらに古い履歴の有無・それより前の件数）
+if "history_cursor" not in st.session_state:
+    st.session_state.history_cursor = None
+if "history_has_more" not in st.session_state:
+    st.session_state.history_has_more = False
+if "history_offset" not in st.session_state:
+    st.session_state.history_offset = 0
+# ★追加: アーカイブ中のジョブ（このセッションで追っているもの）と、それより前の履歴を読まないための時刻
+if "archive_job_ids" not in st.session_state:
+    st.session_state.archive_job_ids = []
+if "history_floor" not in st.session_state:
+    st.session_state.history_floor = None
     
 if "debug_logs" not in st.session_state:
     st.session_state.debug_logs = []
@@ -313,16 +582,18 @@ if st.session_state.user_info is None:
                     if st.session_state.user_role != "global_admin":
                         try:
                             u_ref = db.collection("users").document(uid)
+                            # ★変更: 確認した入室記録はセッションのキャッシュに入れ、ポータルで読み直さない
+                            user_cache = UserSessionCache(u_ref, resp["email"])
+                            st.session_state.user_cache = user_cache
                             # 既存のactiveログがないか確認
-                            active_logs = u_ref.collection("attendance_logs")\
-                                            .where("status", "==", "active")\
-                                            .limit(1).stream()
-                            if not next(active_logs, None):
-                                u_ref.collection("attendance_logs").add({
+                            if not user_cache.active_attendance():
+                                new_log = {
                                     "entry_timestamp": firestore.SERVER_TIMESTAMP,
                                     "status": "active",
                                     "note": "ログインによる自動入室"
-                                })
+                                }
+                                _, new_log_ref = u_ref.collection("attendance_logs").add(new_log)
+                                user_cache.set_active_attendance(new_log_ref.id, new_log)
                         except Exception as e:
                             print(f"Login entry record error: {e}")
 
@@ -377,16 +648,15 @@ user_email = st.session_state.user_info["email"]
 user_role = st.session_state.get("user_role", "student") # ロール取得
 
 user_ref = db.collection("users").document(user_id)
+
+# ★追加: プロフィールと進行中の入室記録はセッション内のキャッシュから読む（変更はライトスルーで反映）
+if st.session_state.get("user_cache") is None or st.session_state.user_cache.user_ref.id != user_id:
+    st.session_state.user_cache = UserSessionCache(user_ref, user_email)
+user_cache = st.session_state.user_cache
+
 if "user_name" not in st.session_state:
     try:
-        user_doc = user_ref.get()
-        if not user_doc.exists:
-            user_data = {"email": user_email, "created_at": firestore.SERVER_TIMESTAMP} 
-            user_ref.set(user_data)
-            st.session_state.user_name = "ゲスト"
-        else:
-            user_data = user_doc.to_dict()
-            st.session_state.user_name = user_data.get("name", "ゲスト")
+        st.session_state.user_name = user_cache.profile().get("name", "ゲスト")
     except Exception as e:
         st.session_state.user_name = "ゲスト"
 
@@ -417,88 +687,44 @@ with st.sidebar:
     
     st.markdown("---")
 
+    # ★追加: バックグラウンドで進めているアーカイブの進捗
+    render_archive_job_status()
+
     # AIコーチ画面の場合のみ「会話履歴削除」を表示
     if st.session_state.current_page == "chat":
         if st.button("🗑️ 会話履歴を全削除", key="sb_clear_history"):
-            with st.spinner("会話内容を要約してアーカイブ保存しています..."):
-                try:
-                    # 1. 履歴を取得
-                    history_stream = user_ref.collection("history").order_by("timestamp").stream()
-                    session_logs = []
-                    full_text_for_summary = ""
-                    
-                    batch = db.batch()
-                    doc_count = 0
-                    
-                    for doc in history_stream:
-                        data = doc.to_dict()
-                        session_logs.append(data)
-                        content_str = data.get("content", "")
-                        role_str = data.get("role", "")
-                        full_text_for_summary += f"{role_str}: {content_str}\n"
-                        
-                        # 物理削除の準備
-                        batch.delete(doc.reference)
-                        doc_count += 1
-                        
-                        if doc_count >= 400:
-                            batch.commit()
-                            batch = db.batch()
-                            doc_count = 0
-                    
-                    # 2. Geminiでタイトル生成
-                    archive_title = datetime.datetime.now(JST).strftime('%Y/%m/%d の学習') # デフォルト
-                    if full_text_for_summary and GEMINI_API_KEY:
-                        try:
-                            genai.configure(api_key=GEMINI_API_KEY)
-                            try:
-                                model_flash = genai.GenerativeModel("gemini-2.0-flash-exp")
-                            except:
-                                model_flash = genai.GenerativeModel("gemini-1.5-flash")
-                                
-                            summary_prompt = f"""
-                            以下の学習ログを読んで、このセッションの内容を一言（20文字以内）で要約し、タイトルをつけてください。
-                            タイトルのみを出力してください。
-                            
-                            ログ:
-                            {full_text_for_summary[:5000]}
-                            """
-                            resp_summary = model_flash.generate_content(summary_prompt)
-                            if resp_summary and resp_summary.text:
-                                archive_title = resp_summary.text.strip()
-                        except Exception as e_gen:
-                            print(f"Summary generation failed: {e_gen}")
-                    
-                    # 3. アーカイブ保存
-                    if session_logs:
-                        user_ref.collection("archived_sessions").add({
-                            "title": archive_title,
-                            "archived_at": firestore.SERVER_TIMESTAMP,
-                            "messages": session_logs,
-                            "note": "ユーザーによる全削除時の自動アーカイブ"
-                        })
-                    
-                    # 4. 物理削除の実行（残りのバッチ）
-                    if doc_count > 0:
-                        batch.commit()
-
-                except Exception as e:
-                    st.error(f"アーカイブ保存エラー: {e}")
+            # ★変更: 要約・アーカイブ保存・削除はバックグラウンドのジョブに任せ、画面はすぐにリセットする
+            try:
+                cutoff = client_timestamp() # この時刻までの履歴がアーカイブ対象（リセット後の会話は含めない）
+                job_id = get_archive_job_runner().submit(user_id, cutoff, "ユーザーによる全削除時の自動アーカイブ")
+                # 会話の要約状態もリセット（キュー経由なので、先に積まれた要約の保存より後に消える）
+                get_write_queue().enqueue_delete(user_ref.collection("chat_context").document("current"))
 
+                st.session_state.archive_job_ids.append(job_id)
+                st.session_state.history_floor = cutoff
                 st.session_state.last_report = "" 
                 st.session_state.messages = [] 
                 st.session_state.messages_loaded = True 
+                st.session_state.chat_context = new_context_state()
+                st.session_state.history_cursor = None
+                st.session_state.history_has_more = False
+                st.session_state.history_offset = 0
                 st.session_state.debug_logs = [] 
-                st.success("履歴をアーカイブしてリセットしました")
-                time.sleep(1)
+            except Exception as e:
+                st.error(f"アーカイブの開始に失敗しました: {e}")
+            else:
                 st.rerun()
         st.markdown("---")
 
     if st.button("退室する", use_container_width=True, key="sb_logout"):
+        # ★追加: キューに残っている会話の保存を吐き出してから退室
+        get_write_queue().flush()
+
         # --- ★退室処理（管理者以外のみ時間記録） ---
         if user_role != "global_admin":
             try:
                 # 最新のactiveなログを取得してクローズ
+                # （退室は他の端末で済んでいる可能性があるので、キャッシュではなく Firestore の現在の値で確認する）
                 active_logs = user_ref.collection("attendance_logs")\
                                     .where("status", "==", "active")\
                                     .limit(1).stream()
@@ -515,30 +741,46 @@ with st.sidebar:
                         duration = int((exit_dt - entry_dt).total_seconds() // 60)
                         if duration < 1: duration = 1
                         
-                        batch = db.batch()
-                        
-                        # 1. Attendance Log Close
-                        batch.update(user_ref.collection("attendance_logs").document(log_id), {
-                            "exit_timestamp": firestore.SERVER_TIMESTAMP,
-                            "duration_minutes": duration,
-                            "status": "completed"
-                        })
-                        
-                        # 2. Total Study Minutes Update
-                        batch.update(user_ref, {
-                            "totalStudyMinutes": firestore.Increment(duration)
-                        })
-                        
-                        # 3. Study Log (バックグラウンド記録 - ランキング集計用)
-                        new_log_ref = user_ref.collection("study_logs").document()
-                        batch.set(new_log_ref, {
-                            "minutes": duration,
-                            "date": exit_dt.strftime('%Y-%m-%d'),
-                            "timestamp": firestore.SERVER_TIMESTAMP,
-                            "note": "自動計測ログ(システム用)"
-                        })
-                        
-                        batch.commit()
+                        log_ref = user_ref.collection("attendance_logs").document(log_id)
+
+                        # ★変更: チームの参加・脱退（トランザクション）と同時に退室しても、分を正しいチームに加算するよう
+                        # teamId の読み込みと加算を1つのトランザクションで行う
+                        @firestore.transactional
+                        def close_attendance(transaction):
+                            log_snap = log_ref.get(transaction=transaction)
+                            if not log_snap.exists or (log_snap.to_dict() or {}).get("status") != "active":
+                                return False  # 他の端末で既に退室済み
+                            team_snap = user_ref.get(field_paths=["teamId"], transaction=transaction)
+                            my_team_id = (team_snap.to_dict() or {}).get("teamId") if team_snap.exists else None
+
+                            # 1. Attendance Log Close
+                            transaction.update(log_ref, {
+                                "exit_timestamp": firestore.SERVER_TIMESTAMP,
+                                "duration_minutes": duration,
+                                "status": "completed"
+                            })
+
+                            # 2. Total Study Minutes Update
+                            transaction.update(user_ref, {
+                                "totalStudyMinutes": firestore.Increment(duration)
+                            })
+
+                            # 3. Study Log (バックグラウンド記録 - ランキング集計用)
+                            new_log_ref = user_ref.collection("study_logs").document()
+                            transaction.set(new_log_ref, {
+                                "minutes": duration,
+                                "date": exit_dt.strftime('%Y-%m-%d'),
+                                "timestamp": firestore.SERVER_TIMESTAMP,
+                                "note": "自動計測ログ(システム用)"
+                            })
+
+                            # 4. ★追加: 日/週/月のロールアップ（ランキング集計用）を同じトランザクションで加算
+                            add_rollup_increments(transaction, db, user_id, my_team_id, duration, exit_dt)
+                            return True
+
+                        if close_attendance(db.transaction()):
+                            get_leaderboard_cache().invalidate()
+                            get_rank_index().add_minutes(user_id, duration, exit_dt)
                         
             except Exception as e:
                 print(f"Logout exit record error: {e}")
@@ -547,8 +789,14 @@ with st.sidebar:
         st.session_state.user_info = None
         st.session_state.messages = []
         st.session_state.messages_loaded = False
+        st.session_state.chat_context = new_context_state()
+        st.session_state.history_cursor = None
+        st.session_state.history_has_more = False
+        st.session_state.history_offset = 0
+        st.session_state.history_floor = None
+        st.session_state.archive_job_ids = []
         st.session_state.debug_logs = []
-        keys_to_remove = ["user_name", "current_page", "is_anon_ranking", "user_role"]
+        keys_to_remove = ["user_name", "current_page", "is_anon_ranking", "user_role", "user_cache"]
         for k in keys_to_remove:
             if k in st.session_state:
                 del st.session_state[k]
@@ -581,47 +829,103 @@ def render_admin_tools_page():
         with col1:
             st.markdown("#### モデル稼働状況")
             st.info(f"**最後に使用したモデル:** `{st.session_state.last_used_model}`")
+            if st.session_state.last_ttft_ms is not None:
+                st.caption(f"最初の文字が表示されるまで: {st.session_state.last_ttft_ms} ms")
+            st.caption(f"ヘッジモード: {'有効' if HEDGING_ENABLED else '無効'}")
+            cache_stats = get_model_cache().stats()
+            st.caption(f"モデルキャッシュ: {cache_stats['entries']}件 (ヒット {cache_stats['hits']} / ミス {cache_stats['misses']})")
+            uc_stats = user_cache.stats()
+            st.caption(f"プロフィールキャッシュ（このセッション）: 読み込み {uc_stats['reads']}回 / キャッシュから {uc_stats['hits']}回")
+            dir_stats = get_user_directory().stats()
+            st.caption(f"ユーザー名簿: {dir_stats['users']}人 (全件読み込み {dir_stats['full_loads']}回 / 差分 {dir_stats['incremental_loads']}回)")
+            wq_stats = get_write_queue().stats()
+            st.caption(f"書き込みキュー: 待ち {wq_stats['pending']}件 / 保存済み {wq_stats['committed']}件 / 失敗 {wq_stats['failed_flushes']}回 / 再試行待ちに戻した {wq_stats['requeued']}件 / 書けずに破棄 {wq_stats['dropped']}件")
+            as_stats = get_archive_search().stats()
+            st.caption(f"アーカイブ検索索引: {as_stats['users']}人 / {as_stats['segments']}セグメント (全件読み込み {as_stats['full_loads']}回 / 差分 {as_stats['incremental_loads']}回 / 前回の検索 {as_stats['last_search_ms']} ms)")
+            sp_stats = get_similar_problems().stats()
+            st.caption(f"似た問題の検索: {sp_stats['users']}人 / {sp_stats['exchanges']}件のやり取り (検索 {sp_stats['queries']}回 / 前回 {sp_stats['last_query_ms']} ms / 裏での準備 {sp_stats['warmups']}回・前回 {sp_stats['last_warm_ms']} ms)")
+            aj_stats = get_archive_job_runner().stats()
+            st.caption(f"アーカイブジョブ: 実行中 {aj_stats['running']}件 / 完了 {aj_stats['completed']}件 / 失敗 {aj_stats['failed']}件 / 再試行 {aj_stats['retries']}回 / 拾い直し {aj_stats['recovered']}件 (前回 {aj_stats['last_job_ms']} ms)")
+            if aj_stats["last_delete_stats"]:
+                ds = aj_stats["last_delete_stats"]
+                st.caption(f"履歴の一括削除（前回）: {ds['deleted']}件 / {ds['seconds']}秒 = {ds['docs_per_sec']}件/秒 (再試行 {ds['retries']}回 / 失敗 {ds['failed']}件)")
+            ri_stats = get_rank_index().stats()
+            st.caption(f"順位インデックス: {ri_stats['users']} / 作り直し {ri_stats['rebuilds']}回 (前回 {ri_stats['last_rebuild_ms']} ms)")
+            lb_stats = get_leaderboard_cache().stats()
+            st.caption(f"ランキングキャッシュ: ヒット {lb_stats['hits']} / 再計算 {lb_stats['misses']} (前回 {lb_stats['compute_ms']} ms)")
+            img_cache_stats = get_image_cache().stats()
+            st.caption(f"画像読み取りキャッシュ: {img_cache_stats['entries']}件 (ヒット {img_cache_stats['hits']} / ミス {img_cache_stats['misses']})")
         
         with col2:
-            st.markdown("#### コスト試算")
-            if st.button("📊 直近1000件から試算", key="admin_cost_calc"):
+            st.markdown("#### コスト・遅延（実測）")
+            USD_JPY = 155.5
+            # ★変更: 文字数からの推定ではなく、呼び出しごとに記録した実トークン数・遅延から集計する
+            if st.button("📊 直近5000回の呼び出しを集計", key="admin_cost_calc"):
                 with st.spinner("集計中..."):
                     try:
-                        INPUT_PRICE_PER_M = 0.50 
-                        OUTPUT_PRICE_PER_M = 3.00
-                        USD_JPY = 155.5
-                        SYSTEM_PROMPT_EST_LEN = 700 
-                        
-                        logs_ref = user_ref.collection("full_conversation_logs").order_by("timestamp", direction=firestore.Query.DESCENDING).limit(1000)
-                        docs = logs_ref.stream()
-                        logs = [d.to_dict() for d in docs]
-                        
-                        if logs:
-                            total_input_chars = 0
-                            total_output_chars = 0
-                            history_buffer_len = 0
-                            for log in logs:
-                                content = log.get("content", "")
-                                content_len = len(content)
-                                img_cost = 0
-                                if "(※画像を送信しました)" in content:
-                                    img_cost = 300
-                                if log.get("role") == "user":
-                                    current_input = SYSTEM_PROMPT_EST_LEN + history_buffer_len + content_len + img_cost
-                                    total_input_chars += current_input
-                                    history_buffer_len += content_len
-                                elif log.get("role") == "model":
-                                    total_output_chars += content_len
-                                    history_buffer_len += content_len
-                            input_cost_usd = (total_input_chars / 1_000_000) * INPUT_PRICE_PER_M
-                            output_cost_usd = (total_output_chars / 1_000_000) * OUTPUT_PRICE_PER_M
-                            total_jpy = (input_cost_usd + output_cost_usd) * USD_JPY
-                            st.metric("推定総コスト", f"¥ {total_jpy:.2f}")
+                        get_write_queue().flush()
+                        metrics_ref = db.collection("gemini_call_metrics").order_by("timestamp", direction=firestore.Query.DESCENDING).limit(5000)
+                        metrics = [d.to_dict() for d in metrics_ref.stream()]
+
+                        if metrics:
+                            df_metrics = pd.DataFrame(metrics)
+                            total_jpy = df_metrics["cost_usd"].fillna(0).sum() * USD_JPY
+                            st.metric("総コスト（実トークン）", f"¥ {total_jpy:.2f}")
+                            st.session_state.admin_call_metrics = df_metrics
                         else:
                             st.warning("ログなし")
                     except Exception as e:
                         st.error(f"計算エラー: {e}")
 
+        if st.session_state.get("admin_call_metrics") is not None:
+            df_metrics = st.session_state.admin_call_metrics
+            summary_rows = []
+            for (model_name, purpose), grp in df_metrics.groupby(["model", "purpose"]):
+                ttft = grp["ttft_ms"].dropna()
+                summary_rows.append({
+                    "モデル": model_name,
+                    "用途": purpose,
+                    "呼出": len(grp),
+                    "成功率": f"{(grp['outcome'] == 'success').mean() * 100:.0f}%",
+                    "再試行": int(grp["retry_count"].fillna(0).sum()),
+                    "入力tok": int(grp["prompt_tokens"].fillna(0).sum()),
+                    "出力tok": int(grp["candidate_tokens"].fillna(0).sum()),
+                    "コスト(¥)": round(grp["cost_usd"].fillna(0).sum() * USD_JPY, 2),
+                    "TTFT p50": int(ttft.quantile(0.5)) if len(ttft) else "-",
+                    "TTFT p95": int(ttft.quantile(0.95)) if len(ttft) else "-",
+                    "所要 p95(ms)": int(grp["wall_ms"].quantile(0.95)),
+                })
+            st.dataframe(pd.DataFrame(summary_rows), use_container_width=True, hide_index=True)
+
+        st.markdown("---")
+        st.markdown("#### 🚦 モデル別サーキットブレーカー")
+        # ★追加: モデルごとのサーキットブレーカー状態（全セッション共通）
+        breaker_rows = []
+        for snap in get_model_health_registry().snapshot(PRIORITY_MODELS):
+            state_label = {"closed": "🟢 正常", "half_open": "🟡 試験中", "open": "🔴 遮断中"}.get(snap["state"], snap["state"])
+            breaker_rows.append({
+                "モデル": snap["model"],
+                "状態": state_label,
+                "直近呼出": snap["calls"],
+                "失敗率": f"{snap['failure_rate'] * 100:.0f}%",
+                "p95(ms)": snap["p95_ms"] if snap["p95_ms"] is not None else "-",
+                "復帰まで(秒)": snap["retry_after_s"],
+            })
+        st.dataframe(pd.DataFrame(breaker_rows), use_container_width=True, hide_index=True)
+
+        st.markdown("---")
+        st.markdown("#### 📈 ランキング集計（ロールアップ）")
+        st.caption("ランキングは退室時に加算される集計ドキュメントから表示しています。導入前のログの取り込みやずれの修復には再構築してください。")
+        if st.button("🔄 今日/今週/今月の集計を study_logs から再構築", key="admin_rebuild_rollups"):
+            with st.spinner("再構築中..."):
+                try:
+                    scanned = rebuild_rollups(db)
+                    get_leaderboard_cache().invalidate()
+                    get_rank_index().rebuild()
+                    st.success(f"再構築しました（{scanned}件のログを集計）")
+                except Exception as e:
+                    st.error(f"再構築エラー: {e}")
+
         st.markdown("---")
         st.markdown("#### 🛠 デバッグログ")
         if st.session_state.debug_logs:
@@ -667,6 +971,7 @@ def render_admin_tools_page():
                                 "isAnonymousRanking": False,
                                 "role": "student"
                             })
+                            get_user_directory().upsert(new_uid, new_name_input, new_email)
                             st.success(f"アカウント作成成功！\n名前: {new_name_input}\nEmail: {new_email}")
                         except Exception as e:
                             st.error(f"データベース登録エラー: {e}")
@@ -680,7 +985,7 @@ def render_admin_tools_page():
                 st.error("APIキーが設定されていません")
             else:
                 try:
-                    genai.configure(api_key=GEMINI_API_KEY)
+                    ensure_genai_configured(genai, GEMINI_API_KEY)
                     models = genai.list_models()
                     available_models = []
                     for m in models:
@@ -700,15 +1005,29 @@ def render_admin_tools_page():
         st.caption("生徒の過去の学習記録（アーカイブ）および現在進行中の会話（History）を確認できます。")
         
         try:
-            # ユーザー一覧取得
-            all_users_stream = db.collection("users").stream()
-            user_options = {}
-            for doc in all_users_stream:
-                u_data = doc.to_dict()
-                u_name = u_data.get("name", "名称未設定")
-                u_email = u_data.get("email", "")
-                label = f"{u_name} ({u_email})"
-                user_options[label] = doc.id
+            # ★変更: users を毎回全件読まず、メモリ上の名簿を前方一致検索して1ページ分だけ表示
+            if "admin_user_search" not in st.session_state:
+                st.session_state.admin_user_search = ""
+                st.session_state.admin_user_cursors = [None] # 各ページの開始カーソル（戻る用）
+            search_query = st.text_input("名前・メールアドレスで検索（前方一致）", value=st.session_state.admin_user_search)
+            if search_query != st.session_state.admin_user_search:
+                st.session_state.admin_user_search = search_query
+                st.session_state.admin_user_cursors = [None]
+
+            page_rows, next_cursor = get_user_directory().search(search_query, st.session_state.admin_user_cursors[-1], limit=20)
+            user_options = {f"{row['name']} ({row['email']})": row["uid"] for row in page_rows}
+
+            col_prev, col_page, col_next = st.columns([1, 2, 1])
+            with col_prev:
+                if len(st.session_state.admin_user_cursors) > 1 and st.button("← 前へ", key="admin_user_prev"):
+                    st.session_state.admin_user_cursors.pop()
+                    st.rerun()
+            with col_page:
+                st.caption(f"{len(st.session_state.admin_user_cursors)}ページ目")
+            with col_next:
+                if next_cursor and st.button("次へ →", key="admin_user_next"):
+                    st.session_state.admin_user_cursors.append(next_cursor)
+                    st.rerun()
             
             if not user_options:
                 st.warning("ユーザーが見つかりません。")
@@ -730,9 +1049,10 @@ def render_admin_tools_page():
                         # --- 現在進行中のログ (History) ---
                         st.info("現在進行中（アーカイブ前）の直近の会話履歴を表示します。")
                         history_stream = target_ref.collection("history")\
-                                                   .order_by("timestamp")\
+                                                   .order_by("timestamp", direction=firestore.Query.DESCENDING)\
                                                    .limit(50).stream()
                         messages = [doc.to_dict() for doc in history_stream]
+                        messages.reverse()
                         
                         if not messages:
                             st.info("現在進行中の会話履歴はありません。")
@@ -748,39 +1068,9 @@ def render_admin_tools_page():
                                         st.markdown(content)
                     else:
                         # --- アーカイブ済みログ ---
-                        archives_stream = target_ref.collection("archived_sessions")\
-                                                .order_by("archived_at", direction=firestore.Query.DESCENDING)\
-                                                .limit(20).stream()
-                        
-                        archives_list = list(archives_stream)
-                        
-                        if not archives_list:
-                            st.info(f"{selected_user_label} さんのアーカイブはありません。")
-                        else:
-                            archive_opts = {}
-                            for a_doc in archives_list:
-                                a_data = a_doc.to_dict()
-                                ts = a_data.get("archived_at")
-                                date_str = ts.astimezone(JST).strftime('%m/%d %H:%M') if ts else "日時不明"
-                                title = a_data.get("title", "無題")
-                                a_label = f"{date_str} : {title}"
-                                archive_opts[a_label] = a_data.get("messages", [])
-                            
-                            selected_archive = st.selectbox("閲覧するアーカイブを選択", list(archive_opts.keys()))
-                            
-                            if selected_archive:
-                                st.success(f"表示中: {selected_archive}")
-                                messages = archive_opts[selected_archive]
-                                
-                                with st.container():
-                                    for msg in messages:
-                                        role = msg.get("role")
-                                        content = msg.get("content")
-                                        if isinstance(content, dict):
-                                                content = content.get("text", "")
-                                        
-                                        with st.chat_message(role):
-                                            st.markdown(content)
+                        # ★変更: 一覧はメタデータだけ、本文は選んだ1件だけ読む
+                        render_archive_browser(target_uid, f"admin_{target_uid}",
+                                               f"{selected_user_label} さんのアーカイブはありません。")
         except Exception as e:
             st.error(f"データ取得エラー: {e}")
 
@@ -822,13 +1112,9 @@ def render_admin_tools_page():
 def render_settings_page():
     st.title("⚙️ 設定")
     
-    # ユーザー情報の取得
+    # ユーザー情報の取得（★変更: セッション内のキャッシュから）
     try:
-        user_doc_obj = user_ref.get()
-        if user_doc_obj.exists:
-            user_doc = user_doc_obj.to_dict()
-        else:
-            user_doc = {}
+        user_doc = user_cache.profile()
     except Exception:
         user_doc = {}
 
@@ -840,8 +1126,11 @@ def render_settings_page():
     
     if st.button("名前を更新する", key="btn_update_name"):
         if new_name and new_name != current_name:
-            user_ref.update({"name": new_name})
+            user_cache.update_profile({"name": new_name})
+            get_user_directory().upsert(user_id, new_name)
             st.session_state.user_name = new_name
+            # 旧名入りのシステムプロンプトで作ったモデルはもう使わないので破棄
+            get_model_cache().evict_instruction(build_coach_system_instruction(student_name))
             st.success("名前を更新しました！")
             time.sleep(1)
             st.rerun()
@@ -859,7 +1148,7 @@ def render_settings_page():
     is_anon = st.checkbox("ランキングで匿名にする", value=st.session_state.is_anon_ranking)
     
     if is_anon != st.session_state.is_anon_ranking:
-        user_ref.update({"isAnonymousRanking": is_anon})
+        user_cache.update_profile({"isAnonymousRanking": is_anon})
         st.session_state.is_anon_ranking = is_anon
         st.success("匿名設定を更新しました")
 
@@ -897,24 +1186,33 @@ def render_portal_page():
     apply_portal_css()
     st.title(f"こんにちは、{student_name}さん！👋")
     
-    # 簡易サマリ
-    user_doc_obj = user_ref.get()
-    user_doc = user_doc_obj.to_dict()
+    # 簡易サマリ（★変更: セッション内のキャッシュから）
+    user_doc = user_cache.profile()
     total_minutes = user_doc.get("totalStudyMinutes", 0)
     total_hours = total_minutes // 60
     
     st.info(f"📚 **累計学習時間**: {total_hours}時間 {total_minutes % 60}分")
 
+    # ★追加: 今日/今週の自分の順位（メモリ上の順位インデックスから引くので Firestore の読み込みなし）
+    if st.session_state.user_role != "global_admin":
+        try:
+            rank_index = get_rank_index()
+            rank_labels = []
+            for period, label in (("day", "今日"), ("week", "今週")):
+                my_rank, my_minutes, ranked_users = rank_index.rank_of(period, user_id)
+                if my_rank:
+                    rank_labels.append(f"{label} **{my_rank}位** / {ranked_users}人 ({my_minutes}分)")
+            if rank_labels:
+                st.caption("🏆 " + "　".join(rank_labels))
+        except Exception as e:
+            print(f"Rank lookup error: {e}")
+
     # --- ★入退室（学習タイマー）ロジック ---
     if st.session_state.user_role != "global_admin":
-        active_logs = user_ref.collection("attendance_logs")\
-                            .where("status", "==", "active")\
-                            .limit(1).stream()
-        current_active_log = next(active_logs, None)
+        current_active_log = user_cache.active_attendance() # ★変更: 入室記録もキャッシュから
         
         if current_active_log:
-            data = current_active_log.to_dict()
-            entry_ts = data.get("entry_timestamp")
+            entry_ts = current_active_log.get("entry_timestamp")
             if entry_ts:
                 entry_dt = entry_ts.astimezone(JST)
                 now_dt = datetime.datetime.now(JST)
@@ -1016,47 +1314,121 @@ def render_study_log_page():
     except Exception as e:
         st.error(f"履歴の取得に失敗しました: {e}")
 
+# --- ★追加: アーカイブ閲覧（一覧はメタデータのみ・本文は開いた時だけ取得） ---
+@st.cache_data(max_entries=50, show_spinner=False)
+def fetch_archive_messages(uid, archive_id):
+    """アーカイブは保存後に変わらないので、開いた本文はキャッシュして使い回す"""
+    return load_archive_messages(db.collection("users").document(uid), archive_id)
+
+def render_archive_browser(uid, key_prefix, empty_message):
+    """uid のアーカイブを新しい順に20件ずつ一覧し、選んだ1件の会話を表示する"""
+    cursors_key = f"archive_cursors_{key_prefix}"
+    if cursors_key not in st.session_state:
+        st.session_state[cursors_key] = [None] # 各ページの開始カーソル（戻る用）
+
+    rows, next_cursor = list_archives(db.collection("users").document(uid), st.session_state[cursors_key][-1])
+    if not rows:
+        st.info(empty_message)
+        return
+
+    archive_options = {}
+    for row in rows:
+        ts = row["archived_at"]
+        date_str = ts.astimezone(JST).strftime('%m/%d %H:%M') if ts else "日時不明"
+        count_str = f" ({row['message_count']}件)" if row["message_count"] is not None else ""
+        archive_options[f"{date_str} : {row['title'] or '無題のセッション'}{count_str}"] = row["id"]
+
+    selected_label = st.selectbox("閲覧したい会話を選択", list(archive_options.keys()), key=f"archive_select_{key_prefix}")
+
+    col_prev, col_next = st.columns(2)
+    with col_prev:
+        if len(st.session_state[cursors_key]) > 1 and st.button("← 新しいアーカイブ", key=f"archive_prev_{key_prefix}"):
+            st.session_state[cursors_key].pop()
+            st.rerun()
+    with col_next:
+        if next_cursor and st.button("さらに古いアーカイブ →", key=f"archive_next_{key_prefix}"):
+            st.session_state[cursors_key].append(next_cursor)
+            st.rerun()
+
+    if selected_label:
+        st.markdown("---")
+        st.caption(f"閲覧中: {selected_label}")
+        render_archive_messages(fetch_archive_messages(uid, archive_options[selected_label]))
+
+def render_archive_messages(messages):
+    """アーカイブの会話を再現する"""
+    chat_container = st.container()
+    with chat_container:
+        for msg in messages:
+            role = msg.get("role")
+            content = msg.get("content")
+            if isinstance(content, dict):
+                    content = content.get("text", "")
+            
+            with st.chat_message(role):
+                st.markdown(content)
+
+def backfill_archive_search(uid, missing_ids):
+    """索引の無い（索引導入前の）アーカイブから検索索引を作る"""
+    user_doc_ref = db.collection("users").document(uid)
+    search_index = get_archive_search()
+    progress = st.progress(0.0, text="索引を作成中...")
+    for i, archive_id in enumerate(missing_ids):
+        header = user_doc_ref.collection("archived_sessions").document(archive_id).get(field_paths=["title", "archived_at"])
+        header_data = header.to_dict() or {}
+        segments = write_search_segments(db, user_doc_ref, archive_id, header_data.get("title"),
+                                         header_data.get("archived_at"), fetch_archive_messages(uid, archive_id))
+        search_index.add_segments(uid, segments)
+        progress.progress((i + 1) / len(missing_ids), text=f"索引を作成中... {i + 1}/{len(missing_ids)}")
+
+def render_archive_search(uid):
+    """★追加: アーカイブの全文検索（索引だけを引くのでアーカイブ本体は読まない）"""
+    query = st.text_input("🔎 過去の会話を検索", placeholder="例: 二次関数の最大最小", key="archive_search_query")
+    open_key = "archive_search_open"
+    if query:
+        results = get_archive_search().search(uid, query)
+        if not results:
+            st.info("見つかりませんでした。")
+        for result in results:
+            ts = result["archived_at"]
+            date_str = ts.astimezone(JST).strftime('%m/%d') if ts else "日時不明"
+            st.markdown(f"**{date_str} : {result['title'] or '無題のセッション'}**（{result['hits']}件ヒット）")
+            for role, snippet in result["snippets"]:
+                st.text(f"{'🧑' if role == 'user' else '🤖'} {snippet}")
+            if st.button("この会話を開く", key=f"archive_search_open_{result['archive_id']}"):
+                st.session_state[open_key] = result["archive_id"]
+
+    opened = st.session_state.get(open_key)
+    if opened:
+        st.markdown("---")
+        if st.button("✖ 検索結果の会話を閉じる", key="archive_search_close"):
+            st.session_state[open_key] = None
+            st.rerun()
+        render_archive_messages(fetch_archive_messages(uid, opened))
+
 def render_archive_page():
     """過去の復習（アーカイブ）を表示するページ（新規作成）"""
     st.title("🗄️ 過去の復習 (アーカイブ)")
     st.write("AIコーチとの過去の会話（アーカイブ）を閲覧できます。")
-    
-    archives_stream = user_ref.collection("archived_sessions")\
-                              .order_by("archived_at", direction=firestore.Query.DESCENDING)\
-                              .limit(20).stream()
-    
-    # アーカイブ選択用UI
-    archives = list(archives_stream)
-    if not archives:
-        st.info("アーカイブされた会話はありません。")
-    else:
-        archive_options = {}
-        for doc in archives:
-            d = doc.to_dict()
-            ts = d.get("archived_at")
-            date_str = ts.astimezone(JST).strftime('%m/%d %H:%M') if ts else "日時不明"
-            title = d.get("title", "無題のセッション")
-            label = f"{date_str} : {title}"
-            archive_options[label] = d.get("messages", [])
-        
-        selected_label = st.selectbox("閲覧したい会話を選択", list(archive_options.keys()))
-        
-        if selected_label:
-            st.markdown("---")
-            st.caption(f"閲覧中: {selected_label}")
-            messages = archive_options[selected_label]
-            
-            # チャットログ再現
-            chat_container = st.container()
-            with chat_container:
-                for msg in messages:
-                    role = msg.get("role")
-                    content = msg.get("content")
-                    if isinstance(content, dict):
-                            content = content.get("text", "")
-                    
-                    with st.chat_message(role):
-                        st.markdown(content)
+
+    try:
+        render_archive_search(user_id)
+        # 索引導入前のアーカイブは、ボタンで索引を作ってから検索に出る
+        if "archive_search_missing" not in st.session_state:
+            all_ids = [d.id for d in user_ref.collection("archived_sessions").select([]).stream()]
+            indexed = get_archive_search().indexed_archive_ids(user_id)
+            st.session_state.archive_search_missing = [a for a in all_ids if a not in indexed]
+        missing = st.session_state.archive_search_missing
+        if missing and st.button(f"🗂️ 以前のアーカイブ（{len(missing)}件）も検索できるようにする", key="archive_search_backfill"):
+            backfill_archive_search(user_id, missing)
+            st.session_state.archive_search_missing = []
+            st.rerun()
+    except Exception as e:
+        st.error(f"検索の準備に失敗しました: {e}")
+
+    st.markdown("---")
+    # ★変更: 一覧はメタデータだけ、本文は選んだ1件だけ読む
+    render_archive_browser(user_id, "mine", "アーカイブされた会話はありません。")
 
 def render_ranking_page():
     """ランキング画面 (修正版: 個人/チーム × 日/週/月 の計6パターン + 1位始まり)"""
@@ -1068,15 +1440,14 @@ def render_ranking_page():
         "👥 チーム(今日)", "👥 チーム(今週)", "👥 チーム(今月)"
     ])
     
-    top_users_stream = db.collection("users").order_by("totalStudyMinutes", direction=firestore.Query.DESCENDING).limit(50).stream()
-    all_users = list(top_users_stream)
-    
-    user_map = {}
-    for u in all_users:
-        user_map[u.id] = u.to_dict()
-
-    all_teams = list(db.collection("teams").limit(20).stream())
-    team_list = [{"id": t.id, **t.to_dict()} for t in all_teams]
+    # ★変更: 全閲覧者で共有するスナップショットから描画する（閲覧ごとの Firestore 読み込みなし）
+    try:
+        leaderboard = get_leaderboard_cache().get()
+        rank_index = get_rank_index()
+        rank_index.top("day", 1) # 未構築ならここでロールアップから作る
+    except Exception as e:
+        st.error(f"集計エラー: {e}")
+        return
 
     def get_anonymous_name(uid, original_name, is_anon_flag):
         if is_anon_flag:
@@ -1085,50 +1456,6 @@ def render_ranking_page():
             return "匿名ユーザー"
         return original_name
 
-    # --- 集計ロジック (期間指定でユーザーごとの学習時間を集計) ---
-    def get_aggregated_stats(period_type):
-        """
-        指定期間のログを集計し、{uid: total_minutes} の辞書を返す
-        period_type: 'day', 'week', 'month'
-        """
-        now_jst = datetime.datetime.now(JST)
-        start_dt = None
-
-        if period_type == 'day':
-            start_dt = now_jst.replace(hour=0, minute=0, second=0, microsecond=0)
-        elif period_type == 'week':
-            start_dt = (now_jst - datetime.timedelta(days=now_jst.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
-        elif period_type == 'month':
-            start_dt = now_jst.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        if not start_dt:
-            return {}
-
-        try:
-            query = db.collection_group("study_logs")\
-                      .where("timestamp", ">=", start_dt)\
-                      .select(["minutes"])\
-                      .limit(2000)
-            
-            docs = query.stream()
-            
-            stats = {}
-            for d in docs:
-                parent_ref = d.reference.parent.parent
-                if parent_ref:
-                    uid = parent_ref.id
-                    if uid in user_map or uid == user_id: # 自分は必ず含める
-                        minutes = d.to_dict().get("minutes", 0)
-                        stats[uid] = stats.get(uid, 0) + minutes
-            return stats
-
-        except Exception as e:
-            if "indexes?create_composite=" in str(e):
-                st.error("⚠️ 管理者設定が必要です：Firestoreインデックスを作成してください。")
-            else:
-                st.error(f"集計エラー: {e}")
-            return {}
-
     # --- ランキング表示用関数 ---
     def display_ranking_table(data_list, value_key="minutes"):
         """リストデータを受け取り、1位から順にテーブル表示"""
@@ -1139,9 +1466,13 @@ def render_ranking_page():
         sorted_data = sorted(data_list, key=lambda x: x[value_key], reverse=True)
         
         display_rows = []
+        rank = 0
         for i, item in enumerate(sorted_data):
+            # ★変更: 同じ時間は同順位（rank_index と同じ数え方）。順位が付いていればそれを使う
+            if i == 0 or item[value_key] != sorted_data[i - 1][value_key]:
+                rank = i + 1
             row = {
-                "順位": f"{i + 1}位", 
+                "順位": f"{item.get('rank', rank)}位", 
                 "名前": item["name"],
                 "時間(分)": item[value_key]
             }
@@ -1153,77 +1484,76 @@ def render_ranking_page():
         if not df.empty:
             st.table(df.set_index("順位"))
 
-    stats_day = get_aggregated_stats('day')
-    stats_week = get_aggregated_stats('week')
-    stats_month = get_aggregated_stats('month')
-
     # --- 個人ランキング生成 ---
-    def make_personal_list(stats):
-        result = []
-        for uid, mins in stats.items():
-            if uid in user_map:
-                info = user_map[uid]
-                disp_name = get_anonymous_name(uid, info.get("name", "名無し"), info.get("isAnonymousRanking", False))
-                result.append({"name": disp_name, "minutes": mins})
-            elif uid == user_id:
-                 disp_name = get_anonymous_name(uid, student_name, False) 
-                 result.append({"name": disp_name + " (あなた)", "minutes": mins})
-
-        return result
-
-    # --- チームランキング生成 ---
-    def make_team_list(stats):
-        result = []
-        for t in team_list:
-            team_id = t["id"]
-            members_in_team_doc = t.get("members", [])
-            valid_members_count = 0
-            team_total = 0
-            for m_uid in members_in_team_doc:
-                if m_uid in user_map:
-                    user_info = user_map[m_uid]
-                    if user_info.get("teamId") == team_id:
-                        team_total += stats.get(m_uid, 0)
-                        valid_members_count += 1
-            
-            if team_total > 0 or valid_members_count > 0:
-                result.append({"name": t.get("name", "No Name"), "minutes": team_total, "count": valid_members_count})
-        result = [r for r in result if r["minutes"] > 0]
-        return result
+    # ★変更: 累計トップ50に限らず、期間ごとの順位インデックスから上位を取る
+    RANKING_TOP_K = 50
+    profiles = leaderboard["profiles"]
+
+    def display_name(uid):
+        profile = profiles.get(uid)
+        if uid == user_id:
+            if profile and profile["anonymous"]:
+                return get_anonymous_name(uid, student_name, True)
+            return student_name + " (あなた)"
+        if profile is None:
+            return "ほかの生徒" # 名簿（上位の生徒）に入っていない前後の生徒
+        return get_anonymous_name(uid, profile["name"], profile["anonymous"])
+
+    def make_personal_list(period):
+        return [{"rank": rank, "name": display_name(uid), "minutes": mins}
+                for rank, uid, mins in rank_index.top(period, RANKING_TOP_K)]
+
+    def show_my_rank(period):
+        """自分の順位と前後の生徒（50位圏外でも表示）"""
+        my_rank, my_minutes, ranked_users = rank_index.rank_of(period, user_id)
+        if not my_rank:
+            st.caption("この期間の記録はまだありません")
+            return
+        st.markdown(f"**あなたの順位: {my_rank}位 / {ranked_users}人中（{my_minutes}分）**")
+        if my_rank > RANKING_TOP_K:
+            near_rows = [{"順位": f"{rank}位", "名前": display_name(uid), "時間(分)": mins}
+                         for rank, uid, mins in rank_index.neighbours(period, user_id)]
+            st.table(pd.DataFrame(near_rows).set_index("順位"))
+
+    def make_team_list(period):
+        return leaderboard["teams"][period]
 
     # --- タブへの描画 ---
     
     # 1. 個人 (今日)
     with tabs[0]:
         st.caption(f"集計期間: {datetime.datetime.now(JST).strftime('%Y/%m/%d')} (今日)")
-        display_ranking_table(make_personal_list(stats_day))
+        display_ranking_table(make_personal_list("day"))
+        show_my_rank("day")
 
     # 2. 個人 (今週)
     with tabs[1]:
         start_week = (datetime.datetime.now(JST) - datetime.timedelta(days=datetime.datetime.now(JST).weekday()))
         st.caption(f"集計期間: {start_week.strftime('%m/%d')} 〜")
-        display_ranking_table(make_personal_list(stats_week))
+        display_ranking_table(make_personal_list("week"))
+        show_my_rank("week")
 
     # 3. 個人 (今月)
     with tabs[2]:
         start_month = datetime.datetime.now(JST).replace(day=1)
         st.caption(f"集計期間: {start_month.strftime('%m/%d')} 〜")
-        display_ranking_table(make_personal_list(stats_month))
+        display_ranking_table(make_personal_list("month"))
+        show_my_rank("month")
 
     # 4. チーム (今日)
     with tabs[3]:
         st.caption("チームメンバーの今日の合計時間")
-        display_ranking_table(make_team_list(stats_day))
+        display_ranking_table(make_team_list("day"))
 
     # 5. チーム (今週)
     with tabs[4]:
         st.caption("チームメンバーの今週の合計時間")
-        display_ranking_table(make_team_list(stats_week))
+        display_ranking_table(make_team_list("week"))
 
     # 6. チーム (今月)
     with tabs[5]:
         st.caption("チームメンバーの今月の合計時間")
-        display_ranking_table(make_team_list(stats_month))
+        display_ranking_table(make_team_list("month"))
 
 def render_board_page():
     """掲示板画面 (返信機能付き)"""
@@ -1335,12 +1665,29 @@ def render_board_page():
 
             st.markdown("---")
 
+# ★追加: チームメンバーのプロフィールを1回の get_all でまとめて読む（チーム×メンバー構成ごとにキャッシュ）
+@st.cache_data(ttl=60, show_spinner=False)
+def load_team_members(team_id, member_ids):
+    """
+    member_ids は members 配列のタプル。参加・脱退で構成が変わるとキーが変わるので、自動的に読み直しになる。
+    学習時間の更新は ttl（60秒）で反映する。戻り値: [{"uid", "name", "total"}]（members の順）
+    """
+    if not member_ids:
+        return []
+    refs = [db.collection("users").document(m_uid) for m_uid in member_ids]
+    found = {}
+    for snap in db.get_all(refs, field_paths=["name", "totalStudyMinutes"]):
+        if snap.exists:
+            data = snap.to_dict()
+            found[snap.id] = {"uid": snap.id, "name": data.get("name", "名無し"), "total": data.get("totalStudyMinutes", 0)}
+    return [found[m_uid] for m_uid in member_ids if m_uid in found]
+
 def render_team_page():
     """チーム機能（旧バディ機能から刷新）"""
     st.title("👥 チーム機能")
     
     # ユーザーのチーム所属状況を確認
-    my_doc = user_ref.get().to_dict()
+    my_doc = user_cache.profile() # ★変更: セッション内のキャッシュから
     my_team_id = my_doc.get("teamId")
     
     if my_team_id:
@@ -1350,7 +1697,7 @@ def render_team_page():
         
         if not team_doc.exists:
             # チームが消滅している場合などの整合性処理
-            user_ref.update({"teamId": firestore.DELETE_FIELD})
+            user_cache.update_profile({"teamId": firestore.DELETE_FIELD})
             st.error("所属していたチームが見つかりません。")
             st.rerun()
             return
@@ -1364,22 +1711,18 @@ def render_team_page():
         members = team_data.get("members", [])
         
         if members:
-            # メンバー詳細取得
-            for m_uid in members:
-                m_doc = db.collection("users").document(m_uid).get()
-                if m_doc.exists:
-                    m_data = m_doc.to_dict()
-                    m_name = m_data.get("name", "名無し")
-                    m_total = m_data.get("totalStudyMinutes", 0)
-                    
-                    # 自分かどうか
-                    me_mark = " (あなた)" if m_uid == user_id else ""
-                    st.write(f"- **{m_name}**{me_mark} : 累計 {m_total}分")
+            # ★変更: メンバー詳細は1人ずつ get() せず、まとめて1往復で取得（キャッシュ付き）
+            for member in load_team_members(my_team_id, tuple(members)):
+                # 自分かどうか
+                me_mark = " (あなた)" if member["uid"] == user_id else ""
+                st.write(f"- **{member['name']}**{me_mark} : 累計 {member['total']}分")
         
         st.markdown("---")
         if st.button("🚪 チームから脱退する"):
-            team_ref.update({"members": firestore.ArrayRemove([user_id])})
-            user_ref.update({"teamId": firestore.DELETE_FIELD})
+            # ★変更: 脱退と、チームの期間合計から自分の分を引く処理を1つのトランザクションで行う
+            leave_team(db, user_id, my_team_id)
+            user_cache.apply_profile({"teamId": firestore.DELETE_FIELD})
+            get_leaderboard_cache().invalidate()
             st.success("脱退しました。")
             st.rerun()
 
@@ -1395,20 +1738,15 @@ def render_team_page():
                 submit_create = st.form_submit_button("作成して参加")
                 
                 if submit_create and t_name:
-                    t_code = str(uuid.uuid4())[:6].upper() # 簡易的
-                    
-                    new_team_ref = db.collection("teams").add({
-                        "name": t_name,
-                        "teamCode": t_code,
-                        "members": [user_id],
-                        "createdAt": firestore.SERVER_TIMESTAMP
-                    })
-                    new_team_id = new_team_ref[1].id
-                    
-                    user_ref.update({"teamId": new_team_id})
-                    
-                    st.success(f"チーム「{t_name}」を作成しました！")
-                    st.rerun()
+                    # ★変更: 招待コードの重複を確認し、チーム・コード索引・所属を1つのトランザクションで作成
+                    try:
+                        new_team_id, _ = create_team(db, user_id, t_name)
+                        user_cache.apply_profile({"teamId": new_team_id})
+                        get_leaderboard_cache().invalidate()
+                        st.success(f"チーム「{t_name}」を作成しました！")
+                        st.rerun()
+                    except TeamJoinError as e:
+                        st.error(str(e))
         
         with tab_join:
             with st.form("join_team_form"):
@@ -1417,58 +1755,385 @@ def render_team_page():
                 
                 if submit_join and input_code:
                     input_code = input_code.strip().upper()
-                    teams = db.collection("teams").where("teamCode", "==", input_code).stream()
-                    target_team = next(teams, None)
-                    
-                    if target_team:
-                        t_id = target_team.id
-                        t_data = target_team.to_dict()
-                        members = t_data.get("members", [])
-                        
-                        if user_id in members:
-                             st.warning("既に参加しています")
-                        else:
-                            db.collection("teams").document(t_id).update({
-                                "members": firestore.ArrayUnion([user_id])
-                            })
-                            user_ref.update({"teamId": t_id})
-                            st.success(f"チーム「{t_data.get('name')}」に参加しました！")
-                            st.rerun()
-                    else:
-                        st.error("チームが見つかりませんでした。コードを確認してください。")
-
-def render_chat_page():
-    """AIコーチ画面（既存ロジック）"""
-    apply_chat_css() # CSS適用
-    
-    st.title("🤖 AI数学コーチ")
-    st.caption("教科書の内容を「完璧」に理解しよう。答えは教えません、一緒に解きます。")
+                    # ★変更: teamCodes/{code} の直接 get + トランザクションで参加（同時参加でも所属がずれない）
+                    try:
+                        joined_team_id, joined_name = join_team(db, user_id, input_code)
+                        user_cache.apply_profile({"teamId": joined_team_id})
+                        get_leaderboard_cache().invalidate()
+                        st.success(f"チーム「{joined_name}」に参加しました！")
+                        st.rerun()
+                    except TeamJoinError as e:
+                        st.error(str(e))
+
+# --- ★追加: AIコーチのストリーミング応答 ---
+# ★アップロードファイルのモデル設定に戻す
+PRIORITY_MODELS = [
+    "gemini-3-flash-preview",
+    "gemini-2.0-flash-exp",
+    "gemini-1.5-flash",
+    "gemini-3-pro-preview",
+    "gemini-1.5-pro",
+]
+
+@st.cache_resource
+def get_model_health_registry():
+    """全セッション共通のモデル稼働状況レジストリ（プロセスに1つ）"""
+    return ModelHealthRegistry()
+
+@st.cache_resource
+def get_gemini_executor():
+    """ヘッジリクエストや画像の読み取りなど、Gemini呼び出しを裏で走らせるスレッドプール（プロセスに1つ）"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="gemini-worker")
+
+@st.cache_resource
+def get_image_cache():
+    """同じ問題の写真の読み取り結果を共有するキャッシュ（プロセスに1つ）"""
+    return ImageTranscriptionCache(max_distance=IMAGE_CACHE_MAX_DISTANCE)
+
+STREAM_INTERRUPTED_NOTE = "\n\n（※通信が途中で途切れたため、回答が途中までになっています）"
+
+def extract_chunk_text(chunk):
+    """ストリーミングのチャンクからテキストを取り出す（テキストを持たないチャンクは空文字）"""
+    try:
+        return chunk.text or ""
+    except ValueError:
+        # セーフティ停止などでpartsが空のチャンクは .text が例外になる
+        return ""
 
-    if not st.session_state.messages_loaded:
-        history_ref = user_ref.collection("history").order_by("timestamp").limit(50)
-        docs = history_ref.stream()
-        loaded_msgs = []
-        for doc in docs:
-            loaded_msgs.append(doc.to_dict())
-        st.session_state.messages = loaded_msgs
-        st.session_state.messages_loaded = True
+def stream_coach_reply(system_instruction, history_for_ai, inputs, response_placeholder):
+    """
+    PRIORITY_MODELS を順に試しながら stream=True で回答を受信し、placeholder を逐次更新する。
+    サーキットブレーカーが open のモデルは待たずに飛ばし、最初の健全なモデルから試す。
+    1文字でも受信した後にストリームが切れた場合は、再試行せずに途中までの回答を返す（partial=True）。
+    各試行は gemini_call_metrics に1件ずつ記録する。
+    戻り値: {"model", "text", "partial", "ttft_ms", "total_ms", "errors", "usage", ...}
+    """
+    registry = get_model_health_registry()
+    turn_start = time.perf_counter()
+    ai_text = ""
+    success_model = None
+    is_partial = False
+    ttft_ms = None
+    usage = usage_to_dict(None)
+    error_details = []
+
+    candidate_models = registry.healthy_models(PRIORITY_MODELS)
+
+    def models_to_try():
+        # half_open のモデルは試験枠を確保できた場合のみ送る
+        tried = False
+        for candidate in candidate_models:
+            if registry.allow_request(candidate):
+                tried = True
+                yield candidate
+        # ★変更: 試験枠がすべて埋まっていて1つも送れなかった場合は、全滅時と同じく先頭の候補を強制的に試す
+        if not tried and candidate_models:
+            yield candidate_models[0]
+
+    for model_name in models_to_try():
+        retry_count = 0
+        max_retries = 3
+        
+        while retry_count < max_retries:
+            ai_text = ""
+            attempt_start = time.perf_counter()
+            attempt_ttft_ms = None
+            try:
+                model = get_generative_model(model_name, system_instruction)
+                chat = model.start_chat(history=history_for_ai)
+                response = chat.send_message(inputs, stream=True)
+
+                for chunk in response:
+                    chunk_text = extract_chunk_text(chunk)
+                    if not chunk_text:
+                        continue
+                    if attempt_ttft_ms is None:
+                        attempt_ttft_ms = int((time.perf_counter() - attempt_start) * 1000)
+                    if ttft_ms is None:
+                        ttft_ms = int((time.perf_counter() - turn_start) * 1000)
+                    ai_text += chunk_text
+                    response_placeholder.markdown(ai_text + "▌")
+
+                if not ai_text:
+                    # ★追加: 安全フィルタでのブロックなど、1文字も返さずに終わった応答は失敗として再試行・次のモデルへ
+                    raise RuntimeError(f"空の応答 ({getattr(response, 'prompt_feedback', '') or 'テキストなし'})")
+                response_placeholder.markdown(ai_text)
+                attempt_ms = int((time.perf_counter() - attempt_start) * 1000)
+                usage = usage_to_dict(getattr(response, "usage_metadata", None))
+                registry.record_success(model_name, attempt_ttft_ms)
+                record_gemini_call(build_call_metric("chat", model_name, "success", attempt_ms, attempt_ttft_ms, retry_count, usage))
+                success_model = model_name
+                break 
+            except Exception as e:
+                attempt_ms = int((time.perf_counter() - attempt_start) * 1000)
+                log_message = f"[{datetime.datetime.now().strftime('%H:%M:%S')}] ⚠️ {model_name} エラー(Try {retry_count + 1}): {e}"
+                error_details.append(log_message)
+                st.session_state.debug_logs.append(log_message)
+                registry.record_failure(model_name, e, attempt_ms)
+                record_gemini_call(build_call_metric("chat", model_name, "partial" if ai_text else "error",
+                                                     attempt_ms, attempt_ttft_ms, retry_count, error=e))
+
+                if ai_text:
+                    # 途中まで表示済みの回答は捨てずに保存する（別モデルで再生成すると内容が食い違うため）
+                    response_placeholder.markdown(ai_text)
+                    success_model = model_name
+                    is_partial = True
+                    break
+
+                retry_count += 1
+                # ブレーカーが開いたモデルは待機・再試行せず、すぐ次のモデルへ
+                if not registry.is_available(model_name):
+                    break
+                wait_time = 2 ** retry_count
+                if retry_count < max_retries:
+                    time.sleep(wait_time)
+
+        if success_model:
+            break 
+
+    return {
+        "model": success_model,
+        "text": ai_text,
+        "partial": is_partial,
+        "ttft_ms": ttft_ms,
+        "total_ms": int((time.perf_counter() - turn_start) * 1000),
+        "errors": error_details,
+        "usage": usage,
+        "hedged": False,
+        "hedge_deadline_ms": None,
+    }
 
-    chat_log_container = st.container()
+def hedged_coach_reply(system_instruction, history_for_ai, inputs, response_placeholder):
+    """
+    ヘッジ（競争）モードの応答生成。
+    主モデルが締切（主モデルの最初の文字までの遅延 p95 由来）までに最初の文字を返さなければ、
+    次の健全なモデルにも同じリクエストをスレッドプールで投げ、先に文字を返した方を採用する。
+    負けた方は cancel_event で受信を打ち切り、結果は捨てる。
+    両方失敗した場合は通常の stream_coach_reply にフォールバックする。
+    """
+    registry = get_model_health_registry()
+    candidate_models = [m for m in registry.healthy_models(PRIORITY_MODELS) if registry.is_available(m)]
+    if len(candidate_models) < 2:
+        return stream_coach_reply(system_instruction, history_for_ai, inputs, response_placeholder)
+
+    executor = get_gemini_executor()
+    primary_model, hedge_model = candidate_models[0], candidate_models[1]
+    deadline_ms = hedge_deadline_ms(registry, primary_model, HEDGE_PERCENTILE,
+                                    HEDGE_MIN_DEADLINE_MS, HEDGE_MAX_DEADLINE_MS, HEDGE_DEFAULT_DEADLINE_MS)
+
+    turn_start = time.perf_counter()
+    events = queue.Queue()
+    cancel_events = {}
+    started_at = {}
+    failed = set()
+    error_details = []
+
+    def launch(model_name):
+        if not registry.allow_request(model_name):
+            failed.add(model_name)
+            return
+        cancel_events[model_name] = threading.Event()
+        started_at[model_name] = time.perf_counter()
+        model = get_generative_model(model_name, system_instruction)
+        executor.submit(run_stream_worker, model, history_for_ai, inputs, events, model_name, cancel_events[model_name])
+
+    launch(primary_model)
+    hedged = False
+    winner = None
+    winner_first_at = None
+    ai_text = ""
+    ttft_ms = None
+    is_partial = False
+    completed = False
+    usage = usage_to_dict(None)
+
+    while True:
+        elapsed_ms = (time.perf_counter() - turn_start) * 1000
+        if elapsed_ms > HEDGE_TIMEOUT_SECONDS * 1000:
+            error_details.append(f"[{datetime.datetime.now().strftime('%H:%M:%S')}] ⚠️ ヘッジ応答がタイムアウトしました")
+            break
+        if not hedged and winner is None and (elapsed_ms >= deadline_ms or primary_model in failed):
+            hedged = True
+            launch(hedge_model)
+        if winner is None and hedged and primary_model in failed and hedge_model in failed:
+            break
+
+        wait_s = 0.5 if hedged or winner else max(0.05, (deadline_ms - elapsed_ms) / 1000)
+        try:
+            tag, kind, payload, received_at = events.get(timeout=wait_s)
+        except queue.Empty:
+            continue
+
+        if winner is not None and tag != winner:
+            continue  # 負けた方の残りイベントは無視
+
+        if kind == "error":
+            log_message = f"[{datetime.datetime.now().strftime('%H:%M:%S')}] ⚠️ {tag} エラー(Hedge): {payload}"
+            error_details.append(log_message)
+            st.session_state.debug_logs.append(log_message)
+            attempt_ms = int((received_at - started_at[tag]) * 1000)
+            registry.record_failure(tag, payload, attempt_ms)
+            if winner is None:
+                # 採用済みモデルの途中切れはループ後に partial として1件だけ記録する
+                record_gemini_call(build_call_metric("chat", tag, "error", attempt_ms, error=payload, hedged=True))
+            failed.add(tag)
+            if winner is not None:
+                # 途中まで表示済みの回答は捨てずに保存する
+                is_partial = True
+                break
+            continue
+
+        if kind == "done":
+            if winner is None:
+                # 1文字も返さずに終わった応答は失敗扱い
+                attempt_ms = int((received_at - started_at[tag]) * 1000)
+                registry.record_failure(tag, "空の応答", attempt_ms)
+                record_gemini_call(build_call_metric("chat", tag, "error", attempt_ms, usage=payload,
+                                                     error="空の応答", hedged=True))
+                failed.add(tag)
+                continue
+            completed = True
+            usage = payload
+            break
+
+        # kind == "chunk"
+        if winner is None:
+            winner = tag
+            winner_first_at = received_at
+            ttft_ms = int((received_at - turn_start) * 1000)
+            registry.record_success(tag, int((received_at - started_at[tag]) * 1000))
+            for other, ev in cancel_events.items():
+                if other != winner:
+                    ev.set()
+        ai_text += payload
+        response_placeholder.markdown(ai_text + "▌")
+
+    # 負けた方（タイムアウト時は全て）の受信を打ち切る
+    for ev in cancel_events.values():
+        ev.set()
+    finished_at = time.perf_counter()
+    for other in cancel_events:
+        if other != winner and other not in failed:
+            # 競争に負けて打ち切った呼び出し（入力トークンは課金されうるが usage は取れない）
+            record_gemini_call(build_call_metric("chat", other, "cancelled", int((finished_at - started_at[other]) * 1000),
+                                                 hedged=True))
+    if winner is not None:
+        record_gemini_call(build_call_metric("chat", winner, "success" if completed else "partial",
+                                             int((finished_at - started_at[winner]) * 1000),
+                                             int((winner_first_at - started_at[winner]) * 1000),
+                                             usage=usage, hedged=hedged))
+
+    if winner is None:
+        # 競争した2モデルとも失敗 → 残りのモデルで通常の逐次フォールバック
+        fallback = stream_coach_reply(system_instruction, history_for_ai, inputs, response_placeholder)
+        fallback["errors"] = error_details + fallback["errors"]
+        fallback["hedged"] = hedged
+        fallback["hedge_deadline_ms"] = deadline_ms
+        return fallback
+
+    response_placeholder.markdown(ai_text)
+    return {
+        "model": winner,
+        "text": ai_text,
+        "partial": is_partial or not completed,
+        "ttft_ms": ttft_ms,
+        "total_ms": int((time.perf_counter() - turn_start) * 1000),
+        "errors": error_details,
+        "usage": usage,
+        "hedged": hedged,
+        "hedge_deadline_ms": deadline_ms,
+    }
 
-    with chat_log_container:
-        for msg in st.session_state.messages:
-            with st.chat_message(msg["role"]):
-                content = msg["content"]
-                if isinstance(content, dict):
-                    if "text" in content:
-                        st.markdown(content["text"])
-                else:
-                    st.markdown(content)
+# --- ★追加: 会話履歴の末尾ページ読み込み（新しい順カーソル） ---
+CHAT_PAGE_SIZE = 30 # 1回に読み込むメッセージ数
+CHAT_MAX_VISIBLE_MESSAGES = 120 # session_state に保持する最大メッセージ数
+
+def visible_history_query():
+    """会話履歴のクエリ（★追加: アーカイブ中＝history_floor 以前の発言は出さない）"""
+    history_col = user_ref.collection("history")
+    if st.session_state.history_floor is not None:
+        return history_col.where("timestamp", ">", st.session_state.history_floor)
+    return history_col
+
+def load_latest_history():
+    """最新の CHAT_PAGE_SIZE 件だけを読み込み、表示ウィンドウとカーソルを初期化する"""
+    history_col = visible_history_query()
+    docs = list(history_col.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(CHAT_PAGE_SIZE).stream())
+    docs.reverse()
+    st.session_state.messages = [doc.to_dict() for doc in docs]
+    st.session_state.history_cursor = st.session_state.messages[0].get("timestamp") if docs else None
+    st.session_state.history_has_more = len(docs) == CHAT_PAGE_SIZE
+
+    # 要約状態（会話の先頭から数えた件数）と突き合わせるため、ウィンドウより前の件数を数えておく
+    st.session_state.history_offset = 0
+    if st.session_state.history_has_more:
+        try:
+            total = history_col.count().get()[0][0].value
+            st.session_state.history_offset = max(0, int(total) - len(docs))
+        except Exception as e:
+            print(f"History count error: {e}")
 
-    # ★要件変更: システムプロンプトの高度化
-    system_instruction = f"""
+def load_older_history():
+    """カーソル（表示中の最古メッセージの時刻）より前の1ページを読み込んで先頭に足す"""
+    cursor = st.session_state.history_cursor
+    if cursor is None:
+        st.session_state.history_has_more = False
+        return
+    docs = list(visible_history_query()
+                .order_by("timestamp", direction=firestore.Query.DESCENDING)
+                .start_after({"timestamp": cursor})
+                .limit(CHAT_PAGE_SIZE).stream())
+    docs.reverse()
+    older = [doc.to_dict() for doc in docs]
+    st.session_state.messages = older + st.session_state.messages
+    st.session_state.history_offset = max(0, st.session_state.history_offset - len(older))
+    st.session_state.history_has_more = len(docs) == CHAT_PAGE_SIZE
+    if older:
+        st.session_state.history_cursor = older[0].get("timestamp")
+
+def trim_visible_messages():
+    """表示ウィンドウが上限を超えたら古い方から捨てる（捨てた分は「さらに前」から読み直せる）"""
+    overflow = len(st.session_state.messages) - CHAT_MAX_VISIBLE_MESSAGES
+    if overflow <= 0:
+        return
+    st.session_state.messages = st.session_state.messages[overflow:]
+    st.session_state.history_offset += overflow
+    st.session_state.history_cursor = st.session_state.messages[0].get("timestamp")
+    st.session_state.history_has_more = True
+
+def summarize_conversation(previous_summary, folded_messages):
+    """会話ウィンドウから押し出された発言を、前回の要約に追記する形で要約し直す"""
+    resp_summary = timed_generate_content("context_summary", "gemini-2.0-flash-exp",
+                                          build_summary_prompt(previous_summary, folded_messages))
+    summary_text = resp_summary.text.strip() if resp_summary and resp_summary.text else ""
+    if not summary_text:
+        raise ValueError("要約が空でした")
+    return summary_text
+
+def render_similar_hits(hits):
+    """★追加: 「前に似た問題を解いています」の表示"""
+    for hit in hits or []:
+        ts = hit["archived_at"]
+        date_str = ts.astimezone(JST).strftime('%m/%d') if ts else "以前"
+        st.caption(f"💡 {date_str} にも似た問題を解いています:「{hit['question'][:60]}」"
+                   f"（過去の復習の「{hit['title'] or '無題のセッション'}」）")
+
+def build_similar_context(hits):
+    """似た過去のやり取りを、AIへの入力に添える短い参考情報にする"""
+    lines = ["", "", "【参考: この生徒が以前に解いた似た問題（説明をやり直さず、思い出させる形で活用してください）】"]
+    for hit in hits:
+        ts = hit["archived_at"]
+        date_str = ts.astimezone(JST).strftime('%m/%d') if ts else "以前"
+        lines.append(f"- {date_str} の質問: {hit['question']}")
+        if hit["answer"]:
+            lines.append(f"  そのときのコーチの返答（冒頭）: {hit['answer']}")
+    return "\n".join(lines)
+
+def build_coach_system_instruction(name):
+    """AIコーチのシステムプロンプト（生徒の名前入り）。GenerativeModelキャッシュのキーにもなる"""
+    return f"""
     あなたは世界一の「ソクラテス式数学コーチ」です。
-    生徒の名前は「{student_name}」さんです。
+    生徒の名前は「{name}」さんです。
 
     【重要な追加指示：画像入力について】
     生徒から画像（数式や問題文）が送られた場合：
@@ -1497,6 +2162,57 @@ def render_chat_page():
     ※もし生徒が「A: 今日はこれで終わる」を選んだ場合は、「サイドバーの『会話履歴を全削除』ボタンを押して、今日の学習記録をアーカイブ（保存）してください」と誘導してください。
     """
 
+def render_chat_page():
+    """AIコーチ画面（既存ロジック）"""
+    apply_chat_css() # CSS適用
+    
+    st.title("🤖 AI数学コーチ")
+    st.caption("教科書の内容を「完璧」に理解しよう。答えは教えません、一緒に解きます。")
+
+    if not st.session_state.messages_loaded:
+        get_write_queue().flush() # 直前のセッションの未保存分を反映してから読む
+        track_archive_jobs(user_id) # ★追加: 未完了のアーカイブがあれば、その分の履歴は読まない
+        # ★変更: 古い50件ではなく、最新の1ページ分だけを新しい順のカーソルで読む
+        load_latest_history()
+        # 要約状態（畳み込み済みの古い発言の要約）も一緒に読み込む
+        try:
+            ctx_doc = user_ref.collection("chat_context").document("current").get()
+            if ctx_doc.exists:
+                ctx_data = ctx_doc.to_dict()
+                st.session_state.chat_context = {
+                    "summary": ctx_data.get("summary", ""),
+                    "summarized_count": ctx_data.get("summarized_count", 0),
+                }
+            else:
+                st.session_state.chat_context = new_context_state()
+        except Exception:
+            st.session_state.chat_context = new_context_state()
+        st.session_state.messages_loaded = True
+        # ★追加: 似た問題の検索用の索引を裏で読み込んでおく（最初の質問の応答を待たせない）
+        get_similar_problems().warm(user_id)
+
+    # ★追加: さらに古い会話はボタンで1ページずつ読み込む
+    if st.session_state.history_has_more:
+        if st.button("⬆️ さらに前の会話を読み込む", key="chat_load_older"):
+            load_older_history()
+            st.rerun()
+
+    chat_log_container = st.container()
+
+    with chat_log_container:
+        for msg in st.session_state.messages:
+            with st.chat_message(msg["role"]):
+                content = msg["content"]
+                if isinstance(content, dict):
+                    if "text" in content:
+                        st.markdown(content["text"])
+                else:
+                    st.markdown(content)
+                render_similar_hits(msg.get("similar"))
+
+    # ★要件変更: システムプロンプトの高度化（★変更: モデルキャッシュのキーにするため関数化）
+    system_instruction = build_coach_system_instruction(student_name)
+
     with st.form(key="chat_form", clear_on_submit=True):
         col1, col2, col3 = st.columns([0.8, 5, 1], gap="small")
         with col1:
@@ -1514,25 +2230,49 @@ def render_chat_page():
                 st.warning("Gemini APIキーが設定されていません。")
             else:
                 upload_img_obj = None
+                upload_img_blob = None
+                image_stats = None
+                image_hash = None
+                cached_transcription = None
                 user_msg_content = user_prompt
                 if uploaded_file:
                     try:
-                        upload_img_obj = Image.open(uploaded_file)
+                        # ★変更: 向き補正・縮小・モノクロ補正・JPEG再エンコードしてから送る
+                        upload_img_obj, upload_img_blob, image_stats = preprocess_image(uploaded_file)
+                        # ★追加: 以前に読み取った写真とほぼ同じ（dHash・pHash とも距離2以内）なら、画像の代わりに読み取り済みテキストを送る
+                        image_hash = image_fingerprint(upload_img_obj, upload_img_blob["data"])
+                        cache_entry = get_image_cache().lookup(image_hash)
+                        if cache_entry and cache_entry["transcription"]:
+                            cached_transcription = cache_entry["transcription"]
+                        image_stats["cache"] = "hit" if cached_transcription else "miss"
                         user_msg_content += "\n\n(※画像を送信しました)"
                     except Exception:
                         st.error("画像エラー")
 
-                st.session_state.messages.append({"role": "user", "content": user_msg_content})
+                # ★追加: 自分の過去のアーカイブから似た問題を探す（メモリ上の索引だけを使う）
+                similar_hits = []
+                if user_prompt:
+                    try:
+                        similar_hits = get_similar_problems().find_similar(user_id, user_prompt)
+                    except Exception as e:
+                        print(f"Similar problem lookup error: {e}")
+
+                user_msg_ts = client_timestamp()
+                # similar は画面表示用（Firestore には保存しない）
+                st.session_state.messages.append({"role": "user", "content": user_msg_content, "timestamp": user_msg_ts,
+                                                  "similar": similar_hits})
                 
-                user_ref.collection("history").add({
+                # ★変更: 保存はキューに積むだけにして、Firestoreの往復を応答待ちから外す
+                write_queue = get_write_queue()
+                write_queue.enqueue_add(user_ref.collection("history"), {
                     "role": "user",
                     "content": user_msg_content,
-                    "timestamp": firestore.SERVER_TIMESTAMP
+                    "timestamp": user_msg_ts
                 })
-                user_ref.collection("full_conversation_logs").add({
+                write_queue.enqueue_add(user_ref.collection("full_conversation_logs"), {
                     "role": "user",
                     "content": user_msg_content,
-                    "timestamp": firestore.SERVER_TIMESTAMP,
+                    "timestamp": client_timestamp(),
                     "log_type": "sequential"
                 })
 
@@ -1541,92 +2281,108 @@ def render_chat_page():
                         st.markdown(user_msg_content)
                         if upload_img_obj:
                             st.image(upload_img_obj, width=200)
+                        render_similar_hits(similar_hits)
+
+                    with st.chat_message("model"):
+                        notice_placeholder = st.empty()
+                        response_placeholder = st.empty()
+                        response_placeholder.markdown("AIコーチが思考中...")
+
+                        # ★変更: 件数ではなくトークン予算で履歴を切り、はみ出した分は要約に畳み込む
+                        history_for_ai, new_context, folded_count = build_windowed_history(
+                            st.session_state.messages[:-1],
+                            system_instruction,
+                            st.session_state.chat_context,
+                            summarize_conversation,
+                            budget_tokens=CHAT_CONTEXT_TOKEN_BUDGET,
+                            message_offset=st.session_state.history_offset,
+                        )
+                        if folded_count:
+                            st.session_state.chat_context = new_context
+                            write_queue.enqueue_set(user_ref.collection("chat_context").document("current"), {
+                                "summary": new_context["summary"],
+                                "summarized_count": new_context["summarized_count"],
+                                "updated_at": firestore.SERVER_TIMESTAMP
+                            })
+
+                        inputs = [user_prompt]
+                        if cached_transcription:
+                            inputs = [f"{user_prompt}\n\n【送信された画像の内容（読み取り済み）】\n{cached_transcription}"]
+                        elif upload_img_blob:
+                            inputs.append(upload_img_blob)
+                        if similar_hits and SIMILAR_CONTEXT_ENABLED:
+                            inputs[0] = inputs[0] + build_similar_context(similar_hits)
+
+                        if HEDGING_ENABLED:
+                            result = hedged_coach_reply(system_instruction, history_for_ai, inputs, response_placeholder)
+                        else:
+                            result = stream_coach_reply(system_instruction, history_for_ai, inputs, response_placeholder)
+                        success_model = result["model"]
+                        ai_text = result["text"]
 
-                    with st.spinner("AIコーチが思考中..."):
-                        genai.configure(api_key=GEMINI_API_KEY)
-                        history_for_ai = []
-                        MAX_HISTORY_MESSAGES = 20
-                        limited_messages = st.session_state.messages[:-1][-MAX_HISTORY_MESSAGES:]
-                        
-                        for m in limited_messages: 
-                            content_str = ""
-                            if isinstance(m["content"], dict):
-                                content_str = m["content"].get("text", str(m["content"]))
-                            else:
-                                content_str = str(m["content"])
-                            history_for_ai.append({"role": m["role"], "parts": [content_str]})
-
-                        # ★アップロードファイルのモデル設定に戻す
-                        PRIORITY_MODELS = [
-                            "gemini-3-flash-preview",
-                            "gemini-2.0-flash-exp",
-                            "gemini-1.5-flash",
-                            "gemini-3-pro-preview",
-                            "gemini-1.5-pro",
-                        ]
-                        
-                        ai_text = ""
-                        success_model = None
-                        error_details = []
-                        
-                        for model_name in PRIORITY_MODELS:
-                            retry_count = 0
-                            max_retries = 3
-                            
-                            while retry_count < max_retries:
-                                try:
-                                    model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
-                                    chat = model.start_chat(history=history_for_ai)
-                                    inputs = [user_prompt]
-                                    if upload_img_obj:
-                                        inputs.append(upload_img_obj)
-                                    
-                                    response = chat.send_message(inputs)
-                                    ai_text = response.text
-                                    success_model = model_name
-                                    break 
-                                except Exception as e:
-                                    retry_count += 1
-                                    wait_time = 2 ** retry_count
-                                    log_message = f"[{datetime.datetime.now().strftime('%H:%M:%S')}] ⚠️ {model_name} エラー(Try {retry_count}): {e}"
-                                    error_details.append(log_message)
-                                    st.session_state.debug_logs.append(log_message)
-                                    if retry_count < max_retries:
-                                        time.sleep(wait_time)
-                                    else:
-                                        pass
-
-                            if success_model:
-                                break 
-                    
                         if success_model:
                             st.session_state.last_used_model = success_model
+                            st.session_state.last_ttft_ms = result["ttft_ms"]
+
+                            if image_hash is not None and not cached_transcription:
+                                # 次回以降のために、画像の文字起こしを裏で作っておく
+                                image_cache = get_image_cache()
+                                if image_cache.claim_transcription(image_hash):
+                                    # ワーカースレッドでは session_state を読めないので、記録先をここで確定させておく
+                                    metric_uid = st.session_state.user_info["uid"]
+                                    def on_transcribed(resp, error, wall_ms):
+                                        record_gemini_call(build_call_metric(
+                                            "image_transcription", "gemini-2.0-flash-exp", "error" if error else "success",
+                                            wall_ms, ttft_ms=wall_ms, error=error,
+                                            usage=usage_to_dict(getattr(resp, "usage_metadata", None)),
+                                        ), uid=metric_uid, write_queue=write_queue)
+                                    get_gemini_executor().submit(
+                                        transcribe_image_job, image_cache, image_hash,
+                                        get_generative_model("gemini-2.0-flash-exp"), upload_img_blob, on_transcribed
+                                    )
+
+                            if image_stats:
+                                image_stats["first_token_ms"] = result["ttft_ms"]
+                                st.session_state.debug_logs.append(
+                                    f"[{datetime.datetime.now().strftime('%H:%M:%S')}] {format_image_stats(image_stats)}"
+                                )
+
+                            if result["partial"]:
+                                ai_text += STREAM_INTERRUPTED_NOTE
+                                response_placeholder.markdown(ai_text)
 
                             if success_model != PRIORITY_MODELS[0]:
-                                with st.chat_message("assistant"):
-                                        st.warning(f"Note: 最新モデル ({PRIORITY_MODELS[0]}) が利用できなかったため、{success_model} を使用しました。")
+                                notice_placeholder.warning(f"Note: 最新モデル ({PRIORITY_MODELS[0]}) が利用できなかったため、{success_model} を使用しました。")
 
-                            st.session_state.messages.append({"role": "model", "content": ai_text})
+                            model_msg_ts = client_timestamp()
+                            st.session_state.messages.append({"role": "model", "content": ai_text, "timestamp": model_msg_ts})
+                            trim_visible_messages()
                             
-                            user_ref.collection("history").add({
+                            write_queue.enqueue_add(user_ref.collection("history"), {
                                 "role": "model",
                                 "content": ai_text,
-                                "timestamp": firestore.SERVER_TIMESTAMP
+                                "timestamp": model_msg_ts
                             })
-                            user_ref.collection("full_conversation_logs").add({
+                            write_queue.enqueue_add(user_ref.collection("full_conversation_logs"), {
                                 "role": "model",
                                 "content": ai_text,
-                                "timestamp": firestore.SERVER_TIMESTAMP,
+                                "timestamp": client_timestamp(),
                                 "log_type": "sequential",
-                                "model": success_model
+                                "model": success_model,
+                                "ttft_ms": result["ttft_ms"],
+                                "total_ms": result["total_ms"],
+                                "partial": result["partial"],
+                                "hedged": result["hedged"],
+                                "hedge_deadline_ms": result["hedge_deadline_ms"],
+                                "usage": result["usage"],
+                                "image_stats": image_stats
                             })
                             
-                            with st.chat_message("model"):
-                                st.markdown(ai_text)
                             time.sleep(0.1) 
                             st.rerun()
                         else:
-                            st.error(f"❌ エラーが発生しました。\n詳細: {error_details}")
+                            response_placeholder.empty()
+                            st.error(f"❌ エラーが発生しました。\n詳細: {result['errors']}")
 
 # =========================================================
 # 8. メイン画面ルーティング
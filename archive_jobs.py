@@ -0,0 +1,311 @@
+"""
+「会話履歴を全削除」のアーカイブ処理をバックグラウンドで行うジョブ。
+
+ボタンを押した時点では archive_jobs/{job_id} にジョブを1件書いて実行キューに積むだけで、
+画面は待たずに会話をリセットする（楽観的リセット）。ジョブは
+  collecting（履歴の読み込み）→ titling（タイトル生成）→ archiving（圧縮チャンク保存）→ deleting（履歴の削除）→ done
+の順に進み、段階と進捗をジョブのドキュメントに書くので、再実行や別のセッションからも状況が見える。
+
+- 対象は「押した時刻（cutoff）以前の履歴」だけ。リセット後に続けた会話は消さない
+- アーカイブのIDとタイトルはジョブに記録しておくので、途中で失敗して再試行しても2件にならず、Gemini も呼び直さない
+- 失敗したら指数バックオフで max_attempts 回まで再試行し、それでも駄目なら failed（retry() でやり直せる）
+- heartbeat_at が lease_seconds より古い queued/running のジョブは、プロセスが落ちたものとみなして拾い直す。
+  拾い直す前にトランザクションで状態と heartbeat を確かめて owner を自分に書き換える（2つのプロセスが同じジョブを走らせない）
+"""
+import datetime
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import firestore
+
+from archive_store import ARCHIVE_COLLECTION, write_chunked_archive
+from firestore_writer import bulk_delete
+
+JOB_COLLECTION = "archive_jobs"
+ACTIVE_STATUSES = ["queued", "running"]
+# 学習者の画面に出すジョブ（done は自分のセッションで追っているものだけ見せる）
+VISIBLE_STATUSES = ["queued", "running", "failed"]
+STAGE_LABELS = {
+    "queued": "順番待ち",
+    "collecting": "会話履歴を読み込み中",
+    "titling": "タイトルを作成中",
+    "archiving": "アーカイブを保存中",
+    "deleting": "元の履歴を削除中",
+    "done": "完了",
+}
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class ArchiveJobRunner:
+    """
+    プロセスに1つのアーカイブ・ジョブ実行器。
+    title_fn(uid, transcript) はタイトル文字列（作れなければ None）を返す関数。Streamlit には触らないこと。
+    on_archived(uid, archive_id, title, messages) はアーカイブを書いた直後に呼ぶ関数（検索索引の作成など。失敗してもジョブは続ける）。
+    """
+
+    def __init__(self, db, title_fn, chunk_bytes, write_queue=None, on_archived=None, max_workers=2,
+                 max_attempts=4, lease_seconds=120, page_size=500, delete_deadline_seconds=90):
+        self.db = db
+        self.title_fn = title_fn
+        self.chunk_bytes = chunk_bytes
+        self.write_queue = write_queue
+        self.on_archived = on_archived
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.page_size = page_size
+        self.delete_deadline_seconds = delete_deadline_seconds  # 1回の試行で削除に使う上限秒数（残りは次の試行で消す）
+        self.worker_id = uuid.uuid4().hex  # このプロセスの実行器の ID（ジョブの owner に書く）
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="archive-job")
+        self._lock = threading.Lock()
+        self._running = set()
+        self._progress = {}  # job_id -> このプロセスで実行中のジョブの最新状態（読み込みなしで画面に出す用）
+
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.recovered = 0
+        self.last_job_ms = None
+        self.last_delete_stats = None
+
+    def _job_ref(self, job_id):
+        return self.db.collection(JOB_COLLECTION).document(job_id)
+
+    # --- 投入 ---
+    def submit(self, uid, cutoff, note):
+        """ジョブを記録して実行キューに積む（すぐ返る）。戻り値: job_id"""
+        user_ref = self.db.collection("users").document(uid)
+        job_ref = self.db.collection(JOB_COLLECTION).document()
+        job = {
+            "uid": uid,
+            "status": "queued",
+            "stage": "queued",
+            "progress": 0.0,
+            "cutoff": cutoff,
+            "note": note,
+            "archive_id": user_ref.collection(ARCHIVE_COLLECTION).document().id,
+            "attempts": 0,
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "heartbeat_at": _now(),
+            "owner": self.worker_id,
+        }
+        job_ref.set(job)
+        self._set_progress(job_ref.id, {"uid": uid, "status": "queued", "stage": "queued", "progress": 0.0, "cutoff": cutoff})
+        self._start(job_ref.id)
+        return job_ref.id
+
+    def retry(self, job_id):
+        """failed になったジョブをやり直す"""
+        self._job_ref(job_id).update({"status": "queued", "attempts": 0, "error": firestore.DELETE_FIELD,
+                                      "heartbeat_at": _now(), "owner": self.worker_id})
+        self._start(job_id)
+
+    def _start(self, job_id):
+        with self._lock:
+            if job_id in self._running:
+                return
+            self._running.add(job_id)
+        self._executor.submit(self._run, job_id)
+
+    # --- 状況の参照 ---
+    def _set_progress(self, job_id, data):
+        with self._lock:
+            self._progress[job_id] = {**self._progress.get(job_id, {}), **data, "id": job_id}
+
+    def _local_status(self, job_id):
+        with self._lock:
+            local = self._progress.get(job_id)
+            return dict(local) if local is not None else None
+
+    def status(self, job_id):
+        """ジョブの状況。このプロセスで実行中なら Firestore を読まずに返す。無ければ None"""
+        local = self._local_status(job_id)
+        if local is not None:
+            return local
+        snap = self._job_ref(job_id).get()
+        if not snap.exists:
+            return None
+        return {**snap.to_dict(), "id": job_id}
+
+    def jobs_for_user(self, uid):
+        """
+        学習者の未完了（queued/running/failed）のジョブ。止まったまま（heartbeat が古い）のものは拾い直す。
+        uid の等価条件 + status の in だけなので単一フィールドのインデックスで足りる。
+        """
+        docs = self.db.collection(JOB_COLLECTION)\
+                      .where("uid", "==", uid)\
+                      .where("status", "in", VISIBLE_STATUSES).stream()
+        jobs = []
+        for doc in docs:
+            job = {**doc.to_dict(), "id": doc.id}
+            if self._is_stale(job) and self._claim(doc.id):
+                with self._lock:
+                    self.recovered += 1
+                self._start(doc.id)
+            jobs.append(self._local_status(doc.id) or job)
+        jobs.sort(key=lambda j: j.get("cutoff") or _now())
+        return jobs
+
+    def _is_stale(self, job):
+        if job.get("status") not in ACTIVE_STATUSES:
+            return False
+        with self._lock:
+            if job["id"] in self._running:
+                return False
+        return self._lease_expired(job)
+
+    def _lease_expired(self, job):
+        heartbeat = job.get("heartbeat_at")
+        return heartbeat is None or (_now() - heartbeat).total_seconds() > self.lease_seconds
+
+    def _claim(self, job_id):
+        """止まったジョブを自分のものにする。トランザクションで状態と heartbeat を確かめてから owner を書き換える"""
+        job_ref = self._job_ref(job_id)
+
+        @firestore.transactional
+        def _claim_in(transaction):
+            snap = job_ref.get(transaction=transaction)
+            if not snap.exists:
+                return False
+            job = snap.to_dict()
+            if job.get("status") not in ACTIVE_STATUSES or not self._lease_expired(job):
+                return False  # 他のプロセスが先に拾った・動いている
+            transaction.update(job_ref, {"owner": self.worker_id, "heartbeat_at": _now()})
+            return True
+
+        try:
+            return _claim_in(self.db.transaction())
+        except Exception as e:
+            print(f"Archive job {job_id} could not be claimed: {e}")
+            return False
+
+    # --- 実行 ---
+    def _update(self, job_ref, data):
+        """ジョブのドキュメントとプロセス内の状況を同時に更新（heartbeat も進める）"""
+        data = {**data, "heartbeat_at": _now()}
+        self._set_progress(job_ref.id, data)
+        job_ref.update(data)
+
+    def _run(self, job_id):
+        job_ref = self._job_ref(job_id)
+        started = time.perf_counter()
+        try:
+            while True:
+                snap = job_ref.get()
+                if not snap.exists:
+                    return
+                job = snap.to_dict()
+                if job.get("status") == "done":
+                    return
+                if job.get("owner") not in (None, self.worker_id):
+                    return  # 止まっている間に他のプロセスが拾い直した
+                attempts = job.get("attempts", 0) + 1
+                try:
+                    self._update(job_ref, {"status": "running", "attempts": attempts})
+                    self._execute(job_ref, job)
+                    with self._lock:
+                        self.completed += 1
+                        self.last_job_ms = int((time.perf_counter() - started) * 1000)
+                    return
+                except Exception as e:
+                    print(f"Archive job {job_id} failed (try {attempts}): {e}")
+                    if attempts >= self.max_attempts:
+                        with self._lock:
+                            self.failed += 1
+                        self._update(job_ref, {"status": "failed", "error": str(e)[:300]})
+                        return
+                    with self._lock:
+                        self.retries += 1
+                    self._update(job_ref, {"status": "queued", "error": str(e)[:300]})
+                    time.sleep(min(2 ** attempts, 30))
+        except Exception as e:
+            print(f"Archive job {job_id} could not update its record: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+                self._progress.pop(job_id, None)
+
+    def _execute(self, job_ref, job):
+        uid = job["uid"]
+        user_ref = self.db.collection("users").document(uid)
+        header_ref = user_ref.collection(ARCHIVE_COLLECTION).document(job["archive_id"])
+        if self.write_queue is not None:
+            self.write_queue.flush()  # 押す直前までの会話がまだキューにあれば先に反映する
+
+        # 1. cutoff 以前の履歴を読む（リセット後に続けた会話は対象外）
+        self._update(job_ref, {"stage": "collecting", "progress": 0.05})
+        messages, refs = [], []
+        query = user_ref.collection("history").where("timestamp", "<=", job["cutoff"]).order_by("timestamp")
+        last_doc = None
+        while True:
+            page_query = query.start_after(last_doc) if last_doc else query
+            docs = list(page_query.limit(self.page_size).stream())
+            for doc in docs:
+                messages.append(doc.to_dict())
+                refs.append(doc.reference)
+            if len(docs) < self.page_size:
+                break
+            last_doc = docs[-1]
+
+        # 再試行で、前回アーカイブを書き終えてから削除の途中で落ちた場合は書き直さない
+        already_archived = header_ref.get(field_paths=["format"]).exists
+        if messages and not already_archived:
+            # 2. タイトル（前回作ったものがあれば使い回す）
+            title = job.get("title")
+            if not title:
+                self._update(job_ref, {"stage": "titling", "progress": 0.15, "message_count": len(messages)})
+                transcript = "".join(f"{m.get('role', '')}: {m.get('content', '')}\n" for m in messages)
+                try:
+                    title = self.title_fn(uid, transcript)
+                except Exception as e:
+                    print(f"Archive title generation failed: {e}")
+                title = title or job["cutoff"].astimezone(datetime.timezone(datetime.timedelta(hours=9))).strftime('%Y/%m/%d の学習')
+                self._update(job_ref, {"title": title})
+
+            # 3. アーカイブ保存（同じIDに書くので再試行しても1件）
+            self._update(job_ref, {"stage": "archiving", "progress": 0.3})
+            write_chunked_archive(self.db, user_ref, title, messages, job.get("note", ""),
+                                  self.chunk_bytes, archive_id=job["archive_id"])
+            if self.on_archived is not None:
+                try:
+                    self.on_archived(uid, job["archive_id"], title, messages)
+                except Exception as e:
+                    print(f"Archive post-processing failed: {e}")
+
+        # 4. 元の履歴を削除（アーカイブが保存できた後だけ）。BulkWriter で並列に消す
+        self._update(job_ref, {"stage": "deleting", "progress": 0.6, "delete_total": len(refs)})
+
+        def on_progress(deleted):
+            self._update(job_ref, {"progress": 0.6 + 0.4 * deleted / max(1, len(refs)), "deleted": deleted})
+
+        delete_stats = bulk_delete(self.db, refs, deadline_seconds=self.delete_deadline_seconds, on_progress=on_progress)
+        with self._lock:
+            self.last_delete_stats = delete_stats
+        self._update(job_ref, {"delete_stats": delete_stats})
+        if not delete_stats["complete"]:
+            # 残りは次の試行で読み直して消す（アーカイブは書き済みなので作り直さない）
+            raise RuntimeError(f"履歴の削除が終わりませんでした（{delete_stats['deleted']}/{len(refs)}件）")
+
+        self._update(job_ref, {
+            "status": "done",
+            "stage": "done",
+            "progress": 1.0,
+            "archived": bool(messages),
+            "finished_at": firestore.SERVER_TIMESTAMP,
+        })
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": len(self._running),
+                "completed": self.completed,
+                "failed": self.failed,
+                "retries": self.retries,
+                "recovered": self.recovered,
+                "last_job_ms": self.last_job_ms,
+                "last_delete_stats": self.last_delete_stats,
+            }
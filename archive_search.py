@@ -0,0 +1,325 @@
+"""
+アーカイブの全文検索（文字 n-gram の転置インデックス）。
+
+形態素解析を使わず、正規化（NFKC・空白の詰め）した本文を文字バイグラムに分けて索引にする。
+日本語でも LaTeX でも区切りを気にせず部分一致で引ける（1文字の検索語は、その文字で始まるバイグラムをまとめて引く）。
+検索語全体がそのまま含まれる発言（フレーズ一致）は順位を上げる。
+
+索引はアーカイブ1件ごとのセグメントとして users/{uid}/archive_search/{archive_id}_{part} に保存する。
+  {"archive_id", "part", "title", "archived_at", "message_count", "format", "blob", "indexed_at"}
+blob は {"docs": [[役割, 本文(先頭 SNIPPET_SOURCE_CHARS 文字), 長さ]], "postings": {gram: [発言番号, 出現数, ...]}}
+を JSON にして zlib 圧縮したもの（1ドキュメントの上限を超えそうなら発言の範囲で分割）。
+アーカイブ保存時にそのアーカイブの分だけ作るので、既存の索引を作り直すことはない。
+
+検索はプロセスに1つの ArchiveSearchIndex がユーザーごとにセグメントをメモリに読み込んで行う
+（初回は全セグメント、その後は indexed_at が新しいものだけ）。アーカイブ本体は読まない。
+"""
+import bisect
+import json
+import math
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict
+
+from firebase_admin import firestore
+
+SEARCH_COLLECTION = "archive_search"
+SEGMENT_FORMAT = "ngram2_zlib_v1"
+# 1セグメントの圧縮後の上限（1MiB の上限に余裕を残す）
+SEGMENT_MAX_BYTES = 700 * 1024
+# スニペット用に保存する1発言あたりの文字数（索引自体は全文から作る）
+SNIPPET_SOURCE_CHARS = 2000
+SNIPPET_RADIUS = 40
+# 検索語のバイグラムのうち、この割合以上を含む発言だけを候補にする
+MIN_COVERAGE = 0.7
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_SPACES = re.compile(r"\s+")
+
+
+def message_text(message):
+    content = message.get("content", "")
+    if isinstance(content, dict):
+        content = content.get("text", "")
+    return content if isinstance(content, str) else str(content)
+
+
+def normalize(text):
+    """全角/半角・互換文字をそろえ、空白を1つに詰める（大文字小文字はそのまま。照合は lower() で行う）"""
+    return _SPACES.sub(" ", unicodedata.normalize("NFKC", text or "")).strip()
+
+
+def bigrams(text):
+    return [text[i:i + 2] for i in range(len(text) - 1)]
+
+
+def query_terms(query):
+    """検索語 → 照合に使う語（2文字以上はバイグラム、1文字はその文字自身）"""
+    q = normalize(query).lower()
+    if len(q) < 2:
+        return q, [q] if q else []
+    return q, list(dict.fromkeys(bigrams(q)))
+
+
+# --- セグメントの作成・保存 ---
+def _encode_segment(messages):
+    docs, postings = [], {}
+    for i, message in enumerate(messages):
+        text = normalize(message_text(message))
+        docs.append([message.get("role", ""), text[:SNIPPET_SOURCE_CHARS], len(text)])
+        for gram, tf in Counter(bigrams(text.lower())).items():
+            postings.setdefault(gram, []).extend((i, tf))
+    payload = json.dumps({"docs": docs, "postings": postings}, ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(payload.encode("utf-8"), 6)
+
+
+def build_segments(messages, max_bytes=SEGMENT_MAX_BYTES):
+    """発言を索引のセグメントにする。上限を超える時は発言の範囲を半分ずつに分ける。戻り値: [(開始番号, blob)]"""
+    blob = _encode_segment(messages)
+    if len(blob) <= max_bytes or len(messages) <= 1:
+        return [(0, blob)]
+    half = len(messages) // 2
+    return build_segments(messages[:half], max_bytes) + [
+        (start + half, part) for start, part in build_segments(messages[half:], max_bytes)
+    ]
+
+
+def decode_segment(data):
+    """保存したセグメントのドキュメント（dict）→ メモリ上の形"""
+    payload = json.loads(zlib.decompress(bytes(data["blob"])).decode("utf-8"))
+    return {
+        "archive_id": data["archive_id"],
+        "part": data.get("part", 0),
+        "title": data.get("title"),
+        "archived_at": data.get("archived_at"),
+        "docs": payload["docs"],
+        "postings": payload["postings"],
+    }
+
+
+def write_search_segments(db, user_ref, archive_id, title, archived_at, messages):
+    """アーカイブ1件分の索引を保存する。戻り値: メモリ上の形のセグメント（ArchiveSearchIndex.add_segments 用）"""
+    col = user_ref.collection(SEARCH_COLLECTION)
+    segments = []
+    batch = db.batch()
+    for part, (start, blob) in enumerate(build_segments(messages)):
+        data = {
+            "archive_id": archive_id,
+            "part": part,
+            "title": title,
+            "archived_at": archived_at or firestore.SERVER_TIMESTAMP,
+            "message_count": len(messages),
+            "first_message": start,
+            "format": SEGMENT_FORMAT,
+            "blob": blob,
+            "indexed_at": firestore.SERVER_TIMESTAMP,
+        }
+        batch.set(col.document(f"{archive_id}_{part:03d}"), data)
+        segments.append(decode_segment({**data, "archived_at": archived_at}))
+    batch.commit()
+    return segments
+
+
+# --- 検索 ---
+class _UserIndex:
+    """1ユーザー分のセグメントをまとめた転置インデックス"""
+
+    def __init__(self):
+        self.segments = {}  # segment_key -> decode_segment の結果
+        self.postings = {}  # gram -> [(segment_key, 発言番号, 出現数)]
+        self.total_len = 0
+        self.doc_count = 0
+        self.latest_indexed = None
+        self.checked_at = 0.0
+        self._sorted_grams = None
+
+    def add(self, key, segment):
+        if key in self.segments:
+            return
+        self.segments[key] = segment
+        for gram, flat in segment["postings"].items():
+            bucket = self.postings.setdefault(gram, [])
+            bucket.extend((key, flat[j], flat[j + 1]) for j in range(0, len(flat), 2))
+        self.doc_count += len(segment["docs"])
+        self.total_len += sum(doc[2] for doc in segment["docs"])
+        self._sorted_grams = None
+
+    def archive_ids(self):
+        return {segment["archive_id"] for segment in self.segments.values()}
+
+    def grams_starting_with(self, char):
+        if self._sorted_grams is None:
+            self._sorted_grams = sorted(self.postings)
+        pos = bisect.bisect_left(self._sorted_grams, char)
+        grams = []
+        while pos < len(self._sorted_grams) and self._sorted_grams[pos].startswith(char):
+            grams.append(self._sorted_grams[pos])
+            pos += 1
+        return grams
+
+
+def _snippet(text, query, terms):
+    lowered = text.lower()
+    pos = lowered.find(query) if query else -1
+    length = len(query)
+    if pos < 0:
+        for term in terms:
+            pos = lowered.find(term)
+            if pos >= 0:
+                length = len(term)
+                break
+    if pos < 0:
+        return text[:SNIPPET_RADIUS * 2] + ("…" if len(text) > SNIPPET_RADIUS * 2 else "")
+    start, end = max(0, pos - SNIPPET_RADIUS), min(len(text), pos + length + SNIPPET_RADIUS)
+    return ("…" if start > 0 else "") + text[start:pos] + "【" + text[pos:pos + length] + "】" \
+        + text[pos + length:end] + ("…" if end < len(text) else "")
+
+
+class ArchiveSearchIndex:
+    """
+    プロセスに1つの検索用キャッシュ。ユーザーごとのセグメントを最大 max_users 人分メモリに持つ（LRU）。
+    refresh_seconds ごとに他プロセスで増えたセグメント（indexed_at が新しいもの）だけを読み足す。
+    """
+
+    def __init__(self, db, refresh_seconds=120, max_users=200):
+        self.db = db
+        self.refresh_seconds = refresh_seconds
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+        self.full_loads = 0
+        self.incremental_loads = 0
+        self.last_search_ms = None
+
+    def _load_locked(self, uid, query):
+        index = self._users.get(uid) or _UserIndex()
+        for doc in query.stream():
+            data = doc.to_dict()
+            if data.get("format") != SEGMENT_FORMAT:
+                continue
+            index.add(doc.id, decode_segment(data))
+            indexed_at = data.get("indexed_at")
+            if indexed_at is not None and (index.latest_indexed is None or indexed_at > index.latest_indexed):
+                index.latest_indexed = indexed_at
+        index.checked_at = time.time()
+        return index
+
+    def _user_locked(self, uid):
+        col = self.db.collection("users").document(uid).collection(SEARCH_COLLECTION)
+        index = self._users.get(uid)
+        if index is None:
+            index = self._load_locked(uid, col)
+            self.full_loads += 1
+        elif time.time() - index.checked_at > self.refresh_seconds:
+            if index.latest_indexed is not None:
+                index = self._load_locked(uid, col.where("indexed_at", ">", index.latest_indexed))
+            else:
+                index = self._load_locked(uid, col)
+            self.incremental_loads += 1
+        self._users[uid] = index
+        self._users.move_to_end(uid)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return index
+
+    def add_segments(self, uid, segments):
+        """このプロセスで作った索引をその場で反映する（まだ読み込んでいないユーザーは次の検索で読む）"""
+        with self._lock:
+            index = self._users.get(uid)
+            if index is None:
+                return
+            for segment in segments:
+                index.add(f"{segment['archive_id']}_{segment['part']:03d}", segment)
+
+    def is_loaded(self, uid):
+        """uid の索引がメモリにあるか（無ければ最初の参照で Firestore から全セグメントを読む）"""
+        with self._lock:
+            return uid in self._users
+
+    def segments_for(self, uid):
+        """uid の索引セグメント {segment_key: セグメント}（似た問題の検索など、索引を別の形で使う用）"""
+        with self._lock:
+            return dict(self._user_locked(uid).segments)
+
+    def indexed_archive_ids(self, uid):
+        with self._lock:
+            return self._user_locked(uid).archive_ids()
+
+    def search(self, uid, query, limit=10, snippets_per_archive=2):
+        """
+        uid のアーカイブを検索し、関連の高い順に返す。
+        戻り値: [{"archive_id", "title", "archived_at", "score", "hits", "snippets": [(役割, スニペット)]}]
+        """
+        started = time.perf_counter()
+        phrase, terms = query_terms(query)
+        if not terms:
+            return []
+        with self._lock:
+            index = self._user_locked(uid)
+            if not index.doc_count:
+                return []
+            avg_len = index.total_len / index.doc_count
+
+            # 語ごとの (セグメント, 発言) → 出現数。1文字の検索はその文字で始まるバイグラムの合計
+            term_hits = []
+            for term in terms:
+                grams = [term] if len(term) == 2 else index.grams_starting_with(term)
+                hits = Counter()
+                for gram in grams:
+                    for key, doc_no, tf in index.postings.get(gram, ()):
+                        hits[(key, doc_no)] += tf
+                term_hits.append(hits)
+
+            scores, matched = Counter(), Counter()
+            for hits in term_hits:
+                if not hits:
+                    continue
+                idf = math.log(1 + (index.doc_count - len(hits) + 0.5) / (len(hits) + 0.5))
+                for (key, doc_no), tf in hits.items():
+                    doc_len = index.segments[key]["docs"][doc_no][2]
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / avg_len)
+                    scores[(key, doc_no)] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                    matched[(key, doc_no)] += 1
+
+            need = max(1, math.ceil(len(terms) * MIN_COVERAGE))
+            by_archive = {}
+            for doc_key, score in scores.items():
+                if matched[doc_key] < need:
+                    continue
+                key, doc_no = doc_key
+                segment = index.segments[key]
+                role, text, _ = segment["docs"][doc_no]
+                if phrase and phrase in text.lower():
+                    score *= 1.5
+                by_archive.setdefault(segment["archive_id"], []).append((score, role, text, segment))
+
+            results = []
+            for archive_id, docs in by_archive.items():
+                docs.sort(key=lambda d: -d[0])
+                segment = docs[0][3]
+                results.append({
+                    "archive_id": archive_id,
+                    "title": segment["title"],
+                    "archived_at": segment["archived_at"],
+                    # 一番当たった発言を主に、2番目以降も少しだけ足す
+                    "score": docs[0][0] + 0.3 * sum(d[0] for d in docs[1:3]),
+                    "hits": len(docs),
+                    "snippets": [(role, _snippet(text, phrase, terms)) for _, role, text, _ in docs[:snippets_per_archive]],
+                })
+            results.sort(key=lambda r: -r["score"])
+            self.last_search_ms = round((time.perf_counter() - started) * 1000, 2)
+            return results[:limit]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "segments": sum(len(index.segments) for index in self._users.values()),
+                "full_loads": self.full_loads,
+                "incremental_loads": self.incremental_loads,
+                "last_search_ms": self.last_search_ms,
+            }
@@ -0,0 +1,198 @@
+"""
+会話アーカイブ（users/{uid}/archived_sessions）の保存と読み出し。
+
+一覧はフィールドマスク（タイトル・日時・件数・サイズ）だけをカーソルでページングして読み、
+メッセージ本体は開いた1件分だけを取得する。一覧のために全アーカイブの messages 配列を転送しない。
+
+長い会話でも Firestore の1ドキュメント1MiBの上限に当たらないよう、本体は
+  archived_sessions/{id}              … ヘッダ（タイトル・件数・チャンク数・チェックサム）
+  archived_sessions/{id}/chunks/{n}   … メッセージを1行1件のJSONにして zlib 圧縮し、chunk_bytes ごとに分割したもの
+に分けて保存する。チャンクを全て書いてから最後にヘッダを書くので、一覧に出るのは書き終わったアーカイブだけ。
+読み出しはチャンクを順に読み、チェックサムを確認しながら少しずつ展開してメッセージを1件ずつ返す。
+"""
+import datetime
+import hashlib
+import json
+import zlib
+
+from firebase_admin import firestore
+
+ARCHIVE_COLLECTION = "archived_sessions"
+CHUNK_COLLECTION = "chunks"
+CHUNKED_FORMAT = "chunked_zlib_jsonl_v1"
+# 一覧で読むメタデータ（messages は含めない）
+ARCHIVE_META_FIELDS = ["title", "archived_at", "message_count", "size_bytes"]
+# 1チャンクの圧縮後の最大バイト数（1MiBの上限に十分な余裕を残す）
+DEFAULT_CHUNK_BYTES = 256 * 1024
+# 1回のバッチで書くチャンク数（リクエストサイズの上限 10MiB 未満に収める）
+CHUNKS_PER_BATCH = 16
+
+
+class ArchiveIntegrityError(Exception):
+    """チャンクの欠落・チェックサム不一致"""
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def messages_size_bytes(messages):
+    """アーカイブの大きさの目安（JSONにしたUTF-8のバイト数）"""
+    return len(json.dumps(messages, ensure_ascii=False, default=_json_default).encode("utf-8"))
+
+
+def encode_chunks(messages, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    メッセージを JSON Lines → zlib 圧縮し、chunk_bytes ごとに分割する。
+    戻り値: (chunks, meta) chunks は [{"index", "data", "sha256"}]、meta は元サイズ・全体のチェックサムなど
+    """
+    compressor = zlib.compressobj(level=6)
+    raw_hash = hashlib.sha256()
+    raw_size = 0
+    compressed = bytearray()
+    chunks = []
+
+    def cut(final=False):
+        while len(compressed) >= chunk_bytes or (final and compressed):
+            data = bytes(compressed[:chunk_bytes])
+            del compressed[:chunk_bytes]
+            chunks.append({"index": len(chunks), "data": data, "sha256": hashlib.sha256(data).hexdigest()})
+
+    for message in messages:
+        line = (json.dumps(message, ensure_ascii=False, default=_json_default) + "\n").encode("utf-8")
+        raw_hash.update(line)
+        raw_size += len(line)
+        compressed.extend(compressor.compress(line))
+        cut()
+    compressed.extend(compressor.flush())
+    cut(final=True)
+
+    meta = {
+        "message_count": len(messages),
+        "size_bytes": raw_size,
+        "compressed_bytes": sum(len(c["data"]) for c in chunks),
+        "chunk_count": len(chunks),
+        "chunk_bytes": chunk_bytes,
+        "sha256": raw_hash.hexdigest(),
+    }
+    return chunks, meta
+
+
+def iter_decoded_messages(chunk_iter, expected_sha256=None):
+    """チャンクを順に受け取り、チェックサムを確認しながら少しずつ展開してメッセージを1件ずつ返す"""
+    decompressor = zlib.decompressobj()
+    raw_hash = hashlib.sha256()
+    pending = b""
+    expected_index = 0
+    for chunk in chunk_iter:
+        if chunk["index"] != expected_index:
+            raise ArchiveIntegrityError(f"チャンク {expected_index} が見つかりません")
+        data = bytes(chunk["data"])
+        if hashlib.sha256(data).hexdigest() != chunk["sha256"]:
+            raise ArchiveIntegrityError(f"チャンク {expected_index} のチェックサムが一致しません")
+        expected_index += 1
+        pending += decompressor.decompress(data)
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            raw_hash.update(line + b"\n")
+            yield json.loads(line)
+    pending += decompressor.flush()
+    if pending.strip():
+        raw_hash.update(pending)
+        yield json.loads(pending)
+    if expected_sha256 and raw_hash.hexdigest() != expected_sha256:
+        raise ArchiveIntegrityError("アーカイブ全体のチェックサムが一致しません")
+
+
+def write_chunked_archive(db, user_ref, title, messages, note, chunk_bytes=DEFAULT_CHUNK_BYTES, archive_id=None):
+    """
+    チャンク → ヘッダの順に書く。途中で失敗したら書いたチャンクを消して例外を投げる
+    （呼び出し側は、これが成功してから元の履歴を消すこと）。戻り値: アーカイブのドキュメント参照
+    archive_id を指定すると同じIDに上書きで書くので、再試行しても2件にならない。
+    """
+    header_ref = user_ref.collection(ARCHIVE_COLLECTION).document(archive_id)
+    chunks, meta = encode_chunks(messages, chunk_bytes)
+    chunk_col = header_ref.collection(CHUNK_COLLECTION)
+    try:
+        for start in range(0, len(chunks), CHUNKS_PER_BATCH):
+            batch = db.batch()
+            for chunk in chunks[start:start + CHUNKS_PER_BATCH]:
+                batch.set(chunk_col.document(f"{chunk['index']:05d}"), chunk)
+            batch.commit()
+        header_ref.set({
+            "title": title,
+            "archived_at": firestore.SERVER_TIMESTAMP,
+            "note": note,
+            "format": CHUNKED_FORMAT,
+            "chunk_sha256": [c["sha256"] for c in chunks],
+            **meta,
+        })
+    except Exception:
+        try:
+            for chunk in chunks:
+                chunk_col.document(f"{chunk['index']:05d}").delete()
+        except Exception as cleanup_error:
+            print(f"Archive chunk cleanup failed: {cleanup_error}")
+        raise
+    return header_ref
+
+
+def list_archives(user_ref, cursor=None, limit=20):
+    """
+    新しい順にメタデータだけを1ページ分読む。
+    cursor は前のページの next_cursor（archived_at）。戻り値: (rows, next_cursor)
+      rows: [{"id", "title", "archived_at", "message_count", "size_bytes"}]
+    """
+    query = user_ref.collection(ARCHIVE_COLLECTION)\
+                    .order_by("archived_at", direction=firestore.Query.DESCENDING)\
+                    .select(ARCHIVE_META_FIELDS)
+    if cursor is not None:
+        query = query.start_after({"archived_at": cursor})
+    docs = list(query.limit(limit + 1).stream())
+    rows = []
+    for doc in docs[:limit]:
+        data = doc.to_dict()
+        rows.append({
+            "id": doc.id,
+            "title": data.get("title"),
+            "archived_at": data.get("archived_at"),
+            "message_count": data.get("message_count"),
+            "size_bytes": data.get("size_bytes"),
+        })
+    next_cursor = rows[-1]["archived_at"] if len(docs) > limit and rows else None
+    return rows, next_cursor
+
+
+def iter_archive_messages(user_ref, archive_id, chunk_page=8):
+    """開いたアーカイブ1件のメッセージを順に返す（チャンク形式は chunk_page 件ずつ読みながら展開）"""
+    header_ref = user_ref.collection(ARCHIVE_COLLECTION).document(archive_id)
+    header = header_ref.get(field_paths=["format", "sha256"])
+    if not header.exists:
+        return
+    header_data = header.to_dict() or {}
+    if header_data.get("format") != CHUNKED_FORMAT:
+        # 旧形式（messages 配列を1ドキュメントに持つ）
+        legacy = header_ref.get(field_paths=["messages"])
+        yield from (legacy.to_dict() or {}).get("messages", [])
+        return
+
+    def stream_chunks():
+        query = header_ref.collection(CHUNK_COLLECTION).order_by("index")
+        last_index = None
+        while True:
+            page_query = query.start_after({"index": last_index}) if last_index is not None else query
+            docs = list(page_query.limit(chunk_page).stream())
+            for doc in docs:
+                yield doc.to_dict()
+            if len(docs) < chunk_page:
+                break
+            last_index = docs[-1].get("index")
+
+    yield from iter_decoded_messages(stream_chunks(), header_data.get("sha256"))
+
+
+def load_archive_messages(user_ref, archive_id):
+    """開いたアーカイブ1件のメッセージを全て読む"""
+    return list(iter_archive_messages(user_ref, archive_id))
@@ -0,0 +1,84 @@
+"""
+学習ログ集計のベンチマーク（合成データ・Firestore不要）。
+
+従来方式: 日/週/月それぞれで study_logs を timestamp >= 開始 で読み（limit 2000）、Pythonのループで合計
+新方式  : 一番広い窓を1回だけ読み、study_stats.aggregate_study_windows で6表を一度に集計
+
+読み込み件数（= Firestore の読み取り課金の目安）と処理時間を 1k / 10k / 100k 件で比べる。
+実行: python bench_study_aggregation.py
+"""
+import datetime
+import random
+import time
+
+from study_stats import JST, PERIODS, aggregate_study_windows, period_start, widest_window_start
+
+OLD_QUERY_LIMIT = 2000
+
+
+def make_logs(n, now, n_users=300, n_teams=20, days=45, seed=0):
+    """過去 days 日に散らばった n 件の合成ログと、ユーザー→チームの対応"""
+    rng = random.Random(seed)
+    uids = [f"user{i:04d}" for i in range(n_users)]
+    team_of = {uid: f"team{rng.randrange(n_teams):02d}" for uid in uids if rng.random() < 0.7}
+    logs = []
+    for _ in range(n):
+        ts = now - datetime.timedelta(seconds=rng.uniform(0, days * 86400))
+        logs.append((rng.choice(uids), rng.randint(1, 180), ts))
+    logs.sort(key=lambda x: x[2])
+    return logs, team_of
+
+
+def old_approach(logs, now, team_of):
+    """期間ごとに別クエリ（件数上限つき）で読み、辞書で合計する"""
+    reads = 0
+    personal, teams = {}, {}
+    for period in PERIODS:
+        start = period_start(period, now)
+        docs = [log for log in logs if log[2] >= start][:OLD_QUERY_LIMIT]
+        reads += len(docs)
+        stats = {}
+        for uid, mins, _ in docs:
+            stats[uid] = stats.get(uid, 0) + mins
+        team_stats = {}
+        for uid, mins in stats.items():
+            if uid in team_of:
+                team_stats[team_of[uid]] = team_stats.get(team_of[uid], 0) + mins
+        personal[period], teams[period] = stats, team_stats
+    return {"personal": personal, "teams": teams}, reads
+
+
+def new_approach(logs, now, team_of):
+    """一番広い窓を1回だけ読み、1パスで全窓に振り分ける"""
+    start = widest_window_start(now)
+    stream = (log for log in logs if log[2] >= start)
+    result = aggregate_study_windows(stream, now, team_of)
+    return result, result["rows"]
+
+
+def timed(fn, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        out = fn(*args)
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return out, best
+
+
+def main():
+    # 週が月をまたぐ日（木曜・10/1）に固定して、窓の重なり方を毎回同じにする
+    now = datetime.datetime(2026, 10, 1, 18, 0, tzinfo=JST)
+    print(f"{'logs':>7} | {'old reads':>9} {'old ms':>8} {'truncated':>9} | {'new reads':>9} {'new ms':>8}")
+    print("-" * 64)
+    for n in (1_000, 10_000, 100_000):
+        logs, team_of = make_logs(n, now)
+        (old_result, old_reads), old_ms = timed(old_approach, logs, now, team_of)
+        (new_result, new_reads), new_ms = timed(new_approach, logs, now, team_of)
+        # 上限に当たらない限り、両者の結果は一致するはず
+        truncated = old_result["personal"] != new_result["personal"] or old_result["teams"] != new_result["teams"]
+        print(f"{n:>7} | {old_reads:>9} {old_ms:>8.1f} {'yes' if truncated else 'no':>9} | {new_reads:>9} {new_ms:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+会話コンテキストの管理（トークン予算つきウィンドウ + ローリング要約）。
+
+直近の会話だけをトークン予算内でモデルに送り、予算からはみ出した古い発言は
+「これまでの要約」に少しずつ畳み込む。要約は呼び出し側がセッション/Firestoreに保存し、
+次のターン以降は再生成しない（新しく畳み込む分だけ要約を更新する）。
+"""
+import re
+
+# CJK（ひらがな・カタカナ・漢字・全角記号）は概ね1文字≒1トークン、
+# それ以外（英数字・LaTeX）は概ね4文字≒1トークンとして見積もる
+_CJK_PATTERN = re.compile(r"[　-ヿ㐀-䶿一-鿿＀-￯]")
+
+# 1メッセージあたりのロール等のオーバーヘッド
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PREFIX = "【これまでの会話の要約】\n"
+SUMMARY_ACK = "要約を確認しました。この続きから指導します。"
+
+
+def estimate_tokens(text):
+    """ネットワーク呼び出しなしでトークン数を見積もる（count_tokens API の往復を避けるため）"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def message_text(message):
+    """session_state.messages の1要素から送信用テキストを取り出す（画像付きdictにも対応）"""
+    content = message.get("content")
+    if isinstance(content, dict):
+        return content.get("text", "")
+    return str(content) if content is not None else ""
+
+
+def new_context_state():
+    """要約状態の初期値。summarized_count は要約に畳み込み済みのメッセージ数（会話の先頭から数える）"""
+    return {"summary": "", "summarized_count": 0}
+
+
+def _next_user_index(messages, start):
+    """start 以降で最初の user 発言の位置（ウィンドウは user 発言から始める）"""
+    idx = start
+    while idx < len(messages) and messages[idx].get("role") != "user":
+        idx += 1
+    return idx
+
+
+def build_windowed_history(messages, system_instruction, state, summarizer,
+                           budget_tokens=6000, fold_target_ratio=0.6, message_offset=0):
+    """
+    モデルに送る history を組み立てる。
+
+    messages : これまでの会話（今回の user 発言は含めない）
+    state    : {"summary", "summarized_count"}（new_context_state の形式）
+    summarizer(previous_summary, folded_messages) -> 新しい要約テキスト
+    message_offset : messages[0] が会話全体の何番目か（末尾だけ読み込んでいる場合）
+
+    予算を超えたら、ウィンドウが予算の fold_target_ratio 倍に収まるまで古い発言を要約へ畳み込む
+    （毎ターン要約し直さないよう、余裕をもって畳み込む）。
+    戻り値: (history_for_ai, new_state, folded_count)
+    """
+    state = dict(state or new_context_state())
+    start = max(0, state.get("summarized_count", 0) - message_offset)
+    start = min(start, len(messages))
+
+    fixed_tokens = estimate_tokens(system_instruction) + estimate_tokens(state.get("summary", ""))
+    token_counts = [estimate_tokens(message_text(m)) + MESSAGE_OVERHEAD_TOKENS for m in messages]
+    window_tokens = sum(token_counts[start:])
+
+    folded_count = 0
+    if fixed_tokens + window_tokens > budget_tokens:
+        target = budget_tokens * fold_target_ratio - fixed_tokens
+        new_start = start
+        while new_start < len(messages) and window_tokens > target:
+            window_tokens -= token_counts[new_start]
+            new_start += 1
+        new_start = _next_user_index(messages, new_start)
+
+        folded = messages[start:new_start]
+        if folded:
+            try:
+                state["summary"] = summarizer(state.get("summary", ""), folded)
+                state["summarized_count"] = message_offset + new_start
+                folded_count = len(folded)
+            except Exception:
+                # 要約に失敗したターンは古い発言を送らないだけにして、要約状態は次回に持ち越す
+                pass
+            start = new_start
+
+    history = []
+    if state.get("summary"):
+        history.append({"role": "user", "parts": [SUMMARY_PREFIX + state["summary"]]})
+        history.append({"role": "model", "parts": [SUMMARY_ACK]})
+    for m in messages[start:]:
+        history.append({"role": m["role"], "parts": [message_text(m)]})
+    return history, state, folded_count
+
+
+def build_summary_prompt(previous_summary, folded_messages, max_chars=600):
+    """要約更新用のプロンプト（前回の要約 + 新しく畳み込む発言だけを渡す）"""
+    lines = []
+    for m in folded_messages:
+        role = "生徒" if m.get("role") == "user" else "コーチ"
+        lines.append(f"{role}: {message_text(m)[:2000]}")
+    log_text = "\n".join(lines)
+    return f"""
+以下は数学の個別指導の会話です。「これまでの要約」に「追加の会話」の内容を統合し、
+{max_chars}文字以内の新しい要約を作ってください。
+扱った問題・生徒がつまずいた点・理解できた点・未解決の問いを優先して残してください。
+要約のみを出力してください。
+
+これまでの要約:
+{previous_summary or "(なし)"}
+
+追加の会話:
+{log_text}
+"""
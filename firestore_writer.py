@@ -0,0 +1,302 @@
+"""
+Firestore への書き込みを応答のクリティカルパスから外すためのヘルパー。
+
+WriteBehindQueue: チャットの各ターンの .add() をその場で送らずにキューへ積み、
+バックグラウンドスレッドが db.batch() でまとめてコミットする（件数・時間の閾値でフラッシュ。
+失敗したバッチは1件ずつ書き直し、一時的なエラーの分はキューの先頭に戻して後で再試行する）。
+
+bulk_delete: 大量のドキュメント（会話履歴など）を BulkWriter で並列に削除する
+（500/50/5 ルールに沿って秒間の書き込み数を段階的に上げ、競合・一時的なエラーは指数バックオフで再試行）。
+"""
+import atexit
+import threading
+import time
+from collections import deque
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1.bulk_writer import BulkRetry, BulkWriterOptions, SendMode
+
+# Firestore のバッチは1回500書き込みまで
+MAX_BATCH_WRITES = 500
+# 何度書いても成功しないエラー（存在しないドキュメントへの update など）。これだけは再試行せずに破棄する
+PERMANENT_ERRORS = (
+    google_exceptions.NotFound,
+    google_exceptions.AlreadyExists,
+    google_exceptions.InvalidArgument,
+    google_exceptions.FailedPrecondition,
+    google_exceptions.PermissionDenied,
+)
+
+
+class WriteBehindQueue:
+    """
+    プロセスに1つのライトビハインド・キュー。
+
+    - enqueue_add / enqueue_set で書き込みを積むだけなので、呼び出し側は待たない
+    - max_batch 件たまるか、最古の書き込みから flush_interval 秒経ったらコミット
+    - バッチのコミットが batch_retries 回失敗したら、1件ずつ同期的に書き直す（他の書き込みを巻き添えにしない）。
+      それでも一時的なエラーで失敗した分はキューの先頭に戻し（順序を保って）、指数バックオフの後に再試行する。
+      破棄するのは PERMANENT_ERRORS（何度やっても成功しない書き込み）だけ
+    - flush() で「呼び出し時点までに積んだ分」のコミット完了を待てる（退室時・履歴アーカイブ前など）
+    - プロセス終了時は atexit で残りを吐き出す
+
+    ※同じバッチ内の SERVER_TIMESTAMP は全て同じ時刻になるため、
+      並び順が必要なデータ（会話履歴など）はクライアント側の時刻を入れて積むこと。
+    """
+
+    def __init__(self, db, max_batch=200, flush_interval=1.0, batch_retries=2):
+        self.db = db
+        self.max_batch = min(max_batch, MAX_BATCH_WRITES)
+        self.flush_interval = flush_interval
+        self.batch_retries = batch_retries
+
+        self._ops = deque()  # (seq, kind, ref, data, merge, enqueued_at, attempts)。seq の昇順
+        self._cond = threading.Condition()
+        self._next_seq = 0
+        self._done_seq = -1  # ここまでの seq はコミット済み（または書けないものとして破棄）
+        self._flush_requested_seq = -1  # flush() で待たれている seq（時間閾値を待たずにコミットする）
+        self._closed = False
+
+        self.committed = 0
+        self.failed_flushes = 0
+        self.requeued = 0
+        self.dropped = 0
+        self.last_error = None
+        self.last_flush_ms = None
+
+        self._thread = threading.Thread(target=self._run, name="firestore-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # --- 積む側 ---
+    def _enqueue(self, kind, ref, data, merge=False):
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._ops.append((seq, kind, ref, data, merge, time.time(), 0))
+            self._cond.notify()
+            return seq
+
+    def enqueue_add(self, collection_ref, data):
+        """collection_ref.add(data) の代わり。IDはクライアントで採番し、そのドキュメント参照を返す"""
+        doc_ref = collection_ref.document()
+        self._enqueue("set", doc_ref, data)
+        return doc_ref
+
+    def enqueue_set(self, doc_ref, data, merge=False):
+        self._enqueue("set", doc_ref, data, merge)
+        return doc_ref
+
+    def enqueue_update(self, doc_ref, data):
+        self._enqueue("update", doc_ref, data)
+        return doc_ref
+
+    def enqueue_delete(self, doc_ref):
+        self._enqueue("delete", doc_ref, None)
+        return doc_ref
+
+    # --- フラッシュ ---
+    def flush(self, timeout=10.0):
+        """呼び出し時点までに積まれた書き込みがコミットされるまで待つ。間に合えば True"""
+        with self._cond:
+            target = self._next_seq - 1
+            if self._done_seq >= target:
+                return True
+            self._cond.notify_all()  # 時間閾値を待たずにすぐコミットさせる
+            deadline = time.time() + timeout
+            self._flush_requested_seq = target
+            while self._done_seq < target:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self, timeout=10.0):
+        """残りを吐き出してからワーカーを止める（プロセス終了時）"""
+        if self._closed:
+            return
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    # --- ワーカー ---
+    def _ready(self):
+        if not self._ops:
+            return False
+        if len(self._ops) >= self.max_batch or self._closed:
+            return True
+        if self._flush_requested_seq >= self._ops[0][0]:
+            return True
+        return time.time() - self._ops[0][5] >= self.flush_interval
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    if self._closed and not self._ops:
+                        return
+                    timeout = self.flush_interval
+                    if self._ops:
+                        timeout = max(0.01, self.flush_interval - (time.time() - self._ops[0][5]))
+                    self._cond.wait(timeout)
+                batch_ops = [self._ops.popleft() for _ in range(min(self.max_batch, len(self._ops)))]
+
+            self._commit_with_retry(batch_ops)
+
+    def _add_to_batch(self, batch, kind, ref, data, merge):
+        if kind == "set":
+            batch.set(ref, data, merge=merge)
+        elif kind == "update":
+            batch.update(ref, data)
+        elif kind == "delete":
+            batch.delete(ref)
+
+    def _mark_done(self):
+        """キューに残っている最小の seq の手前までを完了にする（呼び出し側で _cond を持つこと）"""
+        self._done_seq = self._ops[0][0] - 1 if self._ops else self._next_seq - 1
+        self._cond.notify_all()
+
+    def _commit_with_retry(self, batch_ops):
+        for attempt in range(1, self.batch_retries + 1):
+            started = time.perf_counter()
+            try:
+                batch = self.db.batch()
+                for _, kind, ref, data, merge, _, _ in batch_ops:
+                    self._add_to_batch(batch, kind, ref, data, merge)
+                batch.commit()
+                with self._cond:
+                    self.committed += len(batch_ops)
+                    self.last_flush_ms = int((time.perf_counter() - started) * 1000)
+                    self._mark_done()
+                return
+            except Exception as e:
+                with self._cond:
+                    self.failed_flushes += 1
+                    self.last_error = str(e)[:200]
+                print(f"Write-behind flush error (try {attempt}): {e}")
+                if attempt < self.batch_retries:
+                    time.sleep(0.25 * 2 ** attempt)
+
+        self._commit_individually(batch_ops)
+
+    def _commit_individually(self, batch_ops):
+        """バッチで書けなかった分を1件ずつ同期的に書く。一時的なエラーの分はキューの先頭に戻す"""
+        retry_ops = []
+        blocked_paths = set()  # 前の書き込みを戻したドキュメント。後の書き込みを先に反映しないよう一緒に戻す
+        for op in batch_ops:
+            seq, kind, ref, data, merge, enqueued_at, attempts = op
+            if ref.path in blocked_paths:
+                retry_ops.append(op)
+                continue
+            try:
+                self._write_single(kind, ref, data, merge)
+            except PERMANENT_ERRORS as e:
+                print(f"Write-behind dropped {kind} {ref.path}: {e}")
+                with self._cond:
+                    self.dropped += 1
+                    self.last_error = str(e)[:200]
+                continue
+            except Exception as e:
+                with self._cond:
+                    self.last_error = str(e)[:200]
+                retry_ops.append((seq, kind, ref, data, merge, enqueued_at, attempts + 1))
+                blocked_paths.add(ref.path)
+                continue
+            with self._cond:
+                self.committed += 1
+
+        with self._cond:
+            # 先頭に戻す（後から積まれた同じドキュメントへの書き込みを古い内容で上書きしないよう、順序を保つ）
+            self._ops.extendleft(reversed(retry_ops))
+            self.requeued += len(retry_ops)
+            self._mark_done()
+        if retry_ops:
+            time.sleep(min(0.25 * 2 ** max(op[6] for op in retry_ops), 8))
+
+    def _write_single(self, kind, ref, data, merge):
+        if kind == "set":
+            ref.set(data, merge=merge)
+        elif kind == "update":
+            ref.update(data)
+        elif kind == "delete":
+            ref.delete()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending": len(self._ops),
+                "committed": self.committed,
+                "failed_flushes": self.failed_flushes,
+                "requeued": self.requeued,
+                "dropped": self.dropped,
+                "last_flush_ms": self.last_flush_ms,
+                "last_error": self.last_error or "",
+            }
+
+
+def bulk_delete(db, refs, window=2000, max_attempts=5, deadline_seconds=None, on_progress=None,
+                initial_ops_per_second=500, max_ops_per_second=5000):
+    """
+    refs（ドキュメント参照のイテラブル）を BulkWriter で並列に削除する。
+
+    - window 件ずつ積んで flush するので、進捗（on_progress(削除済み件数)）と期限の確認はその単位
+    - 1件ごとの失敗は max_attempts 回まで BulkWriter 側で指数バックオフして再試行
+    - deadline_seconds を過ぎたら残りは積まずに返す（complete=False。呼び出し側でやり直す）
+    戻り値: {"deleted", "failed", "retries", "seconds", "docs_per_sec", "complete"}
+    """
+    started = time.perf_counter()
+    lock = threading.Lock()
+    counts = {"deleted": 0, "failed": 0, "retries": 0}
+
+    def on_result(reference, result, writer):
+        with lock:
+            counts["deleted"] += 1
+
+    def on_error(error, writer):
+        with lock:
+            if error.attempts < max_attempts:
+                counts["retries"] += 1
+                return True
+            counts["failed"] += 1
+        print(f"Bulk delete error ({error.code}): {error.message}")
+        return False
+
+    writer = db.bulk_writer(options=BulkWriterOptions(
+        initial_ops_per_second=initial_ops_per_second,
+        max_ops_per_second=max_ops_per_second,
+        mode=SendMode.parallel,
+        retry=BulkRetry.exponential,
+    ))
+    writer.on_write_result(on_result)
+    writer.on_write_error(on_error)
+
+    complete = True
+    pending = 0
+    try:
+        for ref in refs:
+            writer.delete(ref)
+            pending += 1
+            if pending >= window:
+                writer.flush()
+                pending = 0
+                with lock:
+                    deleted = counts["deleted"]
+                if on_progress is not None:
+                    on_progress(deleted)
+                if deadline_seconds is not None and time.perf_counter() - started > deadline_seconds:
+                    complete = False
+                    break
+    finally:
+        writer.close()
+
+    seconds = time.perf_counter() - started
+    with lock:
+        stats = dict(counts)
+    if on_progress is not None:
+        on_progress(stats["deleted"])
+    stats["complete"] = complete and stats["failed"] == 0
+    stats["seconds"] = round(seconds, 3)
+    stats["docs_per_sec"] = round(stats["deleted"] / seconds, 1) if seconds > 0 else None
+    return stats
@@ -0,0 +1,311 @@
+"""
+チャットにアップロードされた画像の前処理パイプライン（Pillow）。
+
+スマホ写真（4000px・数MB・フルカラー）をそのまま Gemini に送らないように、
+EXIFの向き補正 → 長辺のリサイズ → プリント/ノート写真のグレースケール＋コントラスト補正 → JPEG再エンコード
+を行い、どれだけ小さくなったかを統計として返す。
+"""
+import hashlib
+import io
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image, ImageOps, ImageStat
+
+# Gemini は長辺が大きい画像を内部で縮小するため、それ以上の解像度は送っても無駄になる
+MODEL_MAX_EDGE = 1536
+JPEG_QUALITY = 85
+# 彩度の平均がこれ未満ならプリント・ノートの写真（ほぼモノクロ）とみなす
+WORKSHEET_SATURATION_THRESHOLD = 40
+
+
+def _read_bytes(source):
+    """UploadedFile / ファイルパス / bytes / PIL.Image から元のバイト列を取り出す"""
+    if isinstance(source, Image.Image):
+        buf = io.BytesIO()
+        source.save(buf, format="PNG")
+        return buf.getvalue()
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    if hasattr(source, "read"):
+        if hasattr(source, "seek"):
+            source.seek(0)
+        return source.read()
+    with open(source, "rb") as f:
+        return f.read()
+
+
+def _to_rgb(img):
+    """透過PNGなどは白背景に合成してRGBにする"""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.split()[3])
+        return background
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+
+def is_worksheet_photo(img):
+    """彩度の低い（プリント・ノート・黒板などの）写真かどうか"""
+    sample = img.copy()
+    sample.thumbnail((128, 128))
+    saturation = ImageStat.Stat(sample.convert("HSV")).mean[1]
+    return saturation < WORKSHEET_SATURATION_THRESHOLD
+
+
+def preprocess_image(source, max_edge=MODEL_MAX_EDGE, worksheet_mode="auto", quality=JPEG_QUALITY):
+    """
+    画像を前処理して Gemini 送信用にする。
+
+    worksheet_mode: "auto"（彩度で判定） / True（常にグレースケール化） / False（色を残す）
+    戻り値: (processed_image, blob, stats)
+      processed_image : 表示用の PIL.Image（再エンコード後の画像）
+      blob            : Gemini にそのまま渡せる {"mime_type", "data"}
+      stats           : 元/処理後のバイト数・解像度、削減量、処理時間(ms)
+    """
+    started = time.perf_counter()
+    raw = _read_bytes(source)
+    img = Image.open(io.BytesIO(raw))
+    original_size = img.size
+
+    img = ImageOps.exif_transpose(img)
+    img = _to_rgb(img)
+
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    worksheet = is_worksheet_photo(img) if worksheet_mode == "auto" else bool(worksheet_mode)
+    if worksheet:
+        # 影や黄ばみで薄くなった文字をはっきりさせる（上下1%の外れ値は無視）
+        img = ImageOps.autocontrast(img.convert("L"), cutoff=1)
+
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+    data = buf.getvalue()
+
+    processed = Image.open(io.BytesIO(data))
+    stats = {
+        "original_bytes": len(raw),
+        "processed_bytes": len(data),
+        "bytes_saved": max(0, len(raw) - len(data)),
+        "original_size": f"{original_size[0]}x{original_size[1]}",
+        "processed_size": f"{processed.size[0]}x{processed.size[1]}",
+        "worksheet": worksheet,
+        "preprocess_ms": int((time.perf_counter() - started) * 1000),
+    }
+    return processed, {"mime_type": "image/jpeg", "data": data}, stats
+
+
+def format_image_stats(stats):
+    """デバッグログ用の1行サマリ"""
+    saved_pct = 0
+    if stats["original_bytes"]:
+        saved_pct = int(stats["bytes_saved"] * 100 / stats["original_bytes"])
+    line = (
+        f"📷 画像前処理: {stats['original_size']} {stats['original_bytes'] // 1024}KB → "
+        f"{stats['processed_size']} {stats['processed_bytes'] // 1024}KB "
+        f"({saved_pct}%削減, {'モノクロ補正' if stats['worksheet'] else 'カラー'}, {stats['preprocess_ms']}ms)"
+    )
+    if stats.get("cache") == "hit":
+        line += " / 読み取り済みテキストを再利用"
+    if stats.get("first_token_ms") is not None:
+        # 画像の送信だけの時間は測れない（ストリーミング応答の最初の文字まで。モデルの処理時間を含む）
+        line += f" / 送信〜最初の文字 {stats['first_token_ms']}ms（モデルの処理込み）"
+    return line
+
+
+# =========================================================
+# 知覚ハッシュ（dHash + pHash）による画像の読み取り結果キャッシュ
+# =========================================================
+
+TRANSCRIBE_PROMPT = """
+この画像に写っている数学の問題文・数式・生徒の書き込みを、そのまま文字に起こしてください。
+数式はLaTeX形式（$マーク）で書いてください。解説や解答は書かず、読み取った内容のみを出力してください。
+"""
+
+# 「同じ写真」とみなすハミング距離の上限。文字だらけのプリントは別のページでも dHash が近くなるので、これより緩くはしない
+MAX_HASH_DISTANCE = 2
+
+
+def dhash(img, hash_size=8):
+    """
+    差分ハッシュ（dHash）。(hash_size+1)×hash_size のグレースケールに縮小し、
+    横に隣り合う画素の明暗の大小を64ビット整数にする。撮り直し・圧縮・多少の明るさの違いに強い。
+    """
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (1 if pixels[offset + col] > pixels[offset + col + 1] else 0)
+    return value
+
+
+def _dct_rows(rows, count):
+    """各行の DCT-II の低い方から count 個の係数（正規化は省略。大小比較にしか使わない）"""
+    n = len(rows[0])
+    basis = [[math.cos(math.pi * (2 * x + 1) * u / (2 * n)) for x in range(n)] for u in range(count)]
+    return [[sum(v * b for v, b in zip(row, basis[u])) for u in range(count)] for row in rows]
+
+
+def phash(img, hash_size=8, sample_size=32):
+    """
+    DCT による知覚ハッシュ（pHash）。sample_size 四方のグレースケールに縮小して2次元DCTをとり、
+    低周波の hash_size×hash_size 係数（直流成分を除く）が中央値より大きいかを64ビット整数にする。
+    明暗の勾配だけを見る dHash と違い、ページ全体の配置の違いに反応する。
+    """
+    small = img.convert("L").resize((sample_size, sample_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    rows = [pixels[i * sample_size:(i + 1) * sample_size] for i in range(sample_size)]
+    low = _dct_rows(rows, hash_size)                      # 行方向: sample_size × hash_size
+    low = _dct_rows([list(col) for col in zip(*low)], hash_size)  # 列方向: hash_size × hash_size
+    coeffs = [c for row in low for c in row]
+    median = sorted(coeffs[1:])[len(coeffs[1:]) // 2]
+    value = 0
+    for c in coeffs:
+        value = (value << 1) | (1 if c > median else 0)
+    return value
+
+
+def image_fingerprint(img, data):
+    """
+    キャッシュのキーにする指紋 (dHash, pHash, sha256)。
+    data は Gemini に送る前処理後のバイト列（同じファイルなら前処理の結果も同じになる）。
+    """
+    return dhash(img), phash(img), hashlib.sha256(data).hexdigest()
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ImageTranscriptionCache:
+    """
+    指紋 (dHash, pHash, sha256) → {読み取り結果(LaTeX/テキスト), 解答確認モードの解答} のキャッシュ。
+    dHash と pHash の両方のハミング距離が max_distance（最大 MAX_HASH_DISTANCE）以下なら「同じ問題の写真」とみなす。
+    解答は送った人（owner）ごとに持ち、他の人の解答はバイト列まで同じ画像（sha256 が一致）の時だけ返す。
+    件数上限（LRU）と有効期限で古いものから捨てる。
+    """
+
+    def __init__(self, max_entries=1000, max_distance=MAX_HASH_DISTANCE, ttl_seconds=7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.max_distance = min(max_distance, MAX_HASH_DISTANCE)
+        self.ttl_seconds = ttl_seconds
+        # (dHash, pHash) -> {"transcription", "answers", "created_at", "pending"}
+        # answers: answer_key -> {owner: (sha256, 解答)}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self, now):
+        expired = [h for h, e in self._entries.items() if now - e["created_at"] > self.ttl_seconds]
+        for h in expired:
+            del self._entries[h]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _nearest(self, fingerprint):
+        d_hash, p_hash = fingerprint[0], fingerprint[1]
+        if (d_hash, p_hash) in self._entries:
+            return (d_hash, p_hash)
+        best_key, best_dist = None, None
+        for key in self._entries:
+            d_dist = hamming_distance(key[0], d_hash)
+            if d_dist > self.max_distance:
+                continue
+            p_dist = hamming_distance(key[1], p_hash)
+            if p_dist > self.max_distance:
+                continue
+            if best_dist is None or d_dist + p_dist < best_dist:
+                best_key, best_dist = key, d_dist + p_dist
+        return best_key
+
+    def lookup(self, fingerprint, owner=None):
+        """
+        近い画像のエントリ（コピー）を返す。なければ None。
+        answers には owner 自身の解答と、sha256 まで一致する他の人の解答だけを入れる。
+        """
+        with self._lock:
+            self._evict(time.time())
+            key = self._nearest(fingerprint)
+            if key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            entry = self._entries[key]
+            answers = {}
+            for answer_key, by_owner in entry["answers"].items():
+                if owner is not None and owner in by_owner:
+                    answers[answer_key] = by_owner[owner][1]
+                    continue
+                for digest, answer in by_owner.values():
+                    if digest == fingerprint[2]:
+                        answers[answer_key] = answer
+                        break
+            return {"hash": key, "transcription": entry["transcription"], "answers": answers}
+
+    def _entry_for(self, fingerprint):
+        key = self._nearest(fingerprint)
+        if key is None:
+            key = (fingerprint[0], fingerprint[1])
+            self._entries[key] = {"transcription": None, "answers": {}, "created_at": time.time(), "pending": False}
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def claim_transcription(self, fingerprint):
+        """読み取りジョブを1つだけ走らせるための予約。既に結果があるか実行中なら False"""
+        with self._lock:
+            entry = self._entry_for(fingerprint)
+            if entry["transcription"] or entry["pending"]:
+                return False
+            entry["pending"] = True
+            return True
+
+    def put_transcription(self, fingerprint, text):
+        with self._lock:
+            entry = self._entry_for(fingerprint)
+            entry["pending"] = False
+            if text:
+                entry["transcription"] = text
+            self._evict(time.time())
+
+    def put_answer(self, fingerprint, answer_key, answer, owner):
+        with self._lock:
+            entry = self._entry_for(fingerprint)
+            entry["answers"].setdefault(answer_key, {})[owner] = (fingerprint[2], answer)
+            self._evict(time.time())
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def transcribe_image_job(cache, fingerprint, model, blob, on_complete=None):
+    """
+    （バックグラウンドスレッド用）画像を文字起こししてキャッシュに入れる。
+    次回以降、同じ問題の写真は画像を送らずにこのテキストだけで済む。
+    on_complete(resp, error, wall_ms) を渡すと、終了時に計測用に呼ばれる。
+    """
+    text = None
+    resp = None
+    error = None
+    started = time.perf_counter()
+    try:
+        resp = model.generate_content([TRANSCRIBE_PROMPT, blob])
+        text = resp.text.strip() if resp and resp.text else None
+    except Exception as e:
+        error = e
+        print(f"Image transcription failed: {e}")
+    finally:
+        cache.put_transcription(fingerprint, text)
+        if on_complete:
+            on_complete(resp, error, int((time.perf_counter() - started) * 1000))
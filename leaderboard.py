@@ -0,0 +1,130 @@
+"""
+ランキング画面用のリーダーボード・スナップショット（全セッション共通のTTLキャッシュ）。
+
+ランキングの数字が変わるのは退室時（学習ログの書き込み時）だけなので、
+個人表の名簿とチーム表（日/週/月）を1回だけ計算してプロセス内で共有し、各閲覧者はメモリから描画する。
+退室処理で invalidate() され、別プロセスでの書き込みは TTL で追いつく。
+"""
+import datetime
+import threading
+import time
+
+from firebase_admin import firestore
+
+from study_rollups import load_team_ranking, load_user_ranking
+from study_stats import JST, PERIODS, bucket_key
+
+
+def compute_leaderboard(db, ranking_size=50, team_limit=20):
+    """
+    ロールアップ・上位ユーザー・チームを読み、ランキング表示用のスナップショットを作る。
+    - profiles: 個人表に載りうるユーザーの名前と匿名フラグ（順位そのものは rank_index から引く）
+    - teams   : 期間ごとのチーム表
+    「(あなた)」などの閲覧者ごとの表示は描画側で付ける。
+    """
+    started = time.perf_counter()
+    now = datetime.datetime.now(JST)
+
+    top_users = db.collection("users").order_by("totalStudyMinutes", direction=firestore.Query.DESCENDING).limit(ranking_size).stream()
+    user_map = {u.id: u.to_dict() for u in top_users}
+    # 期間ランキングの上位にいるが、累計トップ(user_map)にいないユーザーの名前を補完する
+    # （上位は期間ごとに minutes の降順で ranking_size 件だけ読む）
+    missing_uids = set()
+    for period in PERIODS:
+        period_top = load_user_ranking(db, period, now, ranking_size)
+        missing_uids.update(uid for uid, _ in period_top if uid and uid not in user_map)
+    if missing_uids:
+        missing_refs = [db.collection("users").document(uid) for uid in missing_uids]
+        for snap in db.get_all(missing_refs, field_paths=["name", "isAnonymousRanking", "teamId"]):
+            if snap.exists:
+                user_map[snap.id] = snap.to_dict()
+
+    # チームは期間ごとに並び済みのランキングを1クエリずつ読み、名前・人数だけ get_all で補う
+    team_rankings = {period: load_team_ranking(db, period, now, team_limit) for period in PERIODS}
+    team_ids = {team_id for ranking in team_rankings.values() for team_id, _ in ranking}
+    team_info = {}
+    if team_ids:
+        team_refs = [db.collection("teams").document(team_id) for team_id in team_ids]
+        for snap in db.get_all(team_refs, field_paths=["name", "members"]):
+            if snap.exists:
+                team_info[snap.id] = snap.to_dict()
+
+    teams = {}
+    for period in PERIODS:
+        teams[period] = [
+            {"name": team_info[team_id].get("name", "No Name"), "minutes": mins, "count": len(team_info[team_id].get("members", []))}
+            for team_id, mins in team_rankings[period] if team_id in team_info  # 解散したチームは除く
+        ]
+
+    return {
+        "profiles": {uid: {"name": info.get("name", "名無し"), "anonymous": info.get("isAnonymousRanking", False)}
+                     for uid, info in user_map.items()},
+        "teams": teams,
+        "day_bucket": bucket_key("day", now),
+        "computed_at": now,
+        "compute_ms": int((time.perf_counter() - started) * 1000),
+    }
+
+
+class LeaderboardCache:
+    """
+    プロセスに1つのスナップショットキャッシュ。
+    - ttl_seconds 経過・invalidate()・日付（JSTの日バケット）の切り替わりで作り直す
+    - 作り直しは同時に1つだけ（他の閲覧者はロックで待って同じ結果を使う）
+    - 計算に失敗したら、古いスナップショットがあればそれを返し続ける
+    """
+
+    def __init__(self, loader, ttl_seconds=60):
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self._snapshot = None
+        self._loaded_at = 0.0
+        self._version = 0  # invalidate() のたびに増える
+        self._loaded_version = -1
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.last_error = None
+
+    def _fresh(self):
+        if self._snapshot is None or self._loaded_version != self._version:
+            return False
+        if time.time() - self._loaded_at > self.ttl_seconds:
+            return False
+        return self._snapshot["day_bucket"] == bucket_key("day", datetime.datetime.now(JST))
+
+    def get(self):
+        if self._fresh():
+            self.hits += 1
+            return self._snapshot
+        with self._lock:
+            if self._fresh():  # 待っている間に他のセッションが作り直した
+                self.hits += 1
+                return self._snapshot
+            self.misses += 1
+            version = self._version
+            try:
+                snapshot = self.loader()
+            except Exception as e:
+                self.last_error = str(e)[:200]
+                if self._snapshot is not None:
+                    return self._snapshot
+                raise
+            self._snapshot = snapshot
+            self._loaded_at = time.time()
+            self._loaded_version = version
+            return snapshot
+
+    def invalidate(self):
+        """学習ログを書き込んだら呼ぶ（次の閲覧時に作り直す）"""
+        self._version += 1
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "computed_at": snapshot["computed_at"] if snapshot else None,
+            "compute_ms": snapshot["compute_ms"] if snapshot else None,
+            "last_error": self.last_error or "",
+        }
@@ -1,8 +1,24 @@
 import streamlit as st
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
+import time
+import uuid
 from PIL import Image
 from streamlit_drawable_canvas import st_canvas
 
+from model_runtime import GenerativeModelCache, bind_client # ★追加: モデルの使い回し
+from model_runtime import build_call_metric, usage_to_dict # ★追加: 呼び出しごとの計測
+from chat_context import build_windowed_history, build_summary_prompt, new_context_state # ★追加: トークン予算つき会話ウィンドウ
+from image_pipeline import preprocess_image, format_image_stats # ★追加: アップロード画像の前処理
+from image_pipeline import image_fingerprint, ImageTranscriptionCache, transcribe_image_job # ★追加: 同じ写真の読み取り結果キャッシュ
+from concurrent.futures import ThreadPoolExecutor
+
+# AIに送る会話履歴のトークン予算（超えた古い発言は要約に畳み込む）
+CONTEXT_TOKEN_BUDGET = 6000
+# 「同じ写真」とみなす知覚ハッシュのハミング距離（0〜2。小さいほど厳密）
+IMAGE_CACHE_MAX_DISTANCE = 2
+CACHED_ANSWER_NOTE = "\n\n（※以前に確認した同じ問題の解答を表示しています）"
+
 # --- 0. 状態リセット処理（ここが最重要！）---
 # 画面が描画される前に、入力モードのリセット予約があるかチェックします
 if "force_reset_to_text" in st.session_state and st.session_state["force_reset_to_text"]:
@@ -18,6 +34,14 @@ st.caption("Gemini 2.5 Flash 搭載。送信すると自動でテキスト入力
 # --- 2. 会話履歴の保存場所 ---
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "chat_context" not in st.session_state:
+    st.session_state.chat_context = new_context_state()
+if "image_stats_log" not in st.session_state:
+    st.session_state.image_stats_log = []
+if "call_metrics" not in st.session_state:
+    st.session_state.call_metrics = [] # Gemini 呼び出しごとのトークン数・遅延・コスト
+if "cache_owner" not in st.session_state:
+    st.session_state.cache_owner = uuid.uuid4().hex # 解答キャッシュの持ち主（ログインが無いのでセッション単位）
 
 # 各種リセット用キー
 if "uploader_key" not in st.session_state:
@@ -214,6 +238,7 @@ with st.sidebar:
     # 共通：手動リセットボタン
     if st.button("🗑️ 会話をリセット", type="primary"):
         st.session_state.messages = []
+        st.session_state.chat_context = new_context_state()
         st.rerun()
 
 # --- 4. モードごとのプロンプト定義 ---
@@ -256,12 +281,48 @@ elif mode == "⚔️ 演習モード":
     """
 
 # --- 5. モデルのセットアップ ---
+@st.cache_resource(max_entries=32)
+def get_model_cache(api_key):
+    """
+    APIキーごとの構築済みGenerativeModelのキャッシュ（モード毎のプロンプトでキーが分かれる）。
+    APIキーは利用者が入力するので genai.configure（プロセス全体で1つ）は使わず、そのキー専用のクライアントで送る
+    """
+    client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    return GenerativeModelCache(
+        lambda name, instruction, config: bind_client(
+            genai.GenerativeModel(name, system_instruction=instruction, generation_config=config), client)
+    )
+
+@st.cache_resource
+def get_image_cache():
+    """同じ問題の写真の読み取り結果・解答を共有するキャッシュ（プロセスに1つ）"""
+    return ImageTranscriptionCache(max_distance=IMAGE_CACHE_MAX_DISTANCE)
+
+@st.cache_resource
+def get_background_executor():
+    """画像の文字起こしを裏で走らせるスレッドプール（プロセスに1つ）"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="transcribe")
+
 if api_key:
-    genai.configure(api_key=api_key)
     try:
         target_model_name = "gemini-2.5-flash"
-        model = genai.GenerativeModel(target_model_name, system_instruction=system_instruction)
+        model = get_model_cache(api_key).get(target_model_name, system_instruction)
         st.sidebar.caption(f"Active Model: `{target_model_name}`")
+        if st.session_state.image_stats_log:
+            with st.sidebar.expander("📷 画像の前処理ログ"):
+                for line in reversed(st.session_state.image_stats_log[-10:]):
+                    st.caption(line)
+        if st.session_state.call_metrics:
+            with st.sidebar.expander("📊 このセッションのAI呼び出し"):
+                call_metrics = list(st.session_state.call_metrics)
+                total_tokens = sum(m["total_tokens"] for m in call_metrics)
+                total_cost = sum(m["cost_usd"] for m in call_metrics)
+                ttfts = sorted(m["ttft_ms"] for m in call_metrics if m["ttft_ms"] is not None)
+                st.caption(f"呼び出し {len(call_metrics)}回 / {total_tokens:,} トークン / 約 ${total_cost:.4f}")
+                if ttfts:
+                    st.caption(f"最初の文字まで 中央値 {ttfts[len(ttfts) // 2]}ms / 最大 {ttfts[-1]}ms")
+                for m in reversed(call_metrics[-5:]):
+                    st.caption(f"{m['purpose']}: {m['outcome']} 入力{m['prompt_tokens']} / 出力{m['candidate_tokens']} tok, {m['wall_ms']}ms")
     except Exception as e:
         st.error(f"モデル設定エラー: {e}")
         st.stop()
@@ -282,41 +343,107 @@ for message in st.session_state.messages:
 if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
     if not api_key: st.stop()
     
+    current_msg = st.session_state.messages[-1]["content"]
+    image_hash = current_msg.get("image_hash") if isinstance(current_msg, dict) else None
+    answer_key = f"{mode}:{current_msg.get('text', '')}" if isinstance(current_msg, dict) else None
+    cache_entry = get_image_cache().lookup(image_hash, st.session_state.cache_owner) if image_hash is not None else None
+
+    # ★追加: 解答確認モードで同じ問題の写真が再送された場合は、AIを呼ばずに前回の解答を返す
+    # （他のセッションの解答は、バイト列まで同じ画像の時だけ使う）
+    if mode == "⚡ 解答確認モード" and cache_entry and answer_key in cache_entry["answers"]:
+        st.session_state.messages.append({"role": "model", "content": cache_entry["answers"][answer_key] + CACHED_ANSWER_NOTE})
+        if st.session_state.image_stats_log:
+            st.session_state.image_stats_log[-1] += " / 解答キャッシュ利用（AI呼び出しなし）"
+        st.rerun()
+
     with st.chat_message("assistant"):
         response_placeholder = st.empty()
         full_response = ""
+        call_started = time.perf_counter()
         try:
-            history_for_ai = []
-            for m in st.session_state.messages[:-1]:
-                if m["role"] != "system":
-                    text_content = ""
-                    if isinstance(m["content"], dict):
-                        text_content = m["content"].get("text", "")
-                    else:
-                        text_content = str(m["content"])
-                    history_for_ai.append({"role": m["role"], "parts": [text_content]})
+            # ★変更: 全履歴を毎回送らず、トークン予算を超えた古い発言は要約に畳み込む
+            def summarize_conversation(previous_summary, folded_messages):
+                summary_model = get_model_cache(api_key).get(target_model_name, None)
+                summary_started = time.perf_counter()
+                summary_resp = summary_model.generate_content(build_summary_prompt(previous_summary, folded_messages))
+                summary_ms = int((time.perf_counter() - summary_started) * 1000)
+                st.session_state.call_metrics.append(build_call_metric(
+                    "context_summary", target_model_name, "success", summary_ms, ttft_ms=summary_ms,
+                    usage=usage_to_dict(getattr(summary_resp, "usage_metadata", None)),
+                ))
+                return summary_resp.text.strip()
+
+            past_messages = [m for m in st.session_state.messages[:-1] if m["role"] != "system"]
+            history_for_ai, st.session_state.chat_context, _ = build_windowed_history(
+                past_messages,
+                system_instruction,
+                st.session_state.chat_context,
+                summarize_conversation,
+                budget_tokens=CONTEXT_TOKEN_BUDGET,
+            )
 
             chat = model.start_chat(history=history_for_ai)
             
-            current_msg = st.session_state.messages[-1]["content"]
             content_to_send = []
+            cached_transcription = cache_entry["transcription"] if cache_entry else None
             
             if isinstance(current_msg, dict):
                 if "text" in current_msg: content_to_send.append(current_msg["text"])
-                if "image" in current_msg: content_to_send.append(current_msg["image"])
+                if cached_transcription:
+                    # 同じ写真は読み取り済みのテキストだけを送る（画像の送信を省く）
+                    content_to_send.append(f"【送信された画像の内容（読み取り済み）】\n{cached_transcription}")
+                elif "image_blob" in current_msg: content_to_send.append(current_msg["image_blob"])
+                elif "image" in current_msg: content_to_send.append(current_msg["image"])
             else:
                 content_to_send.append(current_msg)
 
+            send_started = time.perf_counter()
+            first_chunk_ms = None
             response = chat.send_message(content_to_send, stream=True)
             
             for chunk in response:
                 if chunk.text:
+                    if first_chunk_ms is None:
+                        first_chunk_ms = int((time.perf_counter() - send_started) * 1000)
                     full_response += chunk.text
                     response_placeholder.markdown(full_response)
+
+            st.session_state.call_metrics.append(build_call_metric(
+                "chat", target_model_name, "success", int((time.perf_counter() - send_started) * 1000), first_chunk_ms,
+                usage=usage_to_dict(getattr(response, "usage_metadata", None)),
+            ))
+
+            if isinstance(current_msg, dict) and "image_blob" in current_msg and st.session_state.image_stats_log:
+                if cached_transcription:
+                    st.session_state.image_stats_log[-1] += " / 読み取り済みテキストを再利用"
+                st.session_state.image_stats_log[-1] += f" / 送信〜最初の文字 {first_chunk_ms}ms（モデルの処理込み）"
+
+            if image_hash is not None:
+                image_cache = get_image_cache()
+                if mode == "⚡ 解答確認モード" and full_response:
+                    image_cache.put_answer(image_hash, answer_key, full_response, st.session_state.cache_owner)
+                if not cached_transcription and image_cache.claim_transcription(image_hash):
+                    # 次回以降のために、画像の文字起こしを裏で作っておく
+                    # （ワーカースレッドは session_state に触れないため、記録先のリストをここで渡す）
+                    record_metric = st.session_state.call_metrics.append
+                    def on_transcribed(resp, error, wall_ms):
+                        record_metric(build_call_metric(
+                            "image_transcription", target_model_name, "error" if error else "success", wall_ms,
+                            ttft_ms=wall_ms, error=error, usage=usage_to_dict(getattr(resp, "usage_metadata", None)),
+                        ))
+                    get_background_executor().submit(
+                        transcribe_image_job, image_cache, image_hash,
+                        get_model_cache(api_key).get(target_model_name, None),
+                        current_msg["image_blob"], on_transcribed
+                    )
             
             st.session_state.messages.append({"role": "model", "content": full_response})
             st.rerun()
         except Exception as e:
+            st.session_state.call_metrics.append(build_call_metric(
+                "chat", target_model_name, "partial" if full_response else "error",
+                int((time.perf_counter() - call_started) * 1000), error=e,
+            ))
             st.error(f"エラー: {e}")
 
 # --- 8. 入力エリア ---
@@ -364,12 +491,14 @@ if not (st.session_state.messages and st.session_state.messages[-1]["role"] == "
         
         if st.button("画像で送信", type="primary"):
             if img_file:
-                image_data = Image.open(img_file)
+                # ★変更: 向き補正・縮小・モノクロ補正・JPEG再エンコードしてから送る
+                image_data, image_blob, image_stats = preprocess_image(img_file)
+                st.session_state.image_stats_log.append(format_image_stats(image_stats))
                 text_part = img_text if img_text else "この画像の数学の問題を解いてください。"
                 if mode == "⚔️ 演習モード":
                     text_part = f"【生徒の画像解答】\n{text_part}\n\n※採点してください。"
                 
-                content_to_save = {"image": image_data, "text": text_part}
+                content_to_save = {"image": image_data, "image_blob": image_blob, "image_hash": image_fingerprint(image_data, image_blob["data"]), "text": text_part}
                 st.session_state.messages.append({"role": "user", "content": content_to_save})
                 
                 # ★修正：状態リセットを予約して、テキストモードへの強制リセットも予約
@@ -401,8 +530,12 @@ if not (st.session_state.messages and st.session_state.messages[-1]["role"] == "
                 background = Image.new("RGB", pil_image.size, (255, 255, 255))
                 background.paste(pil_image, mask=pil_image.split()[3])
                 
+                # 手書きは白背景の線画なので、モノクロ化して小さくしてから送る
+                hw_image, hw_blob, hw_stats = preprocess_image(background, worksheet_mode=True)
+                st.session_state.image_stats_log.append(format_image_stats(hw_stats))
                 content_to_save = {
-                    "image": background,
+                    "image": hw_image,
+                    "image_blob": hw_blob,
                     "text": "【生徒の手書き入力】\nこの手書きの数式・図形を読み取って回答してください。"
                 }
                 if mode == "⚔️ 演習モード":
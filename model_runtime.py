@@ -0,0 +1,414 @@
+"""
+Geminiモデル呼び出しの共通ランタイム。
+
+Streamlitの再実行（rerun）やセッションをまたいで共有したい状態をここに置く。
+app.py 側では st.cache_resource 経由で1プロセスに1つだけ生成して使う。
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+# =========================================================
+# サーキットブレーカー & モデル稼働状況レジストリ
+# =========================================================
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+
+def _percentile(values, pct):
+    """ソート済みでないリストから百分位値を返す（空ならNone）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round((pct / 100.0) * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+class ModelCircuitBreaker:
+    """
+    1モデル分のサーキットブレーカー。
+
+    - closed   : 通常状態。直近ウィンドウの失敗率・連続失敗・遅延率を監視する
+    - open     : 呼び出しを遮断。クールダウン経過後に half_open へ
+    - half_open: 試験的に1リクエストだけ通し、成功なら closed、失敗なら再度 open（クールダウン倍増）
+    """
+
+    def __init__(self, model_name, window_seconds=300, min_calls=4,
+                 failure_rate_threshold=0.5, consecutive_failure_threshold=3,
+                 slow_call_ms=20000, slow_call_rate_threshold=0.8,
+                 open_seconds=60, max_open_seconds=900, probe_timeout_seconds=120):
+        self.model_name = model_name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.consecutive_failure_threshold = consecutive_failure_threshold
+        self.slow_call_ms = slow_call_ms
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.probe_timeout_seconds = probe_timeout_seconds
+
+        self.state = BREAKER_CLOSED
+        self.open_seconds = open_seconds
+        self.opened_at = None
+        self.probe_started_at = None
+        self.consecutive_failures = 0
+        self.last_error = None
+        self._events = deque()  # (timestamp, ok, latency_ms)
+
+    def _trim(self, now):
+        while self._events and now - self._events[0][0] > self.window_seconds:
+            self._events.popleft()
+
+    def allow_request(self, now=None):
+        """このモデルに今リクエストを送ってよいか（half_open では試験呼び出しを1つだけ許可）"""
+        now = now or time.time()
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_OPEN:
+            if now - self.opened_at < self.open_seconds:
+                return False
+            self.state = BREAKER_HALF_OPEN
+            self.probe_started_at = None
+        # half_open
+        if self.probe_started_at is None or now - self.probe_started_at > self.probe_timeout_seconds:
+            self.probe_started_at = now
+            return True
+        return False
+
+    def is_available(self, now=None):
+        """allow_request と同じ判定を状態を変えずに行う（候補の列挙用）"""
+        now = now or time.time()
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_OPEN:
+            return now - self.opened_at >= self.open_seconds
+        return self.probe_started_at is None or now - self.probe_started_at > self.probe_timeout_seconds
+
+    def record_success(self, latency_ms=None, now=None):
+        now = now or time.time()
+        self._events.append((now, True, latency_ms))
+        self._trim(now)
+        self.consecutive_failures = 0
+        if self.state != BREAKER_CLOSED:
+            # 復帰時は遮断前の失敗履歴を持ち越さない（直後の1失敗で再遮断されるのを防ぐ）
+            self._events = deque([(now, True, latency_ms)])
+            self.state = BREAKER_CLOSED
+            self.open_seconds = self.base_open_seconds
+            self.opened_at = None
+            self.probe_started_at = None
+            return
+        if self._slow_rate_exceeded():
+            self._trip(now, "応答遅延が閾値を超えています")
+
+    def record_failure(self, error=None, latency_ms=None, now=None):
+        now = now or time.time()
+        self._events.append((now, False, latency_ms))
+        self._trim(now)
+        self.consecutive_failures += 1
+        if error is not None:
+            self.last_error = str(error)[:200]
+
+        if self.state == BREAKER_HALF_OPEN:
+            # 試験呼び出しが失敗したらクールダウンを延ばして再遮断
+            self.open_seconds = min(self.open_seconds * 2, self.max_open_seconds)
+            self._trip(now, self.last_error)
+            return
+        if self.state == BREAKER_CLOSED:
+            if self.consecutive_failures >= self.consecutive_failure_threshold:
+                self._trip(now, self.last_error)
+            elif len(self._events) >= self.min_calls and self.failure_rate() >= self.failure_rate_threshold:
+                self._trip(now, self.last_error)
+
+    def _trip(self, now, reason):
+        self.state = BREAKER_OPEN
+        self.opened_at = now
+        self.probe_started_at = None
+        if reason:
+            self.last_error = reason
+
+    def _slow_rate_exceeded(self):
+        latencies = [lat for _, ok, lat in self._events if ok and lat is not None]
+        if len(latencies) < self.min_calls:
+            return False
+        slow = sum(1 for lat in latencies if lat >= self.slow_call_ms)
+        return slow / len(latencies) >= self.slow_call_rate_threshold
+
+    def failure_rate(self):
+        if not self._events:
+            return 0.0
+        failures = sum(1 for _, ok, _ in self._events if not ok)
+        return failures / len(self._events)
+
+    def latency_percentile(self, pct):
+        """成功した呼び出しの遅延(ms)の百分位値"""
+        return _percentile([lat for _, ok, lat in self._events if ok and lat is not None], pct)
+
+    def retry_after_seconds(self, now=None):
+        now = now or time.time()
+        if self.state != BREAKER_OPEN:
+            return 0
+        return max(0, int(self.open_seconds - (now - self.opened_at)))
+
+    def snapshot(self, now=None):
+        now = now or time.time()
+        self._trim(now)
+        return {
+            "model": self.model_name,
+            "state": self.state,
+            "calls": len(self._events),
+            "failure_rate": round(self.failure_rate(), 2),
+            "p50_ms": self.latency_percentile(50),
+            "p95_ms": self.latency_percentile(95),
+            "retry_after_s": self.retry_after_seconds(now),
+            "last_error": self.last_error or "",
+        }
+
+
+class ModelHealthRegistry:
+    """プロセス全体で共有するモデルごとのサーキットブレーカー集"""
+
+    def __init__(self, **breaker_options):
+        self._breaker_options = breaker_options
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _get(self, model_name):
+        breaker = self._breakers.get(model_name)
+        if breaker is None:
+            breaker = ModelCircuitBreaker(model_name, **self._breaker_options)
+            self._breakers[model_name] = breaker
+        return breaker
+
+    def allow_request(self, model_name):
+        with self._lock:
+            return self._get(model_name).allow_request()
+
+    def is_available(self, model_name):
+        with self._lock:
+            return self._get(model_name).is_available()
+
+    def healthy_models(self, priority_models):
+        """
+        優先順リストのうち、今リクエストを送れる見込みのモデルだけを返す。
+        実際に送る直前には allow_request で half_open の試験枠を確保すること。
+        全モデルが遮断中の場合は、最も早く復帰するモデルを1つだけ返す（全滅で回答不能になるのを避ける）。
+        """
+        with self._lock:
+            now = time.time()
+            candidates = [m for m in priority_models if self._get(m).is_available(now)]
+            if candidates or not priority_models:
+                return candidates
+            return [min(priority_models, key=lambda m: self._get(m).retry_after_seconds(now))]
+
+    def record_success(self, model_name, latency_ms=None):
+        with self._lock:
+            self._get(model_name).record_success(latency_ms)
+
+    def record_failure(self, model_name, error=None, latency_ms=None):
+        with self._lock:
+            self._get(model_name).record_failure(error, latency_ms)
+
+    def latency_percentile(self, model_name, pct):
+        with self._lock:
+            return self._get(model_name).latency_percentile(pct)
+
+    def snapshot(self, priority_models):
+        """管理画面表示用。優先順に並べた各モデルの状態"""
+        with self._lock:
+            now = time.time()
+            return [self._get(m).snapshot(now) for m in priority_models]
+
+
+# =========================================================
+# ヘッジ（競争）リクエスト用のストリーム受信ワーカー
+# =========================================================
+
+def run_stream_worker(model, history, inputs, events, tag, cancel_event):
+    """
+    別スレッドで stream=True の応答を受信し、(tag, 種別, 値, 受信時刻) を events キューに流す。
+    種別: "chunk"(テキスト断片) / "done"(正常終了。値はトークン使用量) / "error"(例外)
+    cancel_event が立ったら（競争に負けたら）受信を打ち切る。
+    ※ワーカースレッドからは Streamlit の描画や session_state に触れないこと。
+    """
+    try:
+        chat = model.start_chat(history=history)
+        response = chat.send_message(inputs, stream=True)
+        for chunk in response:
+            if cancel_event.is_set():
+                return
+            try:
+                chunk_text = chunk.text or ""
+            except ValueError:
+                chunk_text = ""
+            if chunk_text:
+                events.put((tag, "chunk", chunk_text, time.perf_counter()))
+        events.put((tag, "done", usage_to_dict(getattr(response, "usage_metadata", None)), time.perf_counter()))
+    except Exception as e:
+        if not cancel_event.is_set():
+            events.put((tag, "error", e, time.perf_counter()))
+
+
+def hedge_deadline_ms(registry, model_name, percentile=95, min_ms=1500, max_ms=8000, default_ms=4000):
+    """主モデルの最初の文字までの遅延の pXX からヘッジ発動までの待ち時間を決める"""
+    observed = registry.latency_percentile(model_name, percentile)
+    if observed is None:
+        return default_ms
+    return int(min(max_ms, max(min_ms, observed)))
+
+
+# =========================================================
+# GenerativeModel キャッシュ & genai 設定の一元化
+# =========================================================
+
+_configure_lock = threading.Lock()
+_configured_api_key = None
+
+
+def ensure_genai_configured(genai_module, api_key):
+    """genai.configure をプロセス内でキーが変わったときだけ呼ぶ（毎ターンの再設定を省く）"""
+    global _configured_api_key
+    if _configured_api_key == api_key:
+        return
+    with _configure_lock:
+        if _configured_api_key != api_key:
+            genai_module.configure(api_key=api_key)
+            _configured_api_key = api_key
+
+
+def bind_client(model, client):
+    """
+    GenerativeModel が送信に使うクライアントを固定する。
+    固定しないと最初の呼び出し時にプロセス全体の既定クライアント（最後に genai.configure したキー）を掴むので、
+    利用者ごとに APIキーが違う場合はキー専用のクライアントを渡すこと。
+    """
+    model._client = client
+    return model
+
+
+def instruction_hash(system_instruction):
+    """システムプロンプトのハッシュ（キャッシュキー用。None は空文字扱い）"""
+    return hashlib.sha256((system_instruction or "").encode("utf-8")).hexdigest()[:16]
+
+
+def _config_key(generation_config):
+    if not generation_config:
+        return ""
+    return json.dumps(generation_config, sort_keys=True, default=str)
+
+
+class GenerativeModelCache:
+    """
+    (モデル名, システムプロンプトのハッシュ, generation_config) をキーに
+    構築済みの GenerativeModel を全セッションで使い回す LRU キャッシュ。
+    factory(model_name, system_instruction, generation_config) でモデルを生成する。
+    """
+
+    def __init__(self, factory, max_entries=256):
+        self._factory = factory
+        self._max_entries = max_entries
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model_name, system_instruction=None, generation_config=None, namespace=""):
+        key = (namespace, model_name, instruction_hash(system_instruction), _config_key(generation_config))
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return model
+            self.misses += 1
+
+        model = self._factory(model_name, system_instruction, generation_config)
+        with self._lock:
+            self._models[key] = model
+            self._models.move_to_end(key)
+            while len(self._models) > self._max_entries:
+                self._models.popitem(last=False)
+        return model
+
+    def evict_instruction(self, system_instruction):
+        """指定したシステムプロンプトで作られたモデルを全て破棄する（生徒の名前変更時など）"""
+        target = instruction_hash(system_instruction)
+        with self._lock:
+            stale = [k for k in self._models if k[2] == target]
+            for k in stale:
+                del self._models[k]
+        return len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._models), "hits": self.hits, "misses": self.misses}
+
+
+# =========================================================
+# 呼び出しごとの計測（トークン・遅延・コスト）
+# =========================================================
+
+# USD / 100万トークン（input, output）。キャッシュ済み入力は input の CACHED_INPUT_RATE 倍で計算
+MODEL_PRICING = {
+    "gemini-3-flash-preview": (0.50, 3.00),
+    "gemini-3-pro-preview": (2.00, 12.00),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.0-flash-exp": (0.10, 0.40),
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-1.5-pro": (1.25, 5.00),
+}
+DEFAULT_PRICING = (0.50, 3.00)
+CACHED_INPUT_RATE = 0.25
+
+
+def usage_to_dict(usage_metadata):
+    """response.usage_metadata を保存しやすい dict にする（取れなければ全て0）"""
+    def _get(name):
+        try:
+            return int(getattr(usage_metadata, name, 0) or 0)
+        except (TypeError, ValueError):
+            return 0
+    return {
+        "prompt_tokens": _get("prompt_token_count"),
+        "candidate_tokens": _get("candidates_token_count"),
+        "cached_tokens": _get("cached_content_token_count"),
+        "total_tokens": _get("total_token_count"),
+    }
+
+
+def call_cost_usd(model_name, usage):
+    """実際のトークン使用量からコスト(USD)を計算する"""
+    input_price, output_price = MODEL_PRICING.get(model_name, DEFAULT_PRICING)
+    cached = usage.get("cached_tokens", 0)
+    uncached_prompt = max(0, usage.get("prompt_tokens", 0) - cached)
+    return (
+        uncached_prompt * input_price
+        + cached * input_price * CACHED_INPUT_RATE
+        + usage.get("candidate_tokens", 0) * output_price
+    ) / 1_000_000
+
+
+def build_call_metric(purpose, model_name, outcome, wall_ms, ttft_ms=None, retry_count=0, usage=None, error=None, **extra):
+    """
+    Gemini 呼び出し1回分の計測レコード。
+    outcome: "success" / "partial"(途中で切断) / "error" / "cancelled"(ヘッジで負けた) / "cache_hit"
+    """
+    usage = usage or usage_to_dict(None)
+    metric = {
+        "purpose": purpose,
+        "model": model_name,
+        "outcome": outcome,
+        "wall_ms": wall_ms,
+        "ttft_ms": ttft_ms,
+        "retry_count": retry_count,
+        "cost_usd": call_cost_usd(model_name, usage),
+        "error": str(error)[:200] if error else None,
+    }
+    metric.update(usage)
+    metric.update(extra)
+    return metric
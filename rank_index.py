@@ -0,0 +1,257 @@
+"""
+期間ごとの順位インデックス（インデックス付きスキップリスト）。
+
+ランキング（日/週/月）を全ユーザー分メモリ上の順序付き構造で持ち、
+上位K件・任意ユーザーの正確な順位・前後のユーザーを O(log n) で返す。
+起動時（と一定間隔・日付の切り替わり時）にロールアップ3ドキュメントから作り直し、
+このプロセスでの退室は add_minutes() でその場で反映する。ポータルの毎回の描画で呼んでも Firestore の読み込みは発生しない。
+"""
+import datetime
+import random
+import threading
+import time
+
+from study_stats import JST, PERIODS, bucket_key
+
+_MAX_LEVEL = 24  # 2^24 ≒ 1600万件まで O(log n) を保てる
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        self.width = [1] * level  # 各レベルで次のノードまでに飛ばす要素数
+
+
+class IndexableSkipList:
+    """キーの昇順に並ぶスキップリスト。挿入・削除・順位・k番目の取得がすべて期待 O(log n)"""
+
+    def __init__(self, seed=None):
+        self._head = _Node(None, _MAX_LEVEL)
+        self._size = 0
+        self._level = 1
+        self._rng = random.Random(seed)
+
+    def __len__(self):
+        return self._size
+
+    def _random_level(self):
+        level = 1
+        while level < _MAX_LEVEL and self._rng.random() < 0.5:
+            level += 1
+        return level
+
+    def insert(self, key):
+        update = [self._head] * _MAX_LEVEL
+        steps = [0] * _MAX_LEVEL  # 各レベルで update[i] までに進んだ位置
+        node, pos = self._head, 0
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                pos += node.width[i]
+                node = node.next[i]
+            update[i], steps[i] = node, pos
+
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                update[i], steps[i] = self._head, 0
+                self._head.width[i] = self._size + 1
+            self._level = level
+
+        new_node = _Node(key, level)
+        for i in range(level):
+            prev = update[i]
+            new_node.next[i] = prev.next[i]
+            prev.next[i] = new_node
+            offset = pos - steps[i]  # prev から新ノード直前までの距離
+            new_node.width[i] = prev.width[i] - offset
+            prev.width[i] = offset + 1
+        for i in range(level, self._level):
+            update[i].width[i] += 1
+        self._size += 1
+
+    def remove(self, key):
+        update = [None] * _MAX_LEVEL
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                node = node.next[i]
+            update[i] = node
+        target = node.next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        for i in range(self._level):
+            if update[i].next[i] is target:
+                update[i].next[i] = target.next[i]
+                update[i].width[i] += target.width[i] - 1
+            else:
+                update[i].width[i] -= 1
+        self._size -= 1
+
+    def bisect_left(self, key):
+        """key より小さいキーの個数"""
+        node, pos = self._head, 0
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                pos += node.width[i]
+                node = node.next[i]
+        return pos
+
+    def index(self, key):
+        """key の0始まりの位置（無ければ KeyError）"""
+        pos = self.bisect_left(key)
+        if pos >= self._size or self[pos] != key:
+            raise KeyError(key)
+        return pos
+
+    def __getitem__(self, index):
+        """0始まりで index 番目のキー"""
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError(index)
+        node, remaining = self._head, index + 1
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.width[i] <= remaining:
+                remaining -= node.width[i]
+                node = node.next[i]
+        return node.key
+
+    def slice(self, start, stop):
+        """start〜stop-1 番目のキー（先頭だけ O(log n) で探し、あとは最下段を辿る）"""
+        start, stop = max(0, start), min(stop, self._size)
+        if start >= stop:
+            return []
+        keys = [self[start]]
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key < keys[0]:
+                node = node.next[i]
+        node = node.next[0].next[0]
+        while node is not None and len(keys) < stop - start:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class StudyRankIndex:
+    """
+    日/週/月それぞれの {uid: 分} と順位インデックス。並びは「分の多い順 → uid 順」。
+    loader() は study_rollups.load_rollups と同じ形（{period: {"users": {uid: 分}}}）を返す関数。
+    refresh_seconds ごと・日付が変わった時に loader から作り直す（他プロセスでの退室を取り込むため）。
+    """
+
+    def __init__(self, loader, refresh_seconds=300):
+        self.loader = loader
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._scores = {}
+        self._lists = {}
+        self._day_bucket = None
+        self._loaded_at = 0.0
+        self.rebuilds = 0
+        self.last_rebuild_ms = None
+
+    @staticmethod
+    def _key(uid, minutes):
+        return (-minutes, uid)
+
+    def _rebuild_locked(self):
+        started = time.perf_counter()
+        now = datetime.datetime.now(JST)
+        rollups = self.loader()
+        scores, lists = {}, {}
+        for period in PERIODS:
+            users = {uid: int(m) for uid, m in rollups.get(period, {}).get("users", {}).items() if m}
+            skiplist = IndexableSkipList()
+            for uid, minutes in users.items():
+                skiplist.insert(self._key(uid, minutes))
+            scores[period], lists[period] = users, skiplist
+        self._scores, self._lists = scores, lists
+        self._day_bucket = bucket_key("day", now)
+        self._loaded_at = time.time()
+        self.rebuilds += 1
+        self.last_rebuild_ms = int((time.perf_counter() - started) * 1000)
+
+    def _ensure_fresh_locked(self):
+        stale = time.time() - self._loaded_at > self.refresh_seconds
+        if not self._lists or stale or self._day_bucket != bucket_key("day", datetime.datetime.now(JST)):
+            self._rebuild_locked()
+
+    def rebuild(self):
+        with self._lock:
+            self._rebuild_locked()
+
+    def add_minutes(self, uid, minutes, dt=None):
+        """退室で記録した分を全期間に加算する（ロールアップへの Increment と同じ内容をメモリにも反映）"""
+        with self._lock:
+            if not self._lists:
+                return  # まだ一度も読んでいない → 次の参照時にロールアップから作るので加算不要
+            dt = dt or datetime.datetime.now(JST)
+            if bucket_key("day", dt) != self._day_bucket:
+                return  # 日付をまたいだ記録は次の作り直しに任せる
+            for period in PERIODS:
+                old = self._scores[period].get(uid)
+                if old is not None:
+                    self._lists[period].remove(self._key(uid, old))
+                new = (old or 0) + minutes
+                self._scores[period][uid] = new
+                self._lists[period].insert(self._key(uid, new))
+
+    def top(self, period, k):
+        """上位 k 件の [(順位, uid, 分)]（同じ分数は同順位）"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            keys = self._lists[period].slice(0, k)
+            return self._with_ranks_locked(period, keys, 0)
+
+    def rank_of(self, period, uid):
+        """(順位, 分, 人数)。記録が無ければ (None, 0, 人数)"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            skiplist = self._lists[period]
+            minutes = self._scores[period].get(uid)
+            if minutes is None:
+                return None, 0, len(skiplist)
+            return self._competition_rank_locked(period, minutes), minutes, len(skiplist)
+
+    def neighbours(self, period, uid, span=2):
+        """自分の前後 span 人ずつの [(順位, uid, 分)]（記録が無ければ空）"""
+        with self._lock:
+            self._ensure_fresh_locked()
+            minutes = self._scores[period].get(uid)
+            if minutes is None:
+                return []
+            skiplist = self._lists[period]
+            pos = skiplist.index(self._key(uid, minutes))
+            start = max(0, pos - span)
+            return self._with_ranks_locked(period, skiplist.slice(start, pos + span + 1), start)
+
+    def _competition_rank_locked(self, period, minutes):
+        """自分より分数の多い人数 + 1（同じ分数の先頭の位置を探す）"""
+        return self._lists[period].bisect_left((-minutes, "")) + 1
+
+    def _with_ranks_locked(self, period, keys, start):
+        rows = []
+        prev_minutes, prev_rank = None, None
+        for offset, (neg_minutes, uid) in enumerate(keys):
+            minutes = -neg_minutes
+            if minutes == prev_minutes:
+                rank = prev_rank
+            elif offset == 0 and start > 0:
+                rank = self._competition_rank_locked(period, minutes)
+            else:
+                rank = start + offset + 1
+            rows.append((rank, uid, minutes))
+            prev_minutes, prev_rank = minutes, rank
+        return rows
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": {period: len(lst) for period, lst in self._lists.items()},
+                "rebuilds": self.rebuilds,
+                "last_rebuild_ms": self.last_rebuild_ms,
+            }
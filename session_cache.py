@@ -0,0 +1,102 @@
+"""
+ログイン中ユーザーのプロフィール（users/{uid}）と、進行中の入室記録（attendance_logs の status == "active"）の
+セッション単位のキャッシュ。
+
+読み込みはリードスルー（初回と max_age_seconds ごとだけ Firestore を読む）、
+このセッションでの名前変更・チーム参加・入退室などはライトスルー（書き込みと同時に手元の値も更新）にして、
+ページを移動しても何も変わっていなければ Firestore を読まない。
+他の端末での変更は max_age_seconds 以内に取り込まれる。
+Streamlit には依存しない（st.session_state に1つ置いて使う）。
+"""
+import copy
+import datetime
+import time
+
+from firebase_admin import firestore
+
+_UNSET = object()
+
+
+class UserSessionCache:
+    def __init__(self, user_ref, email, max_age_seconds=300):
+        self.user_ref = user_ref
+        self.email = email
+        self.max_age_seconds = max_age_seconds
+        self._profile = None
+        self._profile_at = 0.0
+        self._attendance = _UNSET  # None は「進行中の入室記録なし」
+        self._attendance_at = 0.0
+        self.reads = 0
+        self.hits = 0
+
+    def _fresh(self, loaded_at):
+        return time.time() - loaded_at <= self.max_age_seconds
+
+    # --- プロフィール ---
+    def profile(self):
+        """users/{uid} の内容（無ければ作る）。戻り値はコピーなので書き換えても良い"""
+        if self._profile is not None and self._fresh(self._profile_at):
+            self.hits += 1
+            return copy.copy(self._profile)
+        snap = self.user_ref.get()
+        self.reads += 1
+        if snap.exists:
+            self._profile = snap.to_dict() or {}
+        else:
+            self.user_ref.set({"email": self.email, "created_at": firestore.SERVER_TIMESTAMP})
+            self._profile = {"email": self.email}
+        self._profile_at = time.time()
+        return copy.copy(self._profile)
+
+    def apply_profile(self, fields):
+        """他の経路（バッチ・トランザクション）で書いた内容を手元にも反映する（DELETE_FIELD は削除、Increment は加算）"""
+        if self._profile is None:
+            return
+        for key, value in fields.items():
+            if value is firestore.DELETE_FIELD:
+                self._profile.pop(key, None)
+            elif isinstance(value, firestore.Increment):
+                self._profile[key] = self._profile.get(key, 0) + value.value
+            else:
+                self._profile[key] = value
+
+    def update_profile(self, fields):
+        """users/{uid} を更新し、手元の値も同じように更新する"""
+        self.user_ref.update(fields)
+        self.apply_profile(fields)
+
+    def invalidate_profile(self):
+        self._profile = None
+
+    # --- 進行中の入室記録 ---
+    def active_attendance(self):
+        """進行中の入室記録 {"id", "entry_timestamp", ...}（無ければ None）"""
+        if self._attendance is not _UNSET and self._fresh(self._attendance_at):
+            self.hits += 1
+            return copy.copy(self._attendance)
+        active_logs = self.user_ref.collection("attendance_logs")\
+                                   .where("status", "==", "active")\
+                                   .limit(1).stream()
+        doc = next(active_logs, None)
+        self.reads += 1
+        if doc is not None:
+            self.set_active_attendance(doc.id, doc.to_dict())
+        else:
+            self.clear_active_attendance()
+        return copy.copy(self._attendance)
+
+    def set_active_attendance(self, log_id, data):
+        """入室を記録した（または読み込んだ）ときに手元の値を置き換える。
+        entry_timestamp が SERVER_TIMESTAMP のままなら今の時刻で代用する"""
+        data = dict(data)
+        if data.get("entry_timestamp") is firestore.SERVER_TIMESTAMP:
+            data["entry_timestamp"] = datetime.datetime.now(datetime.timezone.utc)
+        self._attendance = {**data, "id": log_id}
+        self._attendance_at = time.time()
+
+    def clear_active_attendance(self):
+        self._attendance = None
+        self._attendance_at = time.time()
+
+    def stats(self):
+        return {"reads": self.reads, "hits": self.hits}
@@ -0,0 +1,231 @@
+"""
+チャットの新しい質問に似た、過去のアーカイブのやり取りを探す（TF-IDF のコサイン類似度）。
+
+アーカイブの検索索引（archive_search のセグメント）に入っている発言から
+「生徒の質問 + 直後のコーチの返答」を1件のやり取りとし、質問を文字バイグラムの特徴にする。
+特徴はバイグラムを crc32 でハッシュした整数で、全やり取りの (特徴, やり取り番号, 1+log(出現数)) を
+NumPy の配列に持つ。検索は質問の特徴ごとに、特徴でソートした配列の該当範囲をまとめて取り出し、
+np.bincount でやり取りごとの内積を一度に計算する（Python のループはやり取りの件数に比例しない）。
+
+新しいアーカイブが索引に入ったら、そのセグメントの分だけハッシュして配列に足す（既存分は計算し直さない）。
+IDF・ノルムとソートは次の検索時にベクトル演算でまとめて作り直す。
+
+初回（索引セグメントの全件読み込みと特徴の作成）はチャットの応答を待たせないよう裏のスレッドで行い、
+それが終わるまでの質問では何も出さない。
+"""
+import math
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from archive_search import bigrams, normalize
+
+# これより短い質問（「はい」「わかった」など）では探さない
+MIN_QUERY_CHARS = 6
+# これ未満のコサイン類似度は「似た問題」として出さない
+MIN_SIMILARITY = 0.2
+QUESTION_PREVIEW_CHARS = 150
+ANSWER_PREVIEW_CHARS = 300
+
+
+def hashed_features(text):
+    """本文 → (特徴の配列 uint32, 1+log(出現数) の配列 float32)。特徴は昇順で重複なし"""
+    counts = Counter(zlib.crc32(gram.encode("utf-8")) for gram in bigrams(normalize(text).lower()))
+    if not counts:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.float32)
+    feats = np.fromiter(counts.keys(), dtype=np.uint32, count=len(counts))
+    tfs = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    order = np.argsort(feats)
+    return feats[order], 1.0 + np.log(tfs[order])
+
+
+def exchanges_from_segment(segment):
+    """セグメント → [(質問, 返答)]（生徒の発言と、その直後のコーチの発言の組）"""
+    docs = segment["docs"]
+    pairs = []
+    for i, (role, text, _) in enumerate(docs):
+        if role != "user" or len(text) < MIN_QUERY_CHARS:
+            continue
+        answer = docs[i + 1][1] if i + 1 < len(docs) and docs[i + 1][0] != "user" else ""
+        pairs.append((text, answer))
+    return pairs
+
+
+class _UserVectors:
+    """1ユーザー分のやり取りの特徴（三つ組の配列）と、検索用に並べ替えた形"""
+
+    def __init__(self):
+        self.segment_keys = set()
+        self.meta = []  # やり取り番号 -> {"archive_id", "title", "archived_at", "question", "answer"}
+        self._feats = []
+        self._docs = []
+        self._weights = []
+        self._prepared = None
+
+    def add_segment(self, key, segment):
+        for question, answer in exchanges_from_segment(segment):
+            feats, weights = hashed_features(question)
+            if not len(feats):
+                continue
+            doc_no = len(self.meta)
+            self.meta.append({
+                "archive_id": segment["archive_id"],
+                "title": segment["title"],
+                "archived_at": segment["archived_at"],
+                "question": question[:QUESTION_PREVIEW_CHARS],
+                "answer": answer[:ANSWER_PREVIEW_CHARS],
+            })
+            self._feats.append(feats)
+            self._docs.append(np.full(len(feats), doc_no, dtype=np.int32))
+            self._weights.append(weights)
+        self.segment_keys.add(key)
+        self._prepared = None
+
+    def _prepare(self):
+        """特徴の昇順に並べ、IDF を掛けた重みとやり取りごとのノルムを作る"""
+        if self._prepared is not None:
+            return self._prepared
+        feats = np.concatenate(self._feats)
+        docs = np.concatenate(self._docs)
+        weights = np.concatenate(self._weights)
+        # 次回は結合済みの1本から始める（足した分だけが小さな配列として後ろに付く）
+        self._feats, self._docs, self._weights = [feats], [docs], [weights]
+
+        order = np.argsort(feats, kind="stable")
+        feats, docs, weights = feats[order], docs[order], weights[order]
+        uniq, starts, df = np.unique(feats, return_index=True, return_counts=True)
+        n = len(self.meta)
+        idf = (np.log((1.0 + n) / (1.0 + df)) + 1.0).astype(np.float32)
+        weights = weights * np.repeat(idf, df)
+        norms = np.sqrt(np.bincount(docs, weights=weights * weights, minlength=n)).astype(np.float32)
+        self._prepared = (uniq, starts, df, idf, docs, weights, norms)
+        return self._prepared
+
+    def query(self, text, k):
+        if not self.meta:
+            return []
+        uniq, starts, df, idf, docs, weights, norms = self._prepare()
+        q_feats, q_weights = hashed_features(text)
+        pos = np.searchsorted(uniq, q_feats)
+        pos_ok = pos < len(uniq)
+        found = np.zeros(len(q_feats), dtype=bool)
+        found[pos_ok] = uniq[pos[pos_ok]] == q_feats[pos_ok]
+        # 過去に一度も出てこない特徴も質問のノルムには含める（IDF は最大値扱い）
+        q_weights = q_weights * np.where(found, idf[np.minimum(pos, len(uniq) - 1)], math.log(1.0 + len(self.meta)) + 1.0)
+        q_norm = float(np.sqrt(np.dot(q_weights, q_weights)))
+        if q_norm == 0 or not found.any():
+            return []
+
+        # 該当する特徴の範囲 [start, start+df) をまとめて1本のインデックス配列にする
+        lengths = df[pos[found]]
+        range_starts = starts[pos[found]]
+        total = int(lengths.sum())
+        offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        idx = np.repeat(range_starts, lengths) + offsets
+        dots = np.bincount(docs[idx], weights=weights[idx] * np.repeat(q_weights[found], lengths), minlength=len(self.meta))
+        sims = dots / (norms * q_norm + 1e-9)
+
+        top = np.argsort(-sims)[:k * 4]
+        hits, seen_archives = [], set()
+        for doc_no in top:
+            sim = float(sims[doc_no])
+            if sim < MIN_SIMILARITY:
+                break
+            meta = self.meta[doc_no]
+            if meta["archive_id"] in seen_archives:
+                continue  # 同じアーカイブからは1件だけ
+            seen_archives.add(meta["archive_id"])
+            hits.append({**meta, "similarity": round(sim, 3)})
+            if len(hits) >= k:
+                break
+        return hits
+
+
+class SimilarProblemIndex:
+    """
+    プロセスに1つ。ユーザーごとのやり取りの特徴を最大 max_users 人分メモリに持つ（LRU）。
+    search_index（ArchiveSearchIndex）のセグメントを元に作り、増えたセグメントの分だけ足していく。
+    """
+
+    def __init__(self, search_index, max_users=100):
+        self.search_index = search_index
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+        self._warming = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="similar-warm")
+        self.queries = 0
+        self.warmups = 0
+        self.last_query_ms = None
+        self.last_warm_ms = None
+
+    def _update_locked(self, uid, segments):
+        vectors = self._users.get(uid) or _UserVectors()
+        for key, segment in segments.items():
+            if key not in vectors.segment_keys:
+                vectors.add_segment(key, segment)
+        self._users[uid] = vectors
+        self._users.move_to_end(uid)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return vectors
+
+    def warm(self, uid):
+        """uid の索引と特徴を裏のスレッドで用意する（用意済み・準備中なら何もしない）"""
+        with self._lock:
+            if uid in self._users or uid in self._warming:
+                return
+            self._warming.add(uid)
+        self._executor.submit(self._warm, uid)
+
+    def _warm(self, uid):
+        started = time.perf_counter()
+        try:
+            segments = self.search_index.segments_for(uid)
+            with self._lock:
+                vectors = self._update_locked(uid, segments)
+                if vectors.meta:
+                    vectors._prepare()
+                self.warmups += 1
+                self.last_warm_ms = int((time.perf_counter() - started) * 1000)
+        except Exception as e:
+            print(f"Similar problem warm-up failed: {e}")
+        finally:
+            with self._lock:
+                self._warming.discard(uid)
+
+    def find_similar(self, uid, text, k=2):
+        """
+        text に似た過去のやり取りを類似度の高い順に最大 k 件（同じアーカイブからは1件）。
+        戻り値: [{"archive_id", "title", "archived_at", "question", "answer", "similarity"}]
+        """
+        if len(normalize(text)) < MIN_QUERY_CHARS:
+            return []
+        with self._lock:
+            ready = uid in self._users
+        if not ready or not self.search_index.is_loaded(uid):
+            self.warm(uid)  # 初回は待たずに空を返し、裏で用意する
+            return []
+        started = time.perf_counter()
+        segments = self.search_index.segments_for(uid)
+        with self._lock:
+            vectors = self._update_locked(uid, segments)
+            hits = vectors.query(text, k)
+            self.queries += 1
+            self.last_query_ms = round((time.perf_counter() - started) * 1000, 2)
+            return hits
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "exchanges": sum(len(v.meta) for v in self._users.values()),
+                "queries": self.queries,
+                "warmups": self.warmups,
+                "last_query_ms": self.last_query_ms,
+                "last_warm_ms": self.last_warm_ms,
+            }
@@ -0,0 +1,227 @@
+"""
+学習時間の事前集計（ロールアップ）ドキュメント。
+
+個人の合計は user_rollups/{period}_{bucket}_{uid} に1人1期間1ドキュメントで持つ。
+  例: user_rollups/day_2025-04-01_{uid}, user_rollups/week_2025-03-31_{uid}, user_rollups/month_2025-04_{uid}
+  {"period": "day", "bucket": "2025-04-01", "uid": uid, "minutes": 分数, "updated_at": SERVER_TIMESTAMP}
+（全員分を1つのドキュメントの map に持つと、クラス全員が一斉に退室した時に同じドキュメントへの書き込みが集中して
+  1ドキュメントあたりの書き込み上限を超え、map も生徒の数だけ大きくなるため、1人ずつに分ける）
+
+チームの合計は team_rollups/{period}_{bucket}_{team_id} に1チーム1ドキュメントで持つ。
+  {"period": "day", "bucket": "2025-04-01", "teamId": team_id, "minutes": 分数, "updated_at": SERVER_TIMESTAMP}
+個人・チームのランキングは period/bucket で絞って minutes の降順に並べる1本のクエリで取れる
+（Firestore の複合インデックス period + bucket + minutes(降順) が user_rollups・team_rollups それぞれに必要）。
+チームの合計は「今そのチームにいるメンバーの期間内の合計」とし、参加・脱退時に本人の分を付け替える。
+
+退室時のバッチで firestore.Increment により加算するので、ランキング画面は
+study_logs を数千件読む代わりにこれらの小さなドキュメントを読むだけで済む。
+バケットは JST（退室時刻）で決める。週は月曜始まりで、月曜の日付をバケット名にする。
+"""
+import datetime
+
+from firebase_admin import firestore
+
+from firestore_writer import MAX_BATCH_WRITES
+from study_stats import JST, PERIODS, aggregate_study_windows, bucket_key, widest_window_start
+
+USER_ROLLUP_COLLECTION = "user_rollups"
+TEAM_ROLLUP_COLLECTION = "team_rollups"
+
+
+def user_rollup_ref(db, period, dt, uid):
+    return db.collection(USER_ROLLUP_COLLECTION).document(f"{period}_{bucket_key(period, dt)}_{uid}")
+
+
+def team_rollup_ref(db, period, dt, team_id):
+    return db.collection(TEAM_ROLLUP_COLLECTION).document(f"{period}_{bucket_key(period, dt)}_{team_id}")
+
+
+def _add_team_minutes(batch, db, team_id, minutes_by_period, dt):
+    for period in PERIODS:
+        minutes = minutes_by_period.get(period, 0)
+        if not minutes:
+            continue
+        batch.set(team_rollup_ref(db, period, dt, team_id), {
+            "period": period,
+            "bucket": bucket_key(period, dt),
+            "teamId": team_id,
+            "minutes": firestore.Increment(minutes),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+
+def add_rollup_increments(batch, db, uid, team_id, minutes, dt):
+    """退室バッチに day/week/month の個人・チームのロールアップへの加算を積む（batch.commit は呼び出し側）"""
+    for period in PERIODS:
+        batch.set(user_rollup_ref(db, period, dt, uid), {
+            "period": period,
+            "bucket": bucket_key(period, dt),
+            "uid": uid,
+            "minutes": firestore.Increment(minutes),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+    if team_id:
+        _add_team_minutes(batch, db, team_id, {period: minutes for period in PERIODS}, dt)
+
+
+def add_team_move(batch, db, uid, old_team_id, new_team_id, minutes_by_period, dt):
+    """
+    チームの参加・脱退時に、本人の今日/今週/今月の分を旧チームから引いて新チームに足す（バッチ・トランザクションに積むだけ）。
+    minutes_by_period は load_user_minutes(db, uid, dt, transaction) で、トランザクションの書き込みより前に読んでおくこと。
+    どちらかが None なら片側だけ。戻り値: 付け替えた {period: 分}
+    """
+    if old_team_id:
+        _add_team_minutes(batch, db, old_team_id, {p: -m for p, m in minutes_by_period.items()}, dt)
+    if new_team_id:
+        _add_team_minutes(batch, db, new_team_id, minutes_by_period, dt)
+    return minutes_by_period
+
+
+def load_user_minutes(db, uid, dt=None, transaction=None):
+    """
+    1人分の現在の day/week/month の合計（get_all で1往復）。戻り値: {period: 分}
+    transaction を渡すとその中で読む（同時に退室した分の加算とずれないよう、チームの付け替えはこちらで読む）。
+    """
+    dt = dt or datetime.datetime.now(JST)
+    refs = {period: user_rollup_ref(db, period, dt, uid) for period in PERIODS}
+    snaps = db.get_all(list(refs.values()), field_paths=["minutes"], transaction=transaction)
+    by_path = {snap.reference.path: snap for snap in snaps}
+    result = {}
+    for period, ref in refs.items():
+        snap = by_path.get(ref.path)
+        data = snap.to_dict() if snap is not None and snap.exists else {}
+        result[period] = int(data.get("minutes", 0))
+    return result
+
+
+def load_rollups(db, dt=None):
+    """
+    現在の day/week/month の個人別ロールアップを全員分読む（順位インデックスの作り直し用。期間ごとに1クエリ）。
+    戻り値: {period: {"users": {uid: 分}}}（記録が無い期間は空）
+    """
+    dt = dt or datetime.datetime.now(JST)
+    result = {}
+    for period in PERIODS:
+        query = db.collection(USER_ROLLUP_COLLECTION)\
+                  .where("period", "==", period)\
+                  .where("bucket", "==", bucket_key(period, dt))\
+                  .select(["uid", "minutes"])
+        users = {}
+        for d in query.stream():
+            data = d.to_dict()
+            if data.get("uid") and data.get("minutes", 0) > 0:
+                users[data["uid"]] = data["minutes"]
+        result[period] = {"users": users}
+    return result
+
+
+def load_user_ranking(db, period, dt=None, limit=50):
+    """期間の個人ランキング上位（分の多い順）を1本のクエリで読む。戻り値: [(uid, 分)]"""
+    dt = dt or datetime.datetime.now(JST)
+    query = db.collection(USER_ROLLUP_COLLECTION)\
+              .where("period", "==", period)\
+              .where("bucket", "==", bucket_key(period, dt))\
+              .order_by("minutes", direction=firestore.Query.DESCENDING)\
+              .limit(limit)
+    result = []
+    for d in query.stream():
+        data = d.to_dict()
+        if data.get("minutes", 0) > 0:
+            result.append((data.get("uid"), data["minutes"]))
+    return result
+
+
+def load_team_ranking(db, period, dt=None, limit=20):
+    """期間のチームランキング（分の多い順）を1本のクエリで読む。戻り値: [(team_id, 分)]"""
+    dt = dt or datetime.datetime.now(JST)
+    query = db.collection(TEAM_ROLLUP_COLLECTION)\
+              .where("period", "==", period)\
+              .where("bucket", "==", bucket_key(period, dt))\
+              .order_by("minutes", direction=firestore.Query.DESCENDING)\
+              .limit(limit)
+    result = []
+    for d in query.stream():
+        data = d.to_dict()
+        if data.get("minutes", 0) > 0:
+            result.append((data.get("teamId"), data["minutes"]))
+    return result
+
+
+def rebuild_rollups(db, dt=None, page_size=500):
+    """
+    （管理者用）現在の day/week/month のロールアップを study_logs から作り直す。
+    ロールアップ導入前のログの取り込みや、ずれた時の修復用。チームは各ユーザーの現在の teamId で数える。
+    戻り値: 読み込んだログ件数
+    """
+    dt = dt or datetime.datetime.now(JST)
+
+    def stream_logs():
+        # 日/週/月のうち一番広い窓だけを、limit で打ち切らずカーソルで最後までページングして1回読む
+        query = db.collection_group("study_logs").where("timestamp", ">=", widest_window_start(dt)).order_by("timestamp")
+        last_doc = None
+        while True:
+            page_query = query.start_after(last_doc) if last_doc else query
+            docs = list(page_query.limit(page_size).stream())
+            for d in docs:
+                parent_ref = d.reference.parent.parent
+                data = d.to_dict()
+                yield (parent_ref.id if parent_ref else None, data.get("minutes", 0), data.get("timestamp"))
+            if len(docs) < page_size:
+                break
+            last_doc = docs[-1]
+
+    # チーム別の集計には各ユーザーの現在の teamId が要るので、ログを一度手元に読み切ってから teamId を引く
+    records = list(stream_logs())
+    uids = {uid for uid, _, _ in records if uid}
+    user_refs = [db.collection("users").document(uid) for uid in uids]
+    team_of = {}
+    for snap in db.get_all(user_refs, field_paths=["teamId"]) if user_refs else []:
+        team_id = (snap.to_dict() or {}).get("teamId") if snap.exists else None
+        if team_id:
+            team_of[snap.id] = team_id
+    aggregated = aggregate_study_windows(records, dt, team_of)
+
+    writes = []  # (ref, data, update で書くか)
+    for period in PERIODS:
+        users = aggregated["personal"][period]
+        teams = aggregated["teams"][period]
+        # 既存の個人・チームのドキュメントは、今回の集計に出てこなければ0にする
+        existing_users = db.collection(USER_ROLLUP_COLLECTION)\
+                           .where("period", "==", period)\
+                           .where("bucket", "==", bucket_key(period, dt)).stream()
+        for d in existing_users:
+            if d.to_dict().get("uid") not in users:
+                writes.append((d.reference, {"minutes": 0, "updated_at": firestore.SERVER_TIMESTAMP}, True))
+        for uid, mins in users.items():
+            writes.append((user_rollup_ref(db, period, dt, uid), {
+                "period": period,
+                "bucket": bucket_key(period, dt),
+                "uid": uid,
+                "minutes": mins,
+                "updated_at": firestore.SERVER_TIMESTAMP,
+            }, False))
+        existing = db.collection(TEAM_ROLLUP_COLLECTION)\
+                     .where("period", "==", period)\
+                     .where("bucket", "==", bucket_key(period, dt)).stream()
+        for d in existing:
+            if d.to_dict().get("teamId") not in teams:
+                writes.append((d.reference, {"minutes": 0, "updated_at": firestore.SERVER_TIMESTAMP}, True))
+        for team_id, mins in teams.items():
+            writes.append((team_rollup_ref(db, period, dt, team_id), {
+                "period": period,
+                "bucket": bucket_key(period, dt),
+                "teamId": team_id,
+                "minutes": mins,
+                "updated_at": firestore.SERVER_TIMESTAMP,
+            }, False))
+
+    # 1バッチ500書き込みの上限があるので分けてコミットする
+    for i in range(0, len(writes), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for ref, data, is_update in writes[i:i + MAX_BATCH_WRITES]:
+            if is_update:
+                batch.update(ref, data)
+            else:
+                batch.set(ref, data)
+        batch.commit()
+    return aggregated["rows"]
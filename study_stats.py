@@ -0,0 +1,109 @@
+"""
+学習ログの期間集計エンジン（日/週/月をまとめて1パスで集計）。
+
+日・週・月の3つの窓を別々のクエリで集計すると、同じログを最大3回読むことになる。
+ここでは一番広い窓（今週の月曜と今月1日の早い方以降）を1回だけ読み、個人別・チーム別 × 日/週/月 の6表を一度に作る。
+減るのは読み込み件数（Firestore の読み取り）で、計算時間はほとんど変わらない。
+件数が多い時（VECTORIZE_MIN_ROWS 件以上）は各ログを「どの窓に入るか」の真偽行列にして pandas の group-by で集計するが、
+計測では 10万件未満で辞書での合計より速くならず、それ以上でも1割程度しか違わない（時間の大半は timestamp の変換）。
+※週は月をまたぐことがあるので「日 ⊂ 週 ⊂ 月」とは限らない（窓ごとに独立に判定する）。
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+PERIODS = ("day", "week", "month")
+# これ未満の件数はベクトル化せずに集計する（bench_study_aggregation.py で 1k 件: 0.2ms 対 5ms、1万件: 2ms 対 7ms）
+VECTORIZE_MIN_ROWS = 20000
+
+
+def period_start(period, dt):
+    """dt(JST) を含む期間の開始時刻"""
+    dt = dt.astimezone(JST)
+    day_start = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "day":
+        return day_start
+    if period == "week":
+        return day_start - datetime.timedelta(days=day_start.weekday())
+    if period == "month":
+        return day_start.replace(day=1)
+    raise ValueError(f"unknown period: {period}")
+
+
+def bucket_key(period, dt):
+    """期間のバケット名（day: YYYY-MM-DD / week: 月曜の YYYY-MM-DD / month: YYYY-MM）"""
+    start = period_start(period, dt)
+    return start.strftime("%Y-%m") if period == "month" else start.strftime("%Y-%m-%d")
+
+
+def widest_window_start(now):
+    """1回で読むべき範囲の開始（日/週/月の開始のうち最も古いもの）"""
+    return min(period_start(period, now) for period in PERIODS)
+
+
+def aggregate_study_windows(records, now=None, team_of=None):
+    """
+    records: (uid, minutes, timestamp) の iterable（Firestore のストリームをそのまま流してよい。1回だけ読む）
+    team_of: {uid: team_id}（チーム表が不要なら None）
+    戻り値: {"personal": {period: {uid: 分}}, "teams": {period: {team_id: 分}}, "rows": 読んだ件数}
+    """
+    now = now or datetime.datetime.now(JST)
+    uids, minutes, epochs = [], [], []
+    for uid, mins, ts in records:
+        if uid is None or ts is None:
+            continue
+        uids.append(uid)
+        minutes.append(mins or 0)
+        epochs.append(ts.timestamp())
+
+    personal = {period: {} for period in PERIODS}
+    teams = {period: {} for period in PERIODS}
+    if not uids:
+        return {"personal": personal, "teams": teams, "rows": 0}
+    if len(uids) < VECTORIZE_MIN_ROWS:
+        return _aggregate_small(uids, minutes, epochs, now, team_of)
+
+    # uid を整数コードにし、(uid, 窓) ごとの合計を bincount でまとめて出す（行ごとの Python ループなし）
+    codes, unique_uids = pd.factorize(np.asarray(uids, dtype=object))
+    mins = np.asarray(minutes, dtype=np.int64)
+    ts = np.asarray(epochs, dtype=np.float64)
+    by_user = pd.DataFrame(
+        {period: np.bincount(codes, weights=mins * (ts >= period_start(period, now).timestamp()),
+                             minlength=len(unique_uids)).astype(np.int64)
+         for period in PERIODS},
+        index=unique_uids,
+    )
+
+    for period in PERIODS:
+        col = by_user[period]
+        personal[period] = {uid: int(v) for uid, v in col[col > 0].items()}
+
+    if team_of:
+        team_ids = pd.Series(unique_uids, index=unique_uids).map(team_of)
+        by_team = by_user[team_ids.notna()].groupby(team_ids.dropna()).sum()
+        for period in PERIODS:
+            col = by_team[period]
+            teams[period] = {team_id: int(v) for team_id, v in col[col > 0].items()}
+
+    return {"personal": personal, "teams": teams, "rows": len(uids)}
+
+
+def _aggregate_small(uids, minutes, epochs, now, team_of):
+    """件数が少ない時の集計（aggregate_study_windows と同じ戻り値）"""
+    starts = [(period, period_start(period, now).timestamp()) for period in PERIODS]
+    personal = {period: {} for period in PERIODS}
+    for uid, mins, epoch in zip(uids, minutes, epochs):
+        for period, start in starts:
+            if epoch >= start:
+                personal[period][uid] = personal[period].get(uid, 0) + mins
+    teams = {period: {} for period in PERIODS}
+    for period in PERIODS:
+        personal[period] = {uid: int(v) for uid, v in personal[period].items() if v > 0}
+        if team_of:
+            for uid, v in personal[period].items():
+                team_id = team_of.get(uid)
+                if team_id:
+                    teams[period][team_id] = teams[period].get(team_id, 0) + v
+    return {"personal": personal, "teams": teams, "rows": len(uids)}
@@ -0,0 +1,135 @@
+"""
+チームの作成・参加・脱退（トランザクション）。
+
+招待コードは teamCodes/{code} → {"teamId"} の索引ドキュメントで引く（where クエリではなく直接 get）。
+作成時はコードの重複をトランザクション内で確認してからチームと索引を同時に書き、
+参加・脱退は teams.members と users.teamId、チームの期間合計（team_rollups）を1つのトランザクションで更新する。
+付け替える本人の期間合計（user_rollups）もトランザクションの中で、書き込みより前に読む。
+同時に参加した場合も、どちらかが読み直して再実行されるので所属がずれない。
+"""
+import datetime
+import secrets
+
+from firebase_admin import firestore
+
+from study_rollups import add_team_move, load_user_minutes
+from study_stats import JST
+
+TEAM_CODE_COLLECTION = "teamCodes"
+# 読み間違えやすい 0/O/1/I は使わない
+TEAM_CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+TEAM_CODE_LENGTH = 6
+
+
+class TeamCodeCollision(Exception):
+    pass
+
+
+class TeamJoinError(Exception):
+    """参加できない理由（画面にそのまま出せるメッセージ）"""
+
+
+def generate_team_code():
+    return "".join(secrets.choice(TEAM_CODE_ALPHABET) for _ in range(TEAM_CODE_LENGTH))
+
+
+def team_code_ref(db, code):
+    return db.collection(TEAM_CODE_COLLECTION).document(code)
+
+
+def create_team(db, uid, name, max_attempts=5):
+    """チームを作って作成者を参加させる。戻り値: (team_id, code)"""
+    user_ref = db.collection("users").document(uid)
+
+    @firestore.transactional
+    def _create(transaction, code):
+        code_ref = team_code_ref(db, code)
+        if code_ref.get(transaction=transaction).exists:
+            raise TeamCodeCollision(code)
+        user_snap = user_ref.get(transaction=transaction)
+        if user_snap.exists and (user_snap.to_dict() or {}).get("teamId"):
+            raise TeamJoinError("既に別のチームに参加しています")
+        now = datetime.datetime.now(JST)
+        minutes_by_period = load_user_minutes(db, uid, now, transaction=transaction)
+
+        team_ref = db.collection("teams").document()
+        transaction.set(team_ref, {
+            "name": name,
+            "teamCode": code,
+            "members": [uid],
+            "createdAt": firestore.SERVER_TIMESTAMP
+        })
+        transaction.set(code_ref, {"teamId": team_ref.id, "createdAt": firestore.SERVER_TIMESTAMP})
+        transaction.update(user_ref, {"teamId": team_ref.id})
+        add_team_move(transaction, db, uid, None, team_ref.id, minutes_by_period, now)
+        return team_ref.id
+
+    for _ in range(max_attempts):
+        code = generate_team_code()
+        try:
+            return _create(db.transaction(), code), code
+        except TeamCodeCollision:
+            continue
+    raise TeamJoinError("招待コードの発行に失敗しました。もう一度お試しください")
+
+
+def resolve_team_code(db, code):
+    """招待コード → team_id（索引が無い古いチームは teamCode で探して索引を作る）。無ければ None"""
+    snap = team_code_ref(db, code).get()
+    if snap.exists:
+        return (snap.to_dict() or {}).get("teamId")
+    legacy = next(db.collection("teams").where("teamCode", "==", code).limit(1).stream(), None)
+    if legacy is None:
+        return None
+    team_code_ref(db, code).set({"teamId": legacy.id, "createdAt": firestore.SERVER_TIMESTAMP})
+    return legacy.id
+
+
+def join_team(db, uid, code):
+    """招待コードのチームに参加する。戻り値: (team_id, チーム名)（参加できなければ TeamJoinError）"""
+    team_id = resolve_team_code(db, code)
+    if not team_id:
+        raise TeamJoinError("チームが見つかりませんでした。コードを確認してください。")
+    user_ref = db.collection("users").document(uid)
+    team_ref = db.collection("teams").document(team_id)
+
+    @firestore.transactional
+    def _join(transaction):
+        team_snap = team_ref.get(transaction=transaction)
+        if not team_snap.exists:
+            raise TeamJoinError("チームが見つかりませんでした。コードを確認してください。")
+        team_data = team_snap.to_dict()
+        user_snap = user_ref.get(transaction=transaction)
+        current_team = (user_snap.to_dict() or {}).get("teamId") if user_snap.exists else None
+        if uid in team_data.get("members", []) or current_team == team_id:
+            raise TeamJoinError("既に参加しています")
+        if current_team:
+            raise TeamJoinError("既に別のチームに参加しています")
+        now = datetime.datetime.now(JST)
+        minutes_by_period = load_user_minutes(db, uid, now, transaction=transaction)
+
+        transaction.update(team_ref, {"members": firestore.ArrayUnion([uid])})
+        transaction.update(user_ref, {"teamId": team_id})
+        add_team_move(transaction, db, uid, None, team_id, minutes_by_period, now)
+        return team_id, team_data.get("name")
+
+    return _join(db.transaction())
+
+
+def leave_team(db, uid, team_id):
+    """チームから脱退する（メンバー・所属・チームの期間合計を同時に更新）"""
+    user_ref = db.collection("users").document(uid)
+    team_ref = db.collection("teams").document(team_id)
+
+    @firestore.transactional
+    def _leave(transaction):
+        user_snap = user_ref.get(transaction=transaction)
+        if (user_snap.to_dict() or {}).get("teamId") != team_id:
+            return  # 別タブなどで既に脱退済み
+        now = datetime.datetime.now(JST)
+        minutes_by_period = load_user_minutes(db, uid, now, transaction=transaction)
+        transaction.update(team_ref, {"members": firestore.ArrayRemove([uid])})
+        transaction.update(user_ref, {"teamId": firestore.DELETE_FIELD})
+        add_team_move(transaction, db, uid, team_id, None, minutes_by_period, now)
+
+    _leave(db.transaction())
@@ -0,0 +1,51 @@
+"""
+テスト共通の設定。
+
+リポジトリ直下のモジュールを import できるようにし、Firestore の SDK が入っていない環境では
+import に必要な名前だけを持つ空のモジュールを置く（テストでは実際の Firestore には接続しない）。
+"""
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _module(name, **attrs):
+    module = sys.modules.get(name) or types.ModuleType(name)
+    for key, value in attrs.items():
+        setattr(module, key, value)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+try:
+    import google.api_core.exceptions  # noqa: F401
+    import google.cloud.firestore_v1.bulk_writer  # noqa: F401
+except ImportError:
+    class _GoogleAPICallError(Exception):
+        pass
+
+    _module("google")
+    _module("google.api_core")
+    _module("google.api_core.exceptions", GoogleAPICallError=_GoogleAPICallError, **{
+        name: type(name, (_GoogleAPICallError,), {})
+        for name in ("NotFound", "AlreadyExists", "InvalidArgument", "FailedPrecondition",
+                     "PermissionDenied", "ServiceUnavailable", "DeadlineExceeded", "Aborted")
+    })
+    _module("google.cloud")
+    _module("google.cloud.firestore_v1")
+    _module("google.cloud.firestore_v1.bulk_writer", BulkRetry=object, BulkWriterOptions=object, SendMode=object)
+
+try:
+    import firebase_admin.firestore  # noqa: F401
+except ImportError:
+    class _Query:
+        ASCENDING = "ASCENDING"
+        DESCENDING = "DESCENDING"
+
+    _module("firebase_admin")
+    _module("firebase_admin.firestore", SERVER_TIMESTAMP=object(), Query=_Query)
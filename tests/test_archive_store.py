@@ -0,0 +1,185 @@
+import datetime
+import random
+
+import pytest
+
+import archive_store
+from archive_store import (
+    ArchiveIntegrityError,
+    encode_chunks,
+    iter_decoded_messages,
+    load_archive_messages,
+    write_chunked_archive,
+)
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data, field_paths=None):
+        self.id = doc_id
+        self.exists = data is not None
+        if data is not None and field_paths is not None:
+            data = {key: data[key] for key in field_paths if key in data}
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data.get(field)
+
+
+class FakeQuery:
+    def __init__(self, store, prefix, order=None, after=None, limit=None):
+        self.store, self.prefix, self.order, self.after, self._limit = store, prefix, order, after, limit
+
+    def order_by(self, field):
+        return FakeQuery(self.store, self.prefix, field, self.after, self._limit)
+
+    def start_after(self, values):
+        return FakeQuery(self.store, self.prefix, self.order, values[self.order], self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self.store, self.prefix, self.order, self.after, count)
+
+    def stream(self):
+        rows = [(path[len(self.prefix):], data) for path, data in self.store.docs.items()
+                if path.startswith(self.prefix) and "/" not in path[len(self.prefix):]]
+        rows.sort(key=lambda row: row[1][self.order])
+        if self.after is not None:
+            rows = [row for row in rows if row[1][self.order] > self.after]
+        self.store.chunk_pages += 1
+        return [FakeSnapshot(doc_id, data) for doc_id, data in rows[:self._limit]]
+
+
+class FakeDocRef:
+    def __init__(self, store, path):
+        self.store, self.path = store, path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.store, f"{self.path}/{name}")
+
+    def get(self, field_paths=None):
+        return FakeSnapshot(self.id, self.store.docs.get(self.path), field_paths)
+
+    def set(self, data):
+        self.store.docs[self.path] = dict(data)
+
+    def delete(self):
+        self.store.docs.pop(self.path, None)
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, store, path):
+        super().__init__(store, path + "/")
+        self.path = path
+
+    def document(self, doc_id=None):
+        return FakeDocRef(self.store, f"{self.path}/{doc_id or 'auto%04d' % len(self.store.docs)}")
+
+
+class FakeBatch:
+    def __init__(self, store):
+        self.store, self.ops = store, []
+
+    def set(self, ref, data):
+        self.ops.append((ref, data))
+
+    def commit(self):
+        for ref, data in self.ops:
+            ref.set(data)
+
+
+class FakeStore:
+    def __init__(self):
+        self.docs = {}
+        self.chunk_pages = 0
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+def sample_messages(count, seed=0):
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        text = "".join(rng.choice("あいうえおabcxyz0123 \n\"\\") for _ in range(rng.randint(0, 400)))
+        messages.append({"role": "user" if i % 2 == 0 else "model", "content": text, "n": i})
+    return messages
+
+
+@pytest.mark.parametrize("chunk_bytes", [64, 1024, archive_store.DEFAULT_CHUNK_BYTES])
+def test_encode_and_decode_round_trip(chunk_bytes):
+    messages = sample_messages(300)
+    chunks, meta = encode_chunks(messages, chunk_bytes)
+
+    assert all(len(chunk["data"]) <= chunk_bytes for chunk in chunks)
+    assert [chunk["index"] for chunk in chunks] == list(range(len(chunks)))
+    assert meta["chunk_count"] == len(chunks)
+    assert meta["message_count"] == len(messages)
+    assert list(iter_decoded_messages(iter(chunks), meta["sha256"])) == messages
+
+
+def test_round_trip_of_empty_conversation():
+    chunks, meta = encode_chunks([])
+    assert list(iter_decoded_messages(iter(chunks), meta["sha256"])) == []
+
+
+def test_datetimes_are_stored_as_iso_strings():
+    sent_at = datetime.datetime(2024, 4, 1, 9, 30)
+    chunks, meta = encode_chunks([{"role": "user", "content": "x", "timestamp": sent_at}])
+
+    assert list(iter_decoded_messages(chunks, meta["sha256"])) == [
+        {"role": "user", "content": "x", "timestamp": sent_at.isoformat()},
+    ]
+
+
+def test_missing_or_corrupted_chunk_is_rejected():
+    chunks, meta = encode_chunks(sample_messages(200), chunk_bytes=256)
+    assert len(chunks) > 2
+
+    with pytest.raises(ArchiveIntegrityError):
+        list(iter_decoded_messages(chunks[:1] + chunks[2:], meta["sha256"]))
+
+    tampered = [dict(chunk) for chunk in chunks]
+    tampered[1]["data"] = bytes([tampered[1]["data"][0] ^ 1]) + tampered[1]["data"][1:]
+    with pytest.raises(ArchiveIntegrityError):
+        list(iter_decoded_messages(tampered, meta["sha256"]))
+
+    with pytest.raises(ArchiveIntegrityError):
+        list(iter_decoded_messages(chunks, "0" * 64))
+
+
+def test_chunked_archive_is_read_back_page_by_page():
+    store = FakeStore()
+    user_ref = FakeDocRef(store, "users/u1")
+    messages = sample_messages(400, seed=1)
+    header_ref = write_chunked_archive(store, user_ref, "title", messages, "note", chunk_bytes=512, archive_id="a1")
+    header = store.docs[header_ref.path]
+
+    assert header["format"] == archive_store.CHUNKED_FORMAT
+    assert header["chunk_count"] > 8
+    assert load_archive_messages(user_ref, "a1") == messages
+    # chunk_page(8) 件ずつ読むので、全件を1回で読まない
+    assert store.chunk_pages == header["chunk_count"] // 8 + 1
+
+
+def test_legacy_archive_with_messages_array_is_still_readable():
+    store = FakeStore()
+    user_ref = FakeDocRef(store, "users/u1")
+    messages = sample_messages(20, seed=2)
+    store.docs["users/u1/archived_sessions/old"] = {"title": "old", "messages": messages}
+
+    assert load_archive_messages(user_ref, "old") == messages
+    assert store.chunk_pages == 0
+
+
+def test_missing_archive_yields_nothing():
+    store = FakeStore()
+    assert load_archive_messages(FakeDocRef(store, "users/u1"), "nope") == []
+
+
+def test_json_lines_survive_embedded_newlines():
+    messages = [{"role": "user", "content": "1行目\n2行目\n"}, {"role": "model", "content": ""}]
+    chunks, meta = encode_chunks(messages, chunk_bytes=8)
+    assert list(iter_decoded_messages(chunks, meta["sha256"])) == messages
@@ -0,0 +1,174 @@
+import threading
+
+from google.api_core import exceptions as google_exceptions
+
+import firestore_writer
+from firestore_writer import WriteBehindQueue
+
+
+class FakeRef:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+
+    def set(self, data, merge=False):
+        self.db.write("set", self, data)
+
+    def update(self, data):
+        self.db.write("update", self, data)
+
+    def delete(self):
+        self.db.write("delete", self, None)
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def set(self, ref, data, merge=False):
+        self.ops.append(("set", ref, data))
+
+    def update(self, ref, data):
+        self.ops.append(("update", ref, data))
+
+    def delete(self, ref):
+        self.ops.append(("delete", ref, None))
+
+    def commit(self):
+        with self.db.lock:
+            self.db.batch_commits += 1
+            if self.db.fail_batches:
+                raise google_exceptions.ServiceUnavailable("batch unavailable")
+        for kind, ref, data in self.ops:
+            self.db.apply(kind, ref, data)
+
+
+class FakeDB:
+    """batch() と1件ずつの書き込みを受け付け、反映した順序を記録する"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.applied = []
+        self.batch_commits = 0
+        self.fail_batches = False
+        self.failures = {}  # path → 1件書き込みで投げる例外のリスト（先頭から1回ずつ）
+
+    def ref(self, path):
+        return FakeRef(self, path)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def write(self, kind, ref, data):
+        with self.lock:
+            pending = self.failures.get(ref.path)
+            if pending:
+                raise pending.pop(0)
+        self.apply(kind, ref, data)
+
+    def apply(self, kind, ref, data):
+        with self.lock:
+            self.applied.append((ref.path, data))
+            if kind == "delete":
+                self.docs.pop(ref.path, None)
+            else:
+                self.docs[ref.path] = data
+
+
+def make_queue(db, **kwargs):
+    kwargs.setdefault("flush_interval", 60.0)
+    kwargs.setdefault("batch_retries", 1)
+    return WriteBehindQueue(db, **kwargs)
+
+
+def test_flush_commits_in_enqueue_order():
+    db = FakeDB()
+    queue = make_queue(db)
+    for i in range(5):
+        queue.enqueue_set(db.ref(f"logs/{i}"), {"n": i})
+
+    assert queue.flush(timeout=5)
+    assert [path for path, _ in db.applied] == [f"logs/{i}" for i in range(5)]
+    assert queue.stats()["pending"] == 0
+    assert queue.stats()["committed"] == 5
+    queue.close()
+
+
+def test_flush_without_pending_writes_returns_immediately():
+    db = FakeDB()
+    queue = make_queue(db)
+    assert queue.flush(timeout=0.1)
+    assert db.batch_commits == 0
+    queue.close()
+
+
+def test_max_batch_splits_commits():
+    db = FakeDB()
+    queue = make_queue(db, max_batch=2)
+    for i in range(5):
+        queue.enqueue_set(db.ref(f"logs/{i}"), {"n": i})
+
+    assert queue.flush(timeout=5)
+    assert db.batch_commits == 3
+    assert [data["n"] for _, data in db.applied] == [0, 1, 2, 3, 4]
+    queue.close()
+
+
+def test_transient_failure_is_requeued_and_keeps_per_document_order(monkeypatch):
+    monkeypatch.setattr(firestore_writer.time, "sleep", lambda seconds: None)
+    db = FakeDB()
+    db.fail_batches = True
+    db.failures["docs/a"] = [google_exceptions.ServiceUnavailable("try again")]
+    queue = make_queue(db)
+    queue.enqueue_set(db.ref("docs/a"), {"v": "a1"})
+    queue.enqueue_set(db.ref("docs/b"), {"v": "b1"})
+    queue.enqueue_set(db.ref("docs/a"), {"v": "a2"})
+
+    assert queue.flush(timeout=5)
+    # docs/a の1件目が戻されたら、同じドキュメントの2件目も一緒に戻して後から書く
+    assert [data["v"] for path, data in db.applied if path == "docs/a"] == ["a1", "a2"]
+    assert db.docs["docs/a"] == {"v": "a2"}
+    assert db.docs["docs/b"] == {"v": "b1"}
+    stats = queue.stats()
+    assert stats["requeued"] == 2
+    assert stats["dropped"] == 0
+    queue.close()
+
+
+def test_requeued_writes_stay_ahead_of_later_writes(monkeypatch):
+    monkeypatch.setattr(firestore_writer.time, "sleep", lambda seconds: None)
+    db = FakeDB()
+    db.fail_batches = True
+    db.failures["docs/a"] = [google_exceptions.ServiceUnavailable("try again")]
+    queue = make_queue(db)
+    queue.enqueue_set(db.ref("docs/a"), {"v": "old"})
+    assert queue.flush(timeout=5)
+    assert db.docs["docs/a"] == {"v": "old"}
+
+    db.failures["docs/a"] = [google_exceptions.ServiceUnavailable("try again")]
+    queue.enqueue_set(db.ref("docs/a"), {"v": "first"})
+    queue.enqueue_set(db.ref("docs/a"), {"v": "second"})
+    assert queue.flush(timeout=5)
+    assert db.docs["docs/a"] == {"v": "second"}
+    queue.close()
+
+
+def test_permanent_failure_is_dropped_without_blocking_others(monkeypatch):
+    monkeypatch.setattr(firestore_writer.time, "sleep", lambda seconds: None)
+    db = FakeDB()
+    db.fail_batches = True
+    db.failures["docs/missing"] = [google_exceptions.NotFound("no such document")]
+    queue = make_queue(db)
+    queue.enqueue_update(db.ref("docs/missing"), {"v": 1})
+    queue.enqueue_set(db.ref("docs/ok"), {"v": 2})
+
+    assert queue.flush(timeout=5)
+    assert "docs/missing" not in db.docs
+    assert db.docs["docs/ok"] == {"v": 2}
+    stats = queue.stats()
+    assert stats["dropped"] == 1
+    assert stats["requeued"] == 0
+    assert stats["pending"] == 0
+    queue.close()
@@ -0,0 +1,88 @@
+import random
+
+import pytest
+
+from rank_index import IndexableSkipList, StudyRankIndex
+
+
+def test_skiplist_matches_sorted_list_under_inserts_and_removes():
+    rng = random.Random(7)
+    skiplist = IndexableSkipList(seed=1)
+    expected = []
+    for _ in range(2000):
+        if expected and rng.random() < 0.3:
+            key = rng.choice(expected)
+            expected.remove(key)
+            skiplist.remove(key)
+        else:
+            key = (-rng.randint(0, 50), f"u{rng.randint(0, 10 ** 6):07d}")
+            if key in expected:
+                continue
+            expected.append(key)
+            skiplist.insert(key)
+        expected.sort()
+
+    assert len(skiplist) == len(expected)
+    assert skiplist.slice(0, len(expected)) == expected
+    for pos in range(0, len(expected), 17):
+        assert skiplist[pos] == expected[pos]
+        assert skiplist.index(expected[pos]) == pos
+    assert skiplist[-1] == expected[-1]
+    assert skiplist.slice(5, 12) == expected[5:12]
+
+
+def test_skiplist_bisect_left_and_missing_keys():
+    skiplist = IndexableSkipList(seed=3)
+    for key in [(-30, "a"), (-20, "b"), (-20, "c"), (-10, "d")]:
+        skiplist.insert(key)
+
+    assert skiplist.bisect_left((-20, "")) == 1
+    assert skiplist.bisect_left((-5, "")) == 4
+    with pytest.raises(KeyError):
+        skiplist.index((-20, "z"))
+    with pytest.raises(KeyError):
+        skiplist.remove((-99, "a"))
+    with pytest.raises(IndexError):
+        skiplist[4]
+    assert skiplist.slice(3, 10) == [(-10, "d")]
+    assert skiplist.slice(4, 10) == []
+
+
+def make_index(users):
+    return StudyRankIndex(lambda: {period: {"users": dict(users)} for period in ("day", "week", "month")})
+
+
+def test_top_uses_competition_ranks_for_ties():
+    index = make_index({"a": 50, "b": 30, "c": 30, "d": 30, "e": 10})
+
+    assert index.top("day", 5) == [
+        (1, "a", 50), (2, "b", 30), (2, "c", 30), (2, "d", 30), (5, "e", 10),
+    ]
+
+
+def test_rank_of_and_neighbours_agree_with_top():
+    index = make_index({"a": 50, "b": 30, "c": 30, "d": 30, "e": 10, "f": 5})
+
+    assert index.rank_of("week", "d") == (2, 30, 6)
+    assert index.rank_of("week", "e") == (5, 10, 6)
+    assert index.rank_of("week", "nobody") == (None, 0, 6)
+    # 窓の先頭が同点の途中から始まっても、順位は同点の先頭に揃える
+    assert index.neighbours("week", "e", span=1) == [(2, "d", 30), (5, "e", 10), (6, "f", 5)]
+    assert index.neighbours("week", "nobody") == []
+
+
+def test_users_without_minutes_are_not_ranked():
+    index = make_index({"a": 10, "b": 0})
+
+    assert index.top("month", 10) == [(1, "a", 10)]
+    assert index.rank_of("month", "b") == (None, 0, 1)
+
+
+def test_add_minutes_moves_user_and_breaks_tie():
+    index = make_index({"a": 50, "b": 30, "c": 30})
+    index.top("day", 3)  # 一度読み込ませる
+
+    index.add_minutes("c", 25)
+    assert index.top("day", 3) == [(1, "c", 55), (2, "a", 50), (3, "b", 30)]
+    index.add_minutes("new", 30)
+    assert index.top("month", 4) == [(1, "c", 55), (2, "a", 50), (3, "b", 30), (3, "new", 30)]
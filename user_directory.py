@@ -0,0 +1,140 @@
+"""
+管理者画面用のユーザー名簿（前方一致検索 + カーソルでのページング）。
+
+users を画面のたびに全件 stream するのをやめ、プロセスに1つの名簿をメモリに持つ。
+  - 初回（と full_refresh_seconds ごと）に name/email だけのフィールドマスクで全件読む
+  - それ以外は refresh_seconds ごとに created_at が前回より新しいユーザーだけを追加で読む
+  - 同じプロセスでの作成・名前変更は upsert() で即時反映
+検索は「名前 or メール」の小文字キーのソート済みリストを二分探索するので、
+1ページの取得はユーザー数によらず O(log n + ページサイズ)。
+"""
+import bisect
+import threading
+import time
+
+NAME, EMAIL = 0, 1  # キーの種類（同じ人が名前とメールの両方で当たった時は名前側だけを返す）
+
+
+class UserDirectory:
+    def __init__(self, db, refresh_seconds=60, full_refresh_seconds=1800):
+        self.db = db
+        self.refresh_seconds = refresh_seconds
+        self.full_refresh_seconds = full_refresh_seconds
+        self._lock = threading.Lock()
+        self._users = {}  # uid -> (name, email)
+        self._keys = []  # ソート済みの (小文字キー, 種類, uid)
+        self._latest_created = None
+        self._full_loaded_at = 0.0
+        self._checked_at = 0.0
+        self.full_loads = 0
+        self.incremental_loads = 0
+
+    # --- 索引の更新 ---
+    @staticmethod
+    def _entry_keys(uid, name, email):
+        keys = [((name or "").lower(), NAME, uid)]
+        if email:
+            keys.append((email.lower(), EMAIL, uid))
+        return keys
+
+    def _remove_locked(self, uid):
+        old = self._users.pop(uid, None)
+        if old is None:
+            return
+        for key in self._entry_keys(uid, *old):
+            pos = bisect.bisect_left(self._keys, key)
+            if pos < len(self._keys) and self._keys[pos] == key:
+                del self._keys[pos]
+
+    def _upsert_locked(self, uid, name, email):
+        self._remove_locked(uid)
+        self._users[uid] = (name, email)
+        for key in self._entry_keys(uid, name, email):
+            bisect.insort(self._keys, key)
+
+    def _track_created_locked(self, created_at):
+        if created_at is not None and (self._latest_created is None or created_at > self._latest_created):
+            self._latest_created = created_at
+
+    def _full_load_locked(self):
+        users, latest = {}, None
+        for doc in self.db.collection("users").select(["name", "email", "created_at"]).stream():
+            data = doc.to_dict()
+            users[doc.id] = (data.get("name", "名称未設定"), data.get("email", ""))
+            created_at = data.get("created_at")
+            if created_at is not None and (latest is None or created_at > latest):
+                latest = created_at
+        keys = []
+        for uid, (name, email) in users.items():
+            keys.extend(self._entry_keys(uid, name, email))
+        keys.sort()
+        self._users, self._keys, self._latest_created = users, keys, latest
+        self._full_loaded_at = self._checked_at = time.time()
+        self.full_loads += 1
+
+    def _incremental_load_locked(self):
+        if self._latest_created is None:
+            return
+        query = self.db.collection("users")\
+                       .where("created_at", ">", self._latest_created)\
+                       .order_by("created_at")\
+                       .select(["name", "email", "created_at"])
+        for doc in query.stream():
+            data = doc.to_dict()
+            self._upsert_locked(doc.id, data.get("name", "名称未設定"), data.get("email", ""))
+            self._track_created_locked(data.get("created_at"))
+        self._checked_at = time.time()
+        self.incremental_loads += 1
+
+    def _ensure_fresh_locked(self):
+        now = time.time()
+        if not self._full_loaded_at or now - self._full_loaded_at > self.full_refresh_seconds:
+            self._full_load_locked()
+        elif now - self._checked_at > self.refresh_seconds:
+            self._incremental_load_locked()
+
+    def upsert(self, uid, name, email=None):
+        """作成・名前変更をその場で反映する（email を省略したら今の値のまま）"""
+        with self._lock:
+            if not self._full_loaded_at:
+                return  # まだ読み込んでいない → 初回の全件読み込みで入る
+            if email is None:
+                email = self._users.get(uid, (None, ""))[1]
+            self._upsert_locked(uid, name, email)
+
+    def invalidate(self):
+        """次の参照で全件読み直す"""
+        with self._lock:
+            self._full_loaded_at = 0.0
+
+    # --- 検索 ---
+    def search(self, query="", cursor=None, limit=20):
+        """
+        名前・メールの前方一致で1ページ分を返す（query が空なら名前順の全員）。
+        cursor は前のページの next_cursor。戻り値: (rows, next_cursor)
+          rows: [{"uid", "name", "email"}], next_cursor: 続きが無ければ None
+        """
+        prefix = (query or "").strip().lower()
+        with self._lock:
+            self._ensure_fresh_locked()
+            keys = self._keys
+            pos = bisect.bisect_right(keys, tuple(cursor)) if cursor else bisect.bisect_left(keys, (prefix,))
+            rows = []
+            last_key = None
+            while pos < len(keys) and len(rows) < limit:
+                key = keys[pos]
+                if not key[0].startswith(prefix):
+                    break
+                pos += 1
+                text, kind, uid = key
+                name, email = self._users[uid]
+                last_key = key
+                if kind == EMAIL and (not prefix or (name or "").lower().startswith(prefix)):
+                    continue  # 名前側のキーで既に返している（または返す）人
+                rows.append({"uid": uid, "name": name, "email": email})
+            has_more = pos < len(keys) and keys[pos][0].startswith(prefix)
+            return rows, (list(last_key) if has_more and last_key else None)
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._users), "full_loads": self.full_loads, "incremental_loads": self.incremental_loads}